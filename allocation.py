@@ -0,0 +1,133 @@
+""" Batch allocation of idle drones to free operators. """
+
+from drones import Drone
+from operators import Operator
+
+
+class AllocationPlan(object):
+    """ The result of planning a batch allocation. """
+
+    def __init__(self):
+        self.assignments = []
+        self.unmatched = []
+
+    def add_assignment(self, drone, operator):
+        """ Records that the drone is allocated to the operator. """
+        self.assignments.append((drone, operator))
+
+    def add_unmatched(self, drone, reason):
+        """ Records that the drone could not be allocated and why. """
+        self.unmatched.append((drone, reason))
+
+
+class AllocationEngine(object):
+    """ Allocates all the unallocated drones to free operators in one batch.
+
+    An operator can fly a drone if their license matches the drone's class and,
+    for rescue drones, they hold a rescue endorsement. Each operator gets at
+    most one drone. """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def plan(self):
+        """ Loads the idle drones and free operators and computes a maximum matching. """
+        drones, operators = self._load()
+
+        # group the operators by license and endorsement, and the drones by class
+        endorsed = {}
+        unendorsed = {}
+        for operator in operators:
+            group = endorsed if operator.rescue_endorsement else unendorsed
+            group.setdefault(operator.drone_license, []).append(operator)
+        classes = {}
+        for drone in drones:
+            classes.setdefault(drone.class_type, ([], []))[1 if drone.rescue else 0].append(drone)
+
+        # Only the class and the rescue flag decide who can fly a drone, so within
+        # a class a matching is maximum if rescue drones take endorsed operators
+        # first and the other drones take unendorsed operators before endorsed ones.
+        plan = AllocationPlan()
+        for class_type, (standard, rescue) in classes.items():
+            with_endorsement = endorsed.get(class_type, [])
+            without_endorsement = unendorsed.get(class_type, [])
+            any_endorsed = with_endorsement != []
+            licensed = len(with_endorsement) + len(without_endorsement)
+
+            # the operators were loaded in descending ID order, so pop() hands
+            # out the operators with the lowest IDs first
+            for drone in rescue:
+                if with_endorsement != []:
+                    plan.add_assignment(drone, with_endorsement.pop())
+                elif licensed == 0:
+                    plan.add_unmatched(drone, f'No free operator has a class {class_type} license')
+                elif not any_endorsed:
+                    plan.add_unmatched(
+                        drone, f'No free operator with a class {class_type} license has a rescue endorsement')
+                else:
+                    plan.add_unmatched(drone, 'All the eligible operators have been allocated a drone')
+
+            for drone in standard:
+                if without_endorsement != []:
+                    plan.add_assignment(drone, without_endorsement.pop())
+                elif with_endorsement != []:
+                    plan.add_assignment(drone, with_endorsement.pop())
+                elif licensed == 0:
+                    plan.add_unmatched(drone, f'No free operator has a class {class_type} license')
+                else:
+                    plan.add_unmatched(drone, 'All the eligible operators have been allocated a drone')
+        return plan
+
+    def commit(self, plan):
+        """ Writes all the assignments of a plan in one transaction.
+
+        The updates only apply to drones and operators that are still free, so
+        if any of them was allocated since the plan was made nothing is written. """
+        if plan.assignments == []:
+            return
+        drone_rows = [(operator.id, drone.id) for drone, operator in plan.assignments]
+        operator_rows = [(drone.id, operator.id) for drone, operator in plan.assignments]
+        drone_changes = [('DroneStore', drone.id, 'update') for drone, operator in plan.assignments]
+        changes = drone_changes + [('OperatorStore', operator.id, 'update') for drone, operator in plan.assignments]
+        with self._factory.connection() as conn:
+            # only the drones change summary key, from unallocated to allocated
+            before = self._factory.lock_keys(conn, drone_changes)
+            after = dict((row, key[:-1] + (1,)) for row, key in before.items())
+            cursor = self._factory.cursor(conn)
+            cursor.executemany('UPDATE DroneStore SET OperatorID = %s WHERE ID = %s AND OperatorID IS NULL', drone_rows)
+            updated = cursor.rowcount
+            cursor.executemany('UPDATE OperatorStore SET DroneID = %s WHERE ID = %s AND DroneID IS NULL', operator_rows)
+            updated += cursor.rowcount
+            cursor.close()
+            if updated != 2 * len(plan.assignments):
+                raise Exception('The fleet changed during the allocation, nothing was allocated')
+            self._factory.log_changes(conn, changes, before, after)
+
+        drone_cache = self._factory.cache('DroneStore')
+        operator_cache = self._factory.cache('OperatorStore')
+        for drone, operator in plan.assignments:
+            drone.operator = operator.id
+            operator.drone = drone.id
+            drone_cache.invalidate(drone.id)
+            operator_cache.invalidate(operator.id)
+
+    def run(self):
+        """ Plans and commits a batch allocation, returning the plan. """
+        plan = self.plan()
+        self.commit(plan)
+        return plan
+
+    def _load(self):
+        """ Loads the unallocated drones and the operators without a drone. """
+        with self._factory.connection() as conn:
+            cursor = self._factory.cursor(conn)
+            cursor.execute('SELECT ID, Name, ClassType, Rescue, OperatorID FROM DroneStore '
+                           'WHERE OperatorID IS NULL ORDER BY ID')
+            drones = [Drone(*record) for record in cursor.fetchall()]
+            cursor.execute('SELECT OperatorStore.* FROM OperatorStore '
+                           'LEFT JOIN DroneStore ON DroneStore.OperatorID = OperatorStore.ID '
+                           'WHERE OperatorStore.DroneID IS NULL AND DroneStore.ID IS NULL '
+                           'ORDER BY OperatorStore.ID DESC')
+            operators = [Operator(*record) for record in cursor.fetchall()]
+            cursor.close()
+        return drones, operators
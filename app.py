@@ -1,22 +1,166 @@
-import mysql.connector
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import sys
 import tkinter as tk
+import tkinter.filedialog as filedialog
 import tkinter.ttk as ttk
 
+from database import DEFAULT_POOL_SIZE, MySQLConnectionFactory, SQLiteConnectionFactory
 from drones import Drone, DroneStore
+from migrations import migrate
 from operators import Operator, OperatorStore
+from replica import sort_key
+from summary import read_summary, summary_lines
+
+
+def stable_rows(positions):
+    """ Returns the indexes of a longest increasing run of positions (not necessarily
+    contiguous). Those rows keep their relative order, so only the others move. """
+    tails = []
+    tail_indexes = []
+    previous = [None] * len(positions)
+    for index, position in enumerate(positions):
+        i = bisect_left(tails, position)
+        if i > 0:
+            previous[index] = tail_indexes[i - 1]
+        if i == len(tails):
+            tails.append(position)
+            tail_indexes.append(index)
+        else:
+            tails[i] = position
+            tail_indexes[i] = index
+
+    stable = set()
+    index = tail_indexes[-1] if tail_indexes else None
+    while index is not None:
+        stable.add(index)
+        index = previous[index]
+    return stable
+
+
+class BackgroundTask(object):
+    """ A call waiting to run, or running, on a BackgroundTasks thread. """
+
+    def __init__(self, func, callback=None, errback=None):
+        self.func = func
+        self.callback = callback
+        self.errback = errback
+        self.cancelled = False
+
+
+class BackgroundTasks(object):
+    """ Runs the store calls of the GUI on a thread pool, so Tk stays responsive.
+
+    The results are put on a queue, which the Tk thread polls with after()
+    every POLL_INTERVAL milliseconds, and the callbacks run on the Tk thread.
+    Tasks submitted with a key replace each other: while a task with the key
+    is running, only the latest one submitted waits to run after it, and the
+    result of the running task is dropped. Tk widgets must only be used in
+    the callbacks, never in the background calls. If stats (a QueryStats) is
+    given, tasks submitted with a name are timed as commands. """
+
+    POLL_INTERVAL = 50
+
+    def __init__(self, root, max_workers=DEFAULT_POOL_SIZE, stats=None):
+        self._root = root
+        self._stats = stats
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix='dalsys')
+        self._results = queue.Queue()
+        self._running = {}
+        self._waiting = {}
+        self._root.after(self.POLL_INTERVAL, self._poll)
+
+    def submit(self, func, callback=None, errback=None, key=None, name=None):
+        """ Runs func() in the background, then calls callback with its result, or
+        errback with the exception it raised, on the Tk thread. Exceptions go to
+        Tk's report_callback_exception if there is no errback. """
+        if self._stats is not None and name is not None:
+            func = self._timed(name, func)
+        task = BackgroundTask(func, callback, errback)
+        if key is not None and key in self._running:
+            # coalesce with the running task, which is now stale
+            self._waiting[key] = task
+        else:
+            self._start(key, task)
+        return task
+
+    def cancel(self, key):
+        """ Drops the tasks submitted with key, so their callbacks are never called. """
+        self._waiting.pop(key, None)
+        task = self._running.get(key)
+        if task is not None:
+            task.cancelled = True
+
+    def busy(self, key):
+        """ Returns True if a task submitted with key has not finished yet. """
+        return key in self._running
+
+    def shutdown(self):
+        """ Stops the threads once the running tasks finish, dropping the others. """
+        self._waiting.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _timed(self, name, func):
+        """ Returns a function that calls func as the command name. """
+        def timed():
+            with self._stats.command(name):
+                return func()
+        return timed
+
+    def _start(self, key, task):
+        """ Hands a task to the thread pool. """
+        if key is not None:
+            self._running[key] = task
+        future = self._executor.submit(task.func)
+        future.add_done_callback(lambda future: self._results.put((key, task, future)))
+
+    def _poll(self):
+        """ Delivers the finished tasks to their callbacks. """
+        # schedule the next poll first, as a callback may open a modal window
+        # that runs a nested event loop
+        self._root.after(self.POLL_INTERVAL, self._poll)
+        while True:
+            try:
+                key, task, future = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if key is not None:
+                waiting = self._waiting.pop(key, None)
+                if waiting is not None:
+                    self._start(key, waiting)
+                    continue
+                del self._running[key]
+            if task.cancelled or future.cancelled():
+                continue
+
+            error = future.exception()
+            if error is None:
+                if task.callback is not None:
+                    task.callback(future.result())
+            elif task.errback is not None:
+                task.errback(error)
+            else:
+                self._root.report_callback_exception(type(error), error, error.__traceback__)
 
 
 class Application(object):
-    """ Main application view - displays the menu. """
+    """ Main application view - displays the menu, and a summary of the fleet that is
+    read again every SUMMARY_INTERVAL milliseconds. """
+
+    SUMMARY_INTERVAL = 5000
 
-    def __init__(self, conn):
+    def __init__(self, factory):
         # Initialise the stores
-        self.drones = DroneStore(conn)
-        self.operators = OperatorStore(conn)
+        self.drones = DroneStore(factory)
+        self.operators = OperatorStore(factory)
+        self._factory = factory
 
         # Initialise the GUI window
         self.root = tk.Tk()
         self.root.title('Drone Allocation and Localisation')
+        self.stats = factory.stats
+        self.tasks = BackgroundTasks(self.root, stats=self.stats)
         frame = tk.Frame(self.root)
         frame.pack(padx=10, pady=10)
 
@@ -27,13 +171,46 @@ class Application(object):
         operator_button = tk.Button(
             frame, text="View Operators", command=self.view_operators, width=40, padx=5, pady=5)
         operator_button.pack(side=tk.TOP)
+        if self.stats is not None:
+            stats_button = tk.Button(
+                frame, text="Export Query Statistics", command=self.export_stats, width=40, padx=5, pady=5)
+            stats_button.pack(side=tk.TOP)
         exit_button = tk.Button(frame, text="Exit System",
                                 command=quit, width=40, padx=5, pady=5)
         exit_button.pack(side=tk.TOP)
 
+        # Add the fleet summary
+        summary_frame = tk.LabelFrame(frame, text='Fleet Summary', padx=5, pady=5)
+        summary_frame.pack(side=tk.TOP, fill=tk.X, pady=(10, 0))
+        self.summary = tk.Label(summary_frame, text='Loading...', justify=tk.LEFT, anchor=tk.W, font='TkFixedFont')
+        self.summary.pack(side=tk.TOP, fill=tk.X)
+        self.refresh_summary()
+
     def main_loop(self):
         """ Main execution loop - start Tkinter. """
         self.root.mainloop()
+        self.tasks.shutdown()
+
+    def refresh_summary(self):
+        """ Reads the fleet summary in the background, and schedules the next read. """
+        self.root.after(self.SUMMARY_INTERVAL, self.refresh_summary)
+        self.tasks.submit(lambda: read_summary(self._factory), self._show_summary, self._summary_failed,
+                          key='summary', name='read_summary')
+
+    def _show_summary(self, report):
+        """ Shows the counts of the fleet summary. """
+        self.summary['text'] = '\n'.join(summary_lines(report))
+
+    def _summary_failed(self, error):
+        """ Reports a summary that could not be read. """
+        self.summary['text'] = f'Error: {error}'
+
+    def export_stats(self):
+        """ Saves the query statistics to a JSON file. """
+        path = filedialog.asksaveasfilename(
+            parent=self.root, defaultextension='.json', filetypes=[('JSON', '*.json')])
+        if path:
+            self.stats.dump(path)
 
     def view_operators(self):
         """ Display the operators. """
@@ -49,12 +226,41 @@ class Application(object):
 
 
 class ListWindow(object):
-    """ Base list window. """
+    """ Base list window.
+
+    Rows are loaded a page at a time: the list starts with the first page and
+    fetches the next one when the view scrolls to within PREFETCH_MARGIN (a
+    fraction of the list) of the last loaded row. Pages are fetched in the
+    background while the window shows that it is loading; a refresh drops
+    any page or refresh still being fetched.
+
+    The window maps the id of each row (its first value) to its Treeview
+    item. A refresh fetches the rows loaded so far again and only inserts,
+    changes, moves and deletes the items that differ, so the scroll position
+    and the selection are kept.
+
+    Every CHANGES_INTERVAL milliseconds the window asks the change log for the
+    rows changed since the version it shows (see fetch_changes). Changed rows
+    that keep their place are updated and deleted rows removed, so a quiet
+    fleet costs one small query per poll; only new or reordered rows fall
+    back to a refresh.
+
+    Typing in the search box filters the list to the best SEARCH_LIMIT name
+    matches (see fetch_search). The search waits until no key has been typed
+    for SEARCH_DELAY milliseconds, and a newer search drops an older one
+    still being fetched. """
+
+    PAGE_SIZE = 100
+    PREFETCH_MARGIN = 0.2
+    CHANGES_INTERVAL = 2000
+    SEARCH_DELAY = 300
+    SEARCH_LIMIT = 50
 
     def __init__(self, parent, title):
         # Add a variable to hold the stores
         self.drones = parent.drones
         self.operators = parent.operators
+        self.tasks = parent.tasks
 
         # Initialise the new top-level window (modal dialog)
         self._parent = parent.root
@@ -62,6 +268,9 @@ class ListWindow(object):
         self.root.title(title)
         self.root.transient(parent.root)
         self.root.grab_set()
+        self.root.protocol('WM_DELETE_WINDOW', self.close)
+        # set by close, after which the callbacks must not touch the widgets
+        self.closed = False
 
         # Initialise the top level frame
         self.frame = tk.Frame(self.root)
@@ -78,21 +287,257 @@ class ListWindow(object):
                             command=self.tree.yview)
         xsb = ttk.Scrollbar(self.frame, orient=tk.HORIZONTAL,
                             command=self.tree.xview)
-        self.tree['yscroll'] = ysb.set
+        self._ysb = ysb
+        self.tree['yscroll'] = self._on_scroll
         self.tree['xscroll'] = xsb.set
         self.tree.bind("<Double-1>", edit_action)
+        self.status = tk.Label(self.frame, anchor=tk.W)
+        self.search = tk.Entry(self.frame, width=30)
+        self.search.bind('<KeyRelease>', self._search_changed)
+        self._search_after = None
+        self._more_after = None
+        self._search_text = ''
+        self._items = {}
+        self._values = {}
+        self._keys = {}
+        self._order = []
+        self._version = None
+        self._changes_after = self.root.after(self.CHANGES_INTERVAL, self.poll_changes)
+        self._next_key = None
+        self._exhausted = True
+        self._loading = False
 
         # Add tree and scrollbars to frame
         self.tree.grid(in_=self.frame, row=0, column=0, sticky=tk.NSEW)
         ysb.grid(in_=self.frame, row=0, column=1, sticky=tk.NS)
         xsb.grid(in_=self.frame, row=1, column=0, sticky=tk.EW)
+        self.status.grid(in_=self.frame, row=3, column=0, sticky=tk.W)
+        self.search.grid(in_=self.frame, row=2, column=0, sticky=tk.W)
 
         # Set frame resize priorities
         self.frame.rowconfigure(0, weight=1)
         self.frame.columnconfigure(0, weight=1)
 
+    def populate_data(self):
+        """ Populates the data in the view from the first row, fetching as many rows
+        as are loaded already (at least a page). The rows shown are kept until
+        the new rows have been fetched. """
+        self._loading = True
+        self._set_busy(True)
+        limit = max(self.PAGE_SIZE, len(self._order))
+        text = self._search_text
+
+        def fetch():
+            # the version is read first, so no change after it can be missed
+            version = self.fetch_changes(None)[0]
+            if text != '':
+                return version, self.fetch_search(text, self.SEARCH_LIMIT)
+            return version, self.fetch_page(None, limit)
+
+        def show(result):
+            self._show_rows(result[1], limit, result[0])
+            if text != '':
+                # the matches are all there is, so there is nothing to page in
+                self._exhausted = True
+        self.tasks.submit(fetch, show, self._load_failed, key=self,
+                          name='search' if text != '' else 'populate_data')
+
+    def _search_changed(self, event):
+        """ Filters the list by the search box once typing pauses. """
+        if self._search_after is not None:
+            self.root.after_cancel(self._search_after)
+        self._search_after = self.root.after(self.SEARCH_DELAY, self._run_search)
+
+    def _run_search(self):
+        """ Shows the rows matching the search box, or all the rows if it is empty. """
+        self._search_after = None
+        text = self.search.get().strip()
+        if text != self._search_text:
+            self._search_text = text
+            self.populate_data()
+
+    def poll_changes(self):
+        """ Applies the rows changed since the version shown, and polls again later. """
+        self._changes_after = self.root.after(self.CHANGES_INTERVAL, self.poll_changes)
+        self.refresh_changes()
+
+    def refresh_changes(self):
+        """ Fetches and applies the rows changed since the version shown. """
+        if self._version is None or self._loading:
+            return
+        version = self._version
+        self.tasks.submit(lambda: self.fetch_changes(version), self._apply_changes, self._load_failed,
+                          key=(self, 'changes'), name='fetch_changes')
+
+    def _apply_changes(self, result):
+        """ Changes the view to show the changed rows. """
+        version, rows, removed = result
+        if self._loading or self._version is None or version < self._version:
+            return
+        self._version = version
+        removed = [id for id in removed if id in self._items]
+        if removed != []:
+            self.tree.delete(*[self._items.pop(id) for id in removed])
+            for id in removed:
+                del self._values[id]
+                del self._keys[id]
+            gone = set(removed)
+            self._order = [id for id in self._order if id not in gone]
+
+        for key, values in rows:
+            id = values[0]
+            if id not in self._items:
+                if self._search_text != '':
+                    # only the rows of the search results are shown
+                    continue
+                if not self._exhausted and sort_key(*key) > sort_key(*self._next_key):
+                    # the row is on a page that has not been loaded yet
+                    continue
+            if self._keys.get(id) != key:
+                # a new row, or a row that moved: only a refresh knows where it goes
+                self.populate_data()
+                return
+            if self._values[id] != values:
+                self.tree.item(self._items[id], values = values)
+                self._values[id] = values
+
+    def load_more(self):
+        """ Appends the next page of rows to the view. """
+        self._more_after = None
+        if self._exhausted:
+            self._loading = False
+            return
+        after = self._next_key
+        self._set_busy(True)
+        self.tasks.submit(lambda: self.fetch_page(after, self.PAGE_SIZE),
+                          self._show_page, self._load_failed, key=self, name='load_more')
+
+    def _show_rows(self, rows, limit, version=None):
+        """ Changes the view to show the rows fetched by a refresh at version. """
+        self._version = version
+        ids = [values[0] for key, values in rows]
+        new_ids = set(ids)
+        removed = [id for id in self._order if id not in new_ids]
+        if removed != []:
+            self.tree.delete(*[self._items.pop(id) for id in removed])
+            for id in removed:
+                del self._values[id]
+                del self._keys[id]
+
+        # detach the kept rows that are out of order, so that the rows before
+        # each position are in place when it is reached
+        kept = [id for id in ids if id in self._items]
+        positions = dict((id, index) for index, id in enumerate(self._order))
+        stable = stable_rows([positions[id] for id in kept])
+        moved = set(id for index, id in enumerate(kept) if index not in stable)
+        if moved:
+            self.tree.detach(*[self._items[id] for id in moved])
+
+        for index, (key, values) in enumerate(rows):
+            id = values[0]
+            item = self._items.get(id)
+            if item is None:
+                self._items[id] = self.tree.insert('', index, values = values)
+            else:
+                if id in moved:
+                    self.tree.move(item, '', index)
+                if self._values[id] != values:
+                    self.tree.item(item, values = values)
+            self._values[id] = values
+            self._keys[id] = key
+        self._order = ids
+        self._page_loaded(rows, limit)
+
+    def _show_page(self, rows):
+        """ Appends a fetched page of rows to the view. """
+        for key, values in rows:
+            id = values[0]
+            if id in self._items:
+                continue
+            self._items[id] = self.tree.insert('', 'end', values = values)
+            self._values[id] = values
+            self._keys[id] = key
+            self._order.append(id)
+        self._page_loaded(rows, self.PAGE_SIZE)
+
+    def _page_loaded(self, rows, limit):
+        """ Records where the next page starts. """
+        if len(rows) < limit:
+            self._exhausted = True
+        else:
+            self._exhausted = False
+            self._next_key = rows[-1][0]
+        self._loading = False
+        self._set_busy(False)
+
+    def _load_failed(self, error):
+        """ Reports a page that could not be fetched. """
+        self._loading = False
+        self._set_busy(False)
+        self.status['text'] = f'Error: {error}'
+
+    def _set_busy(self, busy):
+        """ Shows whether rows are being loaded. """
+        self.status['text'] = 'Loading...' if busy else ''
+        self.tree['cursor'] = 'watch' if busy else ''
+
+    def run(self, func, callback=None, name=None):
+        """ Runs a store call in the background, then calls callback with its result.
+        Errors are shown in the status line. These calls are never dropped, but
+        once the window is closed callback is not called, and errors go to Tk's
+        report_callback_exception instead. """
+        self.status['text'] = 'Working...'
+
+        def done(result):
+            if self.closed:
+                return
+            self.status['text'] = ''
+            if callback is not None:
+                callback(result)
+
+        def failed(error):
+            if self.closed:
+                self._parent.report_callback_exception(type(error), error, error.__traceback__)
+                return
+            self.status['text'] = f'Error: {error}'
+        self.tasks.submit(func, done, failed, name=name)
+
+    def fetch_page(self, after, limit):
+        """ Fetches the page of rows following the key after - this needs to be overriden
+        in inherited classes. This function should return a list of (key, values) pairs, where
+        key is the keyset position of the row and values are the column values. """
+        return []
+
+    def fetch_search(self, text, limit):
+        """ Fetches up to limit rows whose names best match text - this needs to be overriden
+        in inherited classes. This function should return (key, values) pairs like fetch_page,
+        best match first. """
+        return []
+
+    def fetch_changes(self, version):
+        """ Fetches the rows changed after version - this needs to be overriden in inherited
+        classes. This function should return (latest version, rows, removed ids), where rows
+        are (key, values) pairs like fetch_page returns; with version None, only the
+        latest version. """
+        return 0, [], []
+
+    def _on_scroll(self, first, last):
+        """ Updates the scrollbar and fetches the next page when nearing the end of the list. """
+        self._ysb.set(first, last)
+        if not self._exhausted and not self._loading and float(last) >= 1 - self.PREFETCH_MARGIN:
+            self._loading = True
+            self._more_after = self.root.after_idle(self.load_more)
+
     def close(self):
         """ Closes the list window. """
+        self.closed = True
+        self.root.after_cancel(self._changes_after)
+        if self._search_after is not None:
+            self.root.after_cancel(self._search_after)
+        if self._more_after is not None:
+            self.root.after_cancel(self._more_after)
+        self.tasks.cancel(self)
+        self.tasks.cancel((self, 'changes'))
         self.root.destroy()
 
 
@@ -115,12 +560,25 @@ class DroneListWindow(ListWindow):
                                 command=self.close, width=20, padx=5, pady=5)
         exit_button.grid(in_=self.frame, row=3, column=0, sticky=tk.E)
 
-    def populate_data(self):
-        """ Populates the data in the view. """
-        self.tree.delete(*self.tree.get_children())
-        for drone in self.drones.list_all():  
-            values = (drone.id, drone.name, drone.class_type, drone.rescue, drone.operator)
-            self.tree.insert('', 'end', values = values)
+    def fetch_page(self, after, limit):
+        """ Fetches a page of drones with their operator names. """
+        return [self.row(drone, operator) for drone, operator in self.drones.page(after, limit)]
+
+    def fetch_search(self, text, limit):
+        """ Fetches the drones whose names best match text. """
+        return [self.row(drone, operator) for drone, operator in self.drones.search(text, limit)]
+
+    def fetch_changes(self, version):
+        """ Fetches the drones changed after version. """
+        version, changed, removed = self.drones.changes_since(version)
+        return version, [self.row(drone, operator) for drone, operator in changed], removed
+
+    def row(self, drone, operator):
+        """ Returns the (key, values) row of a drone and its operator name. """
+        if operator is None:
+            operator = '<None>'
+        values = (drone.id, drone.name, drone.class_type, drone.rescue, operator)
+        return (drone.name, drone.id), values
 
     def add_drone(self):
         """ Starts a new drone and displays it in the list. """
@@ -138,8 +596,7 @@ class DroneListWindow(ListWindow):
 
     def _save_new_drone(self, drone):
         """ Saves the drone in the store and updates the list. """
-        self.drones.add(drone)
-        self.populate_data()
+        self.run(lambda: self.drones.add(drone), lambda result: self.refresh_changes(), 'add_drone')
 
     def edit_drone(self, event):
         """ Retrieves the drone and shows it in the editor. """
@@ -147,15 +604,13 @@ class DroneListWindow(ListWindow):
         item = self.tree.item(self.tree.focus())
         item_id = item['values'][0]
 
-        # Load the drone from the store
-        drone = self.drones.get(item_id)
-        # Display the drone
-        self.view_drone(drone, self._update_drone)
+        # Load the drone from the store, then display it
+        self.run(lambda: self.drones.get(item_id),
+                 lambda drone: self.view_drone(drone, self._update_drone), 'edit_drone')
 
     def _update_drone(self, drone):
         """ Saves the new details of the drone. """
-        self.drones.update(drone)
-        self.populate_data()
+        self.run(lambda: self.drones.update(drone), lambda result: self.refresh_changes(), 'update_drone')
 
     def view_drone(self, drone, save_action):
         """ Displays the drone editor. """
@@ -171,6 +626,8 @@ class OperatorListWindow(ListWindow):
         # Add the list and fill it with data
         columns = ('id', 'name', 'class', 'rescue', 'operations', 'drone')
         self.add_list(columns, self.edit_operator)
+        #Hide ID column
+        self.tree["displaycolumns"] = ("name", "class", "rescue", "operations", "drone")
         self.populate_data()
 
         # Add the command buttons
@@ -181,36 +638,44 @@ class OperatorListWindow(ListWindow):
                                 command=self.close, width=20, padx=5, pady=5)
         exit_button.grid(in_=self.frame, row=3, column=0, sticky=tk.E)
 
-    def populate_data(self):
-        """ Populates the data in the view. """
-        self.tree.delete(*self.tree.get_children())
-        for operator in self.operators.list_all():  
-            #Get drone assigned to operator
-            for drone in self.drones.list_all():
-                if drone.operator != None:
-                    if drone.operator == operator.id:
-                        #Get drone name to display in window
-                        drone_operator = str(drone.id) +": " + drone.name
-                        if drone.class_type == 1:
-                            class_type = "One"
-                        elif drone.class_type == 2:
-                            class_type = "Two"
-                else:
-                    drone_operator = "<None>"
-                    class_type = "One"
-                    
-            if operator.rescue_endorsement == 1:
-                rescue_endorsement = "Yes"
-            elif operator.rescue_endorsement == 0:
-                rescue_endorsement = "No"
-                
-                
-            name = operator.first_name + " " + operator.family_name
-            values = (operator.id, name, class_type, rescue_endorsement, operator.operations, drone_operator)
-            self.tree.insert('', 'end', values = values)
+    def fetch_page(self, after, limit):
+        """ Fetches a page of operators with their assigned drones. """
+        return [self.row(operator, drone) for operator, drone in self.operators.page(after, limit)]
+
+    def fetch_search(self, text, limit):
+        """ Fetches the operators whose names best match text. """
+        return [self.row(operator, drone) for operator, drone in self.operators.search(text, limit)]
+
+    def fetch_changes(self, version):
+        """ Fetches the operators changed after version. """
+        version, changed, removed = self.operators.changes_since(version)
+        return version, [self.row(operator, drone) for operator, drone in changed], removed
+
+    def row(self, operator, drone):
+        """ Returns the (key, values) row of an operator and their drone. """
+        #Get drone name to display in window
+        if drone is None:
+            drone_operator = "<None>"
+            class_type = "<None>"
+        else:
+            drone_id, drone_name, drone_class = drone
+            drone_operator = str(drone_id) + ": " + drone_name
+            if drone_class == 1:
+                class_type = "One"
+            elif drone_class == 2:
+                class_type = "Two"
+            else:
+                class_type = str(drone_class)
+
+        if operator.rescue_endorsement == 1:
+            rescue_endorsement = "Yes"
+        elif operator.rescue_endorsement == 0:
+            rescue_endorsement = "No"
+            
             
-            #Hide ID column
-            self.tree["displaycolumns"] = ("name", "class", "rescue", "operations", "drone")
+        name = operator.first_name + " " + operator.family_name
+        values = (operator.id, name, class_type, rescue_endorsement, operator.operations, drone_operator)
+        return (operator.family_name, operator.id), values
 
     def add_operator(self):
         """ Starts a new operator and displays it in the list. """
@@ -227,8 +692,7 @@ class OperatorListWindow(ListWindow):
 
     def _save_new_operator(self, operator):
         """ Saves the operator in the store and updates the list. """
-        self.operators._add(operator)
-        self.populate_data()
+        self.run(lambda: self.operators._add(operator), lambda result: self.refresh_changes(), 'add_operator')
 
     def edit_operator(self, event):
         """ Retrieves the operator and shows it in the editor. """
@@ -236,14 +700,13 @@ class OperatorListWindow(ListWindow):
         item = self.tree.item(self.tree.focus())
         item_id = item['values'][0]
 
-        # Load the operator from the store
-        operator = self.operators.get(item_id)
-        self.view_operator(operator, self._update_operator)
+        # Load the operator from the store, then display it
+        self.run(lambda: self.operators.get(item_id),
+                 lambda operator: self.view_operator(operator, self._update_operator), 'edit_operator')
 
     def _update_operator(self, operator):
         """ Saves the new details of the operator. """
-        self.operators.update(operator)
-        self.populate_data()
+        self.run(lambda: self.operators.update(operator), lambda result: self.refresh_changes(), 'update_operator')
 
     def view_operator(self, operator, save_action):
         """ Displays the operator editor. """
@@ -464,7 +927,7 @@ class DroneEditorWindow(EditorWindow):
             self.rescue.insert(0, self._drone.rescue)
         else:
             #Set default value
-            self._drone.resuce = 0
+            self._drone.rescue = 0
             self.rescue.insert(0, "No")
         
         #return row number of last row added
@@ -485,13 +948,24 @@ class DroneEditorWindow(EditorWindow):
 
 
 if __name__ == '__main__':
-    conn = mysql.connector.connect(
-        user='',
-        password='',        
-        host='',   
-        database='',       
-        charset='utf8',
-        use_pure = True )
-    app = Application(conn)
+    # python app.py [database] [-replica] [-stats]
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+    if len(paths) > 0:
+        # use the embedded SQLite database at the given path
+        factory = SQLiteConnectionFactory(paths[0])
+    else:
+        factory = MySQLConnectionFactory(
+            user='',
+            password='',        
+            host='',   
+            database='',       
+            charset='utf8')
+    if '-stats' in sys.argv[1:]:
+        # time every statement, for the statistics export
+        factory.instrument()
+    migrate(factory)
+    if '-replica' in sys.argv[1:]:
+        # answer the reads from an in-memory copy of the fleet
+        factory.replicate()
+    app = Application(factory)
     app.main_loop()
-    conn.close()
@@ -0,0 +1,267 @@
+""" Benchmarks for the stores on a synthetic fleet.
+
+Usage:
+    python benchmark.py [-sizes=1000,100000,1000000] [-repeat=5] [-output=path]
+                        [-baseline=path] [-save-baseline] [-tolerance=0.25] [-keep=dir]
+
+Every fleet size is generated in a new SQLite database, then the store
+operations are timed on it. The results are written as JSON, and compared
+with a baseline written by an earlier run with -save-baseline. The script
+exits with status 1 if the fastest run of any benchmark is slower than in
+the baseline by more than the tolerance. """
+
+import argparse
+import contextlib
+from datetime import date
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+from allocation import AllocationEngine
+import compliance
+from database import SQLiteConnectionFactory, iter_chunks
+from drones import Drone, DroneStore
+from migrations import migrate
+from operators import Operator, OperatorStore
+import summary
+
+# Fraction of the drones that are allocated to an operator
+DEFAULT_ALLOCATED_RATIO = 0.6
+
+# Fraction of the drones that are rescue drones
+DEFAULT_RESCUE_RATIO = 0.2
+
+# Fraction of the operators that hold a rescue endorsement
+DEFAULT_ENDORSED_RATIO = 0.3
+
+# Number of operations timed by each run of the get, allocate and remove benchmarks
+OPERATIONS_PER_RUN = 100
+
+FIRST_NAMES = ['John', 'Jane', 'Josh', 'Jake', 'Mia', 'Liam', 'Ava', 'Noah', 'Zoe', 'Omar', 'Yuki', 'Ana']
+LAST_NAMES = ['Doe', 'Smith', 'Brown', 'Wilson', 'Taylor', 'Ngata', 'Chen', 'Patel', 'Kim', 'Silva']
+DRONE_NAMES = ['Falcon', 'Kea', 'Tui', 'Hawk', 'Kestrel', 'Osprey', 'Swift', 'Heron', 'Kite', 'Raven']
+
+
+def generate_fleet(factory, size, allocated_ratio=DEFAULT_ALLOCATED_RATIO, rescue_ratio=DEFAULT_RESCUE_RATIO,
+                   endorsed_ratio=DEFAULT_ENDORSED_RATIO, seed=0):
+    """ Adds size drones and size operators to the database, and allocates
+    allocated_ratio of the drones to operators that are allowed to fly them. """
+    rng = random.Random(seed)
+    allocated = int(size * allocated_ratio)
+
+    operators = []
+    for i in range(size):
+        # the first operators fly the allocated drones, so they get the
+        # license and endorsement of their drone below
+        born = date(rng.randint(1950, 2000), rng.randint(1, 12), rng.randint(1, 28))
+        operations = rng.randint(0, 20)
+        operators.append(Operator(None, rng.choice(FIRST_NAMES), f'{rng.choice(LAST_NAMES)}{i}', born,
+                                  rng.randint(1, 2), operations >= 5 and rng.random() < endorsed_ratio, operations))
+    drones = []
+    for i in range(size):
+        rescue = 1 if rng.random() < rescue_ratio else 0
+        drones.append(Drone(None, f'{rng.choice(DRONE_NAMES)}-{rng.randrange(size * 10)}', rng.randint(1, 2), rescue, None))
+    for drone, operator in zip(drones[:allocated], operators[:allocated]):
+        operator.drone_license = drone.class_type
+        if drone.rescue:
+            operator.rescue_endorsement = True
+            operator.operations = max(operator.operations, 5)
+
+    OperatorStore(factory).add_many(operators)
+    for drone, operator in zip(drones[:allocated], operators[:allocated]):
+        drone.operator = operator.id
+    DroneStore(factory).add_many(drones)
+
+    for chunk in iter_chunks(zip(drones[:allocated], operators[:allocated])):
+        with factory.connection() as conn:
+            cursor = factory.cursor(conn)
+            cursor.executemany('UPDATE OperatorStore SET DroneID = %s WHERE ID = %s',
+                               [(drone.id, operator.id) for drone, operator in chunk])
+            cursor.close()
+    factory.clear_caches()
+
+
+def consume(rows):
+    """ Reads all the rows of a generator. """
+    for row in rows:
+        pass
+
+
+def quietly(func, *args):
+    """ Calls func, discarding what it prints. """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args)
+
+
+def run_benchmarks(factory, size, repeat):
+    """ Times the store operations on a generated fleet, returning a dict of results by name. """
+    drones = DroneStore(factory)
+    operators = OperatorStore(factory)
+    rng = random.Random(size)
+    results = {}
+
+    def bench(name, func, operations=1, setup=None):
+        durations = []
+        for i in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            func()
+            durations.append((time.perf_counter() - start) * 1000)
+        results[name] = {
+            'size': size,
+            'runs': repeat,
+            'operations': operations,
+            'min_ms': min(durations),
+            'median_ms': statistics.median(durations),
+            'max_ms': max(durations),
+        }
+        print(f'{size: >9} {name: <40} {results[name]["median_ms"]: >12.3f} ms')
+
+    for class_type in ('all', 1, 2):
+        for rescue in ('all', 1):
+            bench(f'drones.list_all[class={class_type},rescue={rescue}]',
+                  lambda: consume(drones.list_all(class_type, rescue)))
+    bench('operators.list_all', lambda: consume(operators.list_all()))
+
+    ids = [rng.randint(1, size) for i in range(OPERATIONS_PER_RUN)]
+    bench('drones.get[cold]', lambda: [drones.get(id) for id in ids], OPERATIONS_PER_RUN, factory.clear_caches)
+    bench('drones.get[warm]', lambda: [drones.get(id) for id in ids], OPERATIONS_PER_RUN)
+
+    # Application.list prints the whole fleet
+    import main
+    application = main.Application(factory)
+    bench('Application.list', lambda: quietly(application.list, []))
+
+    # the rows of the GUI lists, without the Tk widgets
+    try:
+        import app
+    except ImportError:
+        app = None
+    if app is not None:
+        for window_class in (app.DroneListWindow, app.OperatorListWindow):
+            window = types.SimpleNamespace(drones=drones, operators=operators)
+            window.row = types.MethodType(window_class.row, window)
+            bench(f'{window_class.__name__}.fetch_page', lambda: window_class.fetch_page(
+                window, None, app.ListWindow.PAGE_SIZE))
+
+    # the same reads answered by the in-memory replica, loaded by its first read
+    factory.replicate()
+    consume(drones.list_all())
+    bench('replica.list_all[class=all,rescue=all]', lambda: consume(drones.list_all()))
+    bench('replica.list_all[class=2,rescue=1]', lambda: consume(drones.list_all(2, 1)))
+    bench('replica.drones.page', lambda: drones.page(None, app.ListWindow.PAGE_SIZE if app else 100))
+    bench('replica.operators.list_all', lambda: consume(operators.list_all()))
+    bench('replica.drones.get', lambda: [drones.get(id) for id in ids], OPERATIONS_PER_RUN)
+    factory.replica = None
+
+    # name searches, once the index has been loaded by a first search
+    drones.search('falcon')
+    bench('drones.search[prefix]', lambda: drones.search('kestrel-1'))
+    bench('drones.search[fuzzy]', lambda: drones.search('ospry-1234'))
+    bench('operators.search[fuzzy]', lambda: operators.search('jon smth'))
+
+    # the fleet summary, and the GROUP BY counts it saves
+    bench('summary.read_summary', lambda: summary.read_summary(factory))
+    bench('summary.check', lambda: summary.check(factory))
+
+    # the compliance rules over the whole fleet
+    bench('compliance.scan', lambda: consume(compliance.scan(factory)))
+
+    # the writes come last, as they change the fleet; the pairs are taken
+    # from an allocation plan, so allocate() does not prompt
+    plan = AllocationEngine(factory).plan()
+    pairs = iter(plan.assignments)
+    allocations = min(OPERATIONS_PER_RUN, len(plan.assignments) // repeat)
+    operators.find_by_name('', '')
+
+    def allocate_some():
+        for drone, operator in [next(pairs) for i in range(allocations)]:
+            quietly(drones.allocate, drone.id, [operator.first_name, operator.family_name])
+    if allocations > 0:
+        bench('drones.allocate', allocate_some, allocations)
+
+    removals = min(OPERATIONS_PER_RUN, size // repeat)
+    removable = iter(rng.sample(range(1, size + 1), removals * repeat))
+
+    def remove_some():
+        for i in range(removals):
+            drones.remove(next(removable))
+    if removals > 0:
+        bench('drones.remove', remove_some, removals)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Returns (name, baseline ms, ms) for the results slower than the baseline by more than tolerance.
+
+    The fastest runs are compared, as they are the least affected by other
+    work on the machine. """
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is not None and result['min_ms'] > expected['min_ms'] * (1 + tolerance):
+            regressions.append((name, expected['min_ms'], result['min_ms']))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks the stores on a synthetic fleet.')
+    parser.add_argument('-sizes', default='1000', help='comma separated fleet sizes')
+    parser.add_argument('-repeat', type=int, default=5, help='runs of every benchmark')
+    parser.add_argument('-output', default='benchmark.json', help='file the results are written to')
+    parser.add_argument('-baseline', default='benchmark-baseline.json', help='results to compare with')
+    parser.add_argument('-save-baseline', action='store_true', help='write the results as the baseline')
+    parser.add_argument('-tolerance', type=float, default=0.25, help='allowed slowdown, as a fraction')
+    parser.add_argument('-keep', default=None, help='directory to keep the generated databases in')
+    args = parser.parse_args(argv)
+
+    directory = args.keep or tempfile.mkdtemp(prefix='dalsys-benchmark-')
+    os.makedirs(directory, exist_ok=True)
+    results = {}
+    try:
+        for size in [int(size) for size in args.sizes.split(',')]:
+            path = os.path.join(directory, f'fleet-{size}.db')
+            if os.path.exists(path):
+                os.remove(path)
+            factory = SQLiteConnectionFactory(path)
+            migrate(factory)
+            start = time.perf_counter()
+            generate_fleet(factory, size)
+            print(f'{size: >9} {"generate_fleet": <40} {(time.perf_counter() - start) * 1000: >12.3f} ms')
+            for name, result in run_benchmarks(factory, size, args.repeat).items():
+                results[f'{size}/{name}'] = result
+    finally:
+        if args.keep is None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'\nBaseline written to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'\nNo baseline at {args.baseline}, run with -save-baseline to create one')
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance)
+    for name, expected, actual in regressions:
+        print(f'REGRESSION {name}: {expected:.3f} ms -> {actual:.3f} ms')
+    if regressions == []:
+        print(f'\nNo regressions against {args.baseline}')
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
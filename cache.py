@@ -0,0 +1,79 @@
+""" Entity caches for the stores. """
+
+from collections import OrderedDict
+import threading
+import time
+
+# Number of rows kept by an entity cache
+DEFAULT_CACHE_SIZE = 1000
+
+
+class LRUCache(object):
+    """ Bounded least-recently-used cache with an optional time to live.
+
+    Once the cache holds capacity entries, adding a new one evicts the least
+    recently used entry. Entries older than ttl seconds are treated as
+    missing. A capacity of 0 disables the cache. """
+
+    def __init__(self, capacity=DEFAULT_CACHE_SIZE, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value cached for key, or None if there is none. """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """ Caches value for key, evicting the least recently used entry if the cache is full. """
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """ Removes the entry for key, if there is one. """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes all the entries. """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the hit, miss and eviction counters and the current size. """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'capacity': self.capacity,
+            }
+
+
+def cache_key(id):
+    """ Converts an entity id to the key used in the caches, or None if it is not a valid id. """
+    try:
+        return int(id)
+    except (TypeError, ValueError):
+        return None
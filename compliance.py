@@ -0,0 +1,94 @@
+""" Whole-fleet compliance scan.
+
+DroneStore.allocate and OperatorStore.add only check their rules for the
+rows they write, and the user may override every failure. The scan checks
+the same rules for every drone and operator at once, with one set-based
+query per rule, so it costs a few table scans however many pairings break
+the rules. """
+
+from collections import OrderedDict
+from datetime import date
+
+from database import DEFAULT_BATCH_SIZE, iter_rows
+from drones import operator_name
+
+# Columns of a violation, in report order
+VIOLATION_FIELDS = ('rule', 'drone_id', 'drone', 'operator_id', 'operator', 'message')
+
+DRONE_OPERATOR = 'SELECT DroneStore.ID, DroneStore.Name, OperatorStore.ID, OperatorStore.FirstName, OperatorStore.LastName '
+
+# rule -> (message, query returning drone id, drone name, operator id, first name, last name)
+RULES = OrderedDict([
+    ('license', ('Operator does not have correct drone license',
+                 DRONE_OPERATOR + 'FROM DroneStore JOIN OperatorStore ON OperatorStore.ID = DroneStore.OperatorID '
+                 'WHERE OperatorStore.DroneLicense IS NULL OR OperatorStore.DroneLicense <> DroneStore.ClassType')),
+    ('endorsement', ('Operator does not have rescue endorsement',
+                     DRONE_OPERATOR + 'FROM DroneStore JOIN OperatorStore ON OperatorStore.ID = DroneStore.OperatorID '
+                     'WHERE DroneStore.Rescue = 1 AND COALESCE(OperatorStore.RescueEndorsement, 0) = 0')),
+    # DroneStore.OperatorID is unique, so an operator controls more than one
+    # drone when the two references of a pairing disagree
+    ('drone-link', ('Drone is allocated to an operator who controls another drone or none',
+                    'SELECT DroneStore.ID, DroneStore.Name, DroneStore.OperatorID, OperatorStore.FirstName, OperatorStore.LastName '
+                    'FROM DroneStore LEFT JOIN OperatorStore ON OperatorStore.ID = DroneStore.OperatorID '
+                    'WHERE DroneStore.OperatorID IS NOT NULL '
+                    'AND (OperatorStore.DroneID IS NULL OR OperatorStore.DroneID <> DroneStore.ID)')),
+    ('operator-link', ('Operator controls a drone that is not allocated to them',
+                       'SELECT OperatorStore.DroneID, DroneStore.Name, OperatorStore.ID, OperatorStore.FirstName, OperatorStore.LastName '
+                       'FROM OperatorStore LEFT JOIN DroneStore ON DroneStore.ID = OperatorStore.DroneID '
+                       'WHERE OperatorStore.DroneID IS NOT NULL '
+                       'AND (DroneStore.OperatorID IS NULL OR DroneStore.OperatorID <> OperatorStore.ID)')),
+    ('age', ('Operator should be at least twenty to hold a class 2 license',
+             DRONE_OPERATOR + 'FROM OperatorStore LEFT JOIN DroneStore ON DroneStore.OperatorID = OperatorStore.ID '
+             'WHERE OperatorStore.DroneLicense = 2 AND OperatorStore.DateOfBirth > %s')),
+    ('operations', ('To hold a rescue drone endorsement, the operator must have been involved in five prior rescue operations',
+                    DRONE_OPERATOR + 'FROM OperatorStore LEFT JOIN DroneStore ON DroneStore.OperatorID = OperatorStore.ID '
+                    'WHERE OperatorStore.RescueEndorsement = 1 AND COALESCE(OperatorStore.RescueOperations, 0) < 5')),
+])
+
+
+class Violation(object):
+    """ A drone or operator breaking a compliance rule. """
+    __slots__ = ('rule', 'drone_id', 'drone', 'operator_id', 'operator', 'message')
+
+    def __init__(self, rule, drone_id, drone, operator_id, operator, message):
+        self.rule = rule
+        self.drone_id = drone_id
+        self.drone = drone
+        self.operator_id = operator_id
+        self.operator = operator
+        self.message = message
+
+    def values(self):
+        """ Returns the fields of the violation as a dict in VIOLATION_FIELDS order. """
+        return OrderedDict((field, getattr(self, field)) for field in VIOLATION_FIELDS)
+
+
+def age_limit(today):
+    """ Returns the latest date of birth of someone at least twenty years old on today. """
+    try:
+        return today.replace(year=today.year - 20)
+    except ValueError:
+        # February 29 in a year twenty years later than a common year
+        return today.replace(year=today.year - 20, day=28)
+
+
+def scan(factory, rules=None, today=None, batch_size=DEFAULT_BATCH_SIZE):
+    """ Yields the violations of the given rules (all of them if None), rule by rule.
+
+    Every rule is one query over the whole fleet, and its rows are streamed,
+    so memory use does not grow with the number of violations. The age rule
+    is checked on today, the current date if None. """
+    if rules is None:
+        rules = list(RULES)
+    for rule in rules:
+        if rule not in RULES:
+            raise Exception(f'Unknown rule {rule}')
+    params = (age_limit(today or date.today()).isoformat(),)
+
+    with factory.connection() as conn:
+        for rule in rules:
+            message, query = RULES[rule]
+            cursor = factory.cursor(conn)
+            cursor.execute(query, params if '%s' in query else ())
+            for drone_id, drone, operator_id, first_name, last_name in iter_rows(cursor, batch_size):
+                yield Violation(rule, drone_id, drone, operator_id, operator_name(first_name, last_name), message)
@@ -0,0 +1,758 @@
+""" Database helpers shared by the stores.
+
+The stores talk to the database through a connection factory, which is the
+storage backend: MySQLConnectionFactory for the shared MySQL server and
+SQLiteConnectionFactory for an embedded, in-process SQLite database. Queries
+are always written in the MySQL %s parameter style. """
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import queue
+import re
+import sqlite3
+import threading
+import time
+
+from cache import DEFAULT_CACHE_SIZE, LRUCache
+from instrumentation import InstrumentedCursor, QueryStats
+from replica import DEFAULT_MAX_CHANGES, FleetReplica
+from summary import lock_keys, recount
+
+# Number of rows fetched per round trip when streaming query results
+DEFAULT_BATCH_SIZE = 500
+
+# Number of rows returned by one keyset page
+DEFAULT_PAGE_SIZE = 100
+
+# Number of connections kept open by a connection factory
+DEFAULT_POOL_SIZE = 5
+
+# Seconds between the checks of the change log for rows other clients changed,
+# which bounds how stale the entity caches can be
+DEFAULT_CACHE_INTERVAL = 1.0
+
+# Number of prepared statements a MySQL connection keeps open
+DEFAULT_STATEMENT_CACHE_SIZE = 100
+
+# Number of rows inserted and committed together by the bulk imports
+DEFAULT_CHUNK_SIZE = 1000
+
+# The schema from Item4.sql for SQLite, including the DroneID column of
+# OperatorStore that the stores rely on. DateOfBirth is nullable because
+# operators can be added without one.
+SQLITE_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS DroneStore(
+        ID integer primary key autoincrement,
+        Name varchar(100) not null,
+        ClassType int not null,
+        Rescue boolean,
+        OperatorID int unique,
+        foreign key(OperatorID) references OperatorStore(ID)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS OperatorStore(
+        ID integer primary key autoincrement,
+        FirstName varchar(100) not null,
+        LastName varchar(100),
+        DateOfBirth date,
+        DroneLicense tinyint,
+        RescueEndorsement boolean not null default 0,
+        RescueOperations int,
+        DroneID int
+    )''',
+    'CREATE INDEX IF NOT EXISTS DroneStoreName ON DroneStore(Name, ID)',
+    'CREATE INDEX IF NOT EXISTS OperatorStoreLastName ON OperatorStore(LastName, ID)',
+]
+
+
+class ConnectionFactory(object):
+    """ Base class for the storage backends, which hand out connections to the stores. """
+
+    def __init__(self):
+        self._shared = {}
+        self._shared_lock = threading.Lock()
+        self._local = threading.local()
+        self.cache_interval = DEFAULT_CACHE_INTERVAL
+        self._cache_version = None
+        self._cache_checked = None
+        self._cache_lock = threading.Lock()
+        self.stats = None
+        self.replica = None
+
+    def shared(self, name, create):
+        """ Returns the object shared under name by the stores using this factory,
+        calling create() to make it on first use.
+
+        create() runs outside the lock, as it may need a connection from a pool
+        whose holder is waiting for the lock. When two threads create the object
+        at once, the first to finish wins and the other's object is dropped. """
+        with self._shared_lock:
+            value = self._shared.get(name)
+        if value is not None:
+            return value
+        value = create()
+        with self._shared_lock:
+            return self._shared.setdefault(name, value)
+
+    def cache(self, table, capacity=DEFAULT_CACHE_SIZE, ttl=None):
+        """ Returns the entity cache for a table, creating it on first use.
+
+        Stores that share a factory share its caches, so a write made through
+        one store is seen by the others. The first store to ask for the cache
+        of a table sets its capacity and time to live. """
+        return self.shared('cache:' + table, lambda: LRUCache(capacity, ttl))
+
+    def sync_caches(self):
+        """ Drops the cached rows that were changed since the caches last checked the
+        change log, so the writes of other clients reach them.
+
+        The stores call this before reading their caches. The ChangeVersion
+        counter is checked at most every cache_interval seconds, so a cached
+        row is at most that stale, and a quiet database costs one small query
+        per interval. A version that went backwards empties the caches. Inside
+        a transaction the caches are not checked, as the replica is not. """
+        if self.current_work() is not None:
+            return
+        with self._cache_lock:
+            now = time.monotonic()
+            if self._cache_checked is not None and now - self._cache_checked < self.cache_interval:
+                return
+            version = self.current_version()
+            if self._cache_version is None or version < self._cache_version:
+                # rows cached before the first check may be of any version
+                self._clear_entity_caches()
+            elif version > self._cache_version:
+                version, changes = self.changes_since(self._cache_version)
+                with self._shared_lock:
+                    caches = dict((name[len('cache:'):], value) for name, value in self._shared.items()
+                                  if name.startswith('cache:'))
+                for change_version, table, id, operation in changes:
+                    if table in caches:
+                        caches[table].invalidate(id)
+            self._cache_version = version
+            self._cache_checked = now
+
+    def instrument(self, stats=None):
+        """ Records the statements run through the cursors of this factory, and the
+        commits, in stats (a new QueryStats if None), which is returned. """
+        if stats is None:
+            stats = QueryStats()
+        self.stats = stats
+        return stats
+
+    def replicate(self, interval=0.0, max_changes=DEFAULT_MAX_CHANGES):
+        """ Makes the stores of this factory read from an in-memory FleetReplica,
+        which is returned. The replica checks the change log for new versions
+        at most every interval seconds. """
+        self.replica = FleetReplica(self, interval, max_changes)
+        return self.replica
+
+    def read_replica(self):
+        """ Returns the replica, brought up to date, if a read can be answered from it.
+        Reads inside a transaction go to the database, as they must see its
+        uncommitted writes. """
+        if self.replica is None or self.current_work() is not None:
+            return None
+        self.replica.refresh()
+        return self.replica
+
+    def connect(self):
+        """ Checks a connection out of the backend - this needs to be overriden in inherited
+        classes. The connection must be given back with release(). """
+        raise NotImplementedError()
+
+    def release(self, conn):
+        """ Gives a connection back to the backend - this needs to be overriden in inherited classes. """
+        raise NotImplementedError()
+
+    @contextmanager
+    def connection(self):
+        """ Context manager that checks out a connection for the duration of the block.
+        The work is committed at the end of the block, or rolled back on an exception.
+
+        Inside a transaction() on the same thread, the block runs on the
+        transaction's connection and is committed with the rest of its work. """
+        work = self.current_work()
+        if work is not None:
+            work.flush()
+            yield work.conn
+            return
+
+        conn = self.connect()
+        try:
+            yield conn
+            self._commit(conn)
+        except:
+            conn.rollback()
+            raise
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def transaction(self, coalesce=False):
+        """ Context manager that groups the store writes made on this thread in the block
+        into a single unit of work, which is committed once at the end of the block or
+        rolled back on an exception. Nested transactions join the outermost one.
+
+        With coalesce, the updates made through write() are deferred, and several
+        updates of the same row are merged into one statement. Deferred updates
+        are written before any other statement runs in the transaction. """
+        work = self.current_work()
+        if work is not None:
+            yield work
+            return
+
+        conn = self.connect()
+        work = UnitOfWork(self, conn, coalesce)
+        self._local.work = work
+        try:
+            yield work
+            work.flush()
+            self._commit(conn)
+        except:
+            conn.rollback()
+            # the caches may hold rows written by the rolled back work; the
+            # replica never does, as reads in a transaction bypass it
+            self._clear_entity_caches()
+            raise
+        finally:
+            self._local.work = None
+            self.release(conn)
+
+    @contextmanager
+    def savepoint(self):
+        """ Context manager that, inside a transaction(), rolls back only the work of the
+        block on an exception, leaving the rest of the transaction to be committed.
+        Outside a transaction it runs the block in a new transaction. """
+        work = self.current_work()
+        if work is None:
+            with self.transaction() as work:
+                yield work
+            return
+
+        work.flush()
+        self._begin(work.conn)
+        name = f'savepoint{work.savepoints}'
+        work.savepoints += 1
+        cursor = work.conn.cursor()
+        cursor.execute(f'SAVEPOINT {name}')
+        try:
+            yield work
+            work.flush()
+        except:
+            work.discard()
+            cursor.execute(f'ROLLBACK TO SAVEPOINT {name}')
+            cursor.execute(f'RELEASE SAVEPOINT {name}')
+            cursor.close()
+            # the caches may hold rows written by the rolled back work; the
+            # replica never does, as reads in a transaction bypass it
+            self._clear_entity_caches()
+            raise
+        cursor.execute(f'RELEASE SAVEPOINT {name}')
+        cursor.close()
+
+    def _begin(self, conn):
+        """ Makes sure a transaction is open on the connection. The connectors open one
+        with the first statement, so this does nothing unless overriden. """
+        pass
+
+    def current_work(self):
+        """ Returns the unit of work of the transaction open on this thread, or None. """
+        return getattr(self._local, 'work', None)
+
+    def write(self, key, query, params, summary_key=None):
+        """ Runs an update of the row identified by key, a (table, id) pair, and logs the
+        change. summary_key is the fleet summary key of the row after the update
+        (see summary.py); without it the row is read again after the update. In
+        a coalescing transaction the write is deferred, replacing any earlier
+        deferred run of the same query on the row. """
+        work = self.current_work()
+        if work is not None and work.coalesce:
+            work.defer((query, key), query, params, summary_key)
+            return
+        changes = [key + ('update',)]
+        with self.connection() as conn:
+            before = self.lock_keys(conn, changes)
+            cursor = self.statement(conn, query)
+            cursor.execute(query, params)
+            after = None if summary_key is None else {(key[0], int(key[1])): summary_key}
+            self.log_changes(conn, changes, before, after)
+
+    def lock_keys(self, conn, changes):
+        """ Locks the rows of (table, id, operation) changes and returns their fleet
+        summary keys before the write (see summary.py), for log_changes. It must
+        run on the connection of the write, before the rows are changed. """
+        return lock_keys(self, conn, changes)
+
+    def log_changes(self, conn, changes, before=None, after=None):
+        """ Records (table, id, operation) changes in the change log under a new version,
+        which is returned (None if there are no changes), and moves the changed
+        rows from their summary keys before the write to those after it in the
+        fleet summaries (see summary.recount). It must run on the connection of
+        the writes, so it is committed with them.
+
+        The version comes from the counter row in ChangeVersion, which stays
+        locked until the transaction ends, so versions become visible in order
+        and a reader that has seen a version never misses an earlier one. """
+        rows = OrderedDict()
+        for table, id, operation in changes:
+            if id is not None:
+                rows[(table, int(id))] = operation
+        if not rows:
+            return None
+
+        query = 'UPDATE ChangeVersion SET Version = Version + 1 WHERE ID = 1'
+        cursor = self.statement(conn, query)
+        cursor.execute(query)
+        # the summary rows are locked after the counter by every writer
+        recount(self, conn, [(table, id, operation) for (table, id), operation in rows.items()], before, after)
+        query = 'SELECT Version FROM ChangeVersion WHERE ID = 1'
+        cursor = self.statement(conn, query)
+        cursor.execute(query)
+        version = cursor.fetchall()[0][0]
+
+        cursor = self.cursor(conn)
+        cursor.executemany('INSERT INTO ChangeLog (Version, TableName, RowID, Operation) VALUES (%s, %s, %s, %s)',
+                           [(version, table, id, operation) for (table, id), operation in rows.items()])
+        cursor.close()
+        return version
+
+    def current_version(self):
+        """ Returns the version of the last change committed. """
+        with self.connection() as conn:
+            query = 'SELECT Version FROM ChangeVersion WHERE ID = 1'
+            cursor = self.statement(conn, query)
+            cursor.execute(query)
+            return cursor.fetchall()[0][0]
+
+    def changes_since(self, version):
+        """ Returns (latest version, changes) for the changes committed after version,
+        where changes are (version, table, id, operation) tuples in version order.
+        With version None, there are no changes and the current version is returned. """
+        if version is None:
+            return self.current_version(), []
+        with self.connection() as conn:
+            query = 'SELECT Version, TableName, RowID, Operation FROM ChangeLog WHERE Version > %s ORDER BY Version'
+            cursor = self.statement(conn, query)
+            cursor.execute(query, (version,))
+            changes = [tuple(record) for record in cursor.fetchall()]
+        if changes != []:
+            version = changes[-1][0]
+        return version, changes
+
+    def _commit(self, conn):
+        """ Commits the work on a connection, recording it if the factory is instrumented. """
+        if self.stats is None:
+            conn.commit()
+            return
+        start = time.perf_counter()
+        try:
+            conn.commit()
+        finally:
+            self.stats.record('COMMIT', (time.perf_counter() - start) * 1000)
+
+    def _wrap(self, cursor):
+        """ Returns the cursor, wrapped so it is recorded if the factory is instrumented. """
+        if self.stats is None:
+            return cursor
+        return InstrumentedCursor(cursor, self.stats)
+
+    def clear_caches(self):
+        """ Empties the entity caches of all the tables, and makes the replica reload,
+        e.g. after writes made without the stores. """
+        self._clear_entity_caches()
+        if self.replica is not None:
+            self.replica.clear()
+
+    def _clear_entity_caches(self):
+        """ Empties the entity caches of all the tables. """
+        with self._shared_lock:
+            caches = [value for name, value in self._shared.items() if name.startswith('cache:')]
+        for cache in caches:
+            cache.clear()
+
+    def cursor(self, conn):
+        """ Returns a cursor that streams the rows of its result from the database. """
+        return self._wrap(conn.cursor())
+
+    def statement(self, conn, query):
+        """ Returns a cursor for running the query on the connection, reusing the
+        prepared statement if the backend supports it. The caller must read all the
+        rows of the result and must not close the cursor. """
+        return self._wrap(conn.cursor())
+
+    def select_for_update(self, conn, query, params=()):
+        """ Runs a SELECT that locks the rows it reads until the end of the transaction,
+        and returns the rows - this needs to be overriden in inherited classes. """
+        raise NotImplementedError()
+
+    def explain(self, conn, query, params=()):
+        """ Returns the names of the indexes the database uses to run the query - this
+        needs to be overriden in inherited classes. """
+        raise NotImplementedError()
+
+    def insert_many(self, conn, table, columns, rows):
+        """ Inserts the rows of values for columns into table with a single executemany
+        and returns their new IDs - this needs to be overriden in inherited classes. """
+        raise NotImplementedError()
+
+    def add_counts(self, conn, table, columns, rows):
+        """ Adds the count of each (key values..., count) row to the Count of the row of
+        table with that key in columns, inserting the rows that are missing, with a
+        single executemany - this needs to be overriden in inherited classes. """
+        raise NotImplementedError()
+
+
+class UnitOfWork(object):
+    """ The writes of a transaction, which share one connection. """
+
+    def __init__(self, factory, conn, coalesce=False):
+        self.conn = conn
+        self.coalesce = coalesce
+        self.savepoints = 0
+        self._factory = factory
+        self._pending = OrderedDict()
+
+    def defer(self, key, query, params, summary_key=None):
+        """ Defers a write of the row identified by key until the next flush. """
+        self._pending.pop(key, None)
+        self._pending[key] = (query, params, summary_key)
+
+    def discard(self):
+        """ Drops the deferred writes. """
+        self._pending.clear()
+
+    def flush(self):
+        """ Runs the deferred writes, logging their changes under one version. """
+        changes = [key + ('update',) for query, key in self._pending]
+        before = self._factory.lock_keys(self.conn, changes)
+        after = {}
+        while self._pending:
+            (query, key), (query, params, summary_key) = self._pending.popitem(last=False)
+            cursor = self._factory.statement(self.conn, query)
+            cursor.execute(query, params)
+            if after is not None and summary_key is not None:
+                after[(key[0], int(key[1]))] = summary_key
+            else:
+                after = None
+        self._factory.log_changes(self.conn, changes, before, after)
+
+
+class MySQLConnectionFactory(ConnectionFactory):
+    """ Hands out pooled connections to a MySQL server.
+
+    The C extension of the connector is used when it is available, otherwise
+    the pure Python protocol is used. The remaining keyword arguments are
+    passed to the connector (user, password, host, database, ...). Each
+    connection keeps up to statement_cache_size prepared statements. """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, pool_name='dalsys', use_pure=None,
+                 statement_cache_size=DEFAULT_STATEMENT_CACHE_SIZE, **config):
+        super(MySQLConnectionFactory, self).__init__()
+        import mysql.connector
+        from mysql.connector import pooling
+
+        if use_pure is None:
+            use_pure = not mysql.connector.HAVE_CEXT
+        self.use_pure = use_pure
+        self.statement_cache_size = statement_cache_size
+
+        # sessions are not reset when connections go back to the pool, so the
+        # statements prepared on them stay valid
+        self._pool = pooling.MySQLConnectionPool(
+            pool_name=pool_name, pool_size=pool_size, pool_reset_session=False,
+            use_pure=use_pure, **config)
+
+        # the pool raises instead of waiting when it is empty, so checkouts are
+        # limited by a semaphore to make callers wait for a free connection
+        self._available = threading.BoundedSemaphore(pool_size)
+        self._statements = {}
+        self._lock = threading.Lock()
+        # read from the server on the first insert_many
+        self._autoinc_mode = None
+
+    def connect(self):
+        """ Checks a connection out of the pool, waiting for one if they are all in use. """
+        self._available.acquire()
+        try:
+            return self._pool.get_connection()
+        except:
+            self._available.release()
+            raise
+
+    def release(self, conn):
+        """ Returns a connection to the pool. """
+        try:
+            conn.close()
+        finally:
+            self._available.release()
+
+    def cursor(self, conn):
+        """ Returns an unbuffered cursor, which reads the rows from the server as they are fetched. """
+        return self._wrap(conn.cursor(buffered=False))
+
+    def statement(self, conn, query):
+        """ Returns a prepared cursor for the query on the connection.
+
+        Cursors are cached per connection, so running the same query again on
+        the same connection reuses the statement already prepared by the server.
+        Queries such as the IN lists of select_for_update vary with their
+        parameters, so the least recently used statement is closed once the
+        connection has statement_cache_size of them, which keeps the server
+        under its max_prepared_stmt_count. """
+        # pooled connections wrap the real connection, which outlives them
+        cnx = getattr(conn, '_cnx', conn)
+        with self._lock:
+            statements = self._statements.setdefault(cnx, OrderedDict())
+        cursor = statements.get(query)
+        if cursor is None:
+            cursor = conn.cursor(prepared=True)
+            statements[query] = cursor
+            if len(statements) > self.statement_cache_size:
+                # closing the cursor deallocates its statement on the server
+                statements.popitem(last=False)[1].close()
+        else:
+            statements.move_to_end(query)
+        return self._wrap(cursor)
+
+    def select_for_update(self, conn, query, params=()):
+        """ Runs the query with FOR UPDATE, which locks the rows it reads. """
+        query += ' FOR UPDATE'
+        cursor = self.statement(conn, query)
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+    def explain(self, conn, query, params=()):
+        """ Returns the names of the indexes in the key column of the query's EXPLAIN output. """
+        cursor = self._wrap(conn.cursor())
+        cursor.execute('EXPLAIN ' + query, params)
+        records = cursor.fetchall()
+        columns = [column[0] for column in cursor.description]
+        cursor.close()
+
+        key = columns.index('key')
+        return [record[key] for record in records if record[key] is not None]
+
+    def insert_many(self, conn, table, columns, rows):
+        """ Inserts the rows with one multi-row INSERT and returns their new IDs.
+
+        The connector rewrites executemany of an INSERT into a single statement,
+        whose lastrowid is the ID of its first row. With innodb_autoinc_lock_mode
+        0 or 1 the IDs of the other rows follow it, as InnoDB allocates
+        consecutive IDs to a statement inserting a known number of rows.
+
+        With lock mode 2 (the MySQL 8 default) the IDs of concurrent inserts may
+        interleave, so the IDs from the first one on are read back. The
+        transaction's snapshot is taken before the INSERT, so in the default
+        REPEATABLE READ isolation the rows of other transactions with those IDs
+        are not visible, and the read returns only the new rows. """
+        cursor = self._wrap(conn.cursor())
+        interleaved = self._autoinc_lock_mode(cursor) == 2
+        if interleaved:
+            # a consistent read takes the snapshot if the transaction has none yet
+            cursor.execute(f'SELECT ID FROM {table} LIMIT 1')
+            cursor.fetchall()
+
+        cursor.executemany(f'INSERT INTO {table} ({", ".join(columns)}) '
+                           f'VALUES ({", ".join(["%s"] * len(columns))})', rows)
+        first = cursor.lastrowid
+        if interleaved:
+            cursor.execute(f'SELECT ID FROM {table} WHERE ID >= %s ORDER BY ID LIMIT {len(rows)}', (first,))
+            ids = [record[0] for record in cursor.fetchall()]
+        else:
+            ids = list(range(first, first + len(rows)))
+        cursor.close()
+        return ids
+
+    def _autoinc_lock_mode(self, cursor):
+        """ Returns the server's innodb_autoinc_lock_mode, read once per factory. """
+        if self._autoinc_mode is None:
+            cursor.execute('SELECT @@innodb_autoinc_lock_mode')
+            self._autoinc_mode = int(cursor.fetchall()[0][0])
+        return self._autoinc_mode
+
+    def add_counts(self, conn, table, columns, rows):
+        """ Adds the counts with INSERT ... ON DUPLICATE KEY UPDATE. """
+        cursor = self._wrap(conn.cursor())
+        cursor.executemany(f'INSERT INTO {table} ({", ".join(columns)}, Count) '
+                           f'VALUES ({", ".join(["%s"] * (len(columns) + 1))}) '
+                           'ON DUPLICATE KEY UPDATE Count = Count + VALUES(Count)', rows)
+        cursor.close()
+
+
+class SQLiteConnectionFactory(ConnectionFactory):
+    """ Hands out connections to an embedded SQLite database.
+
+    The database runs in-process in WAL mode, so readers do not block the
+    writer. The schema is created when the database is first opened. An
+    in-memory database (':memory:') only exists within one connection, so it
+    is always served by a single connection. """
+
+    def __init__(self, database, pool_size=DEFAULT_POOL_SIZE):
+        super(SQLiteConnectionFactory, self).__init__()
+        self.database = database
+        if database == ':memory:':
+            pool_size = 1
+        self._pool = queue.LifoQueue()
+        self._available = threading.BoundedSemaphore(pool_size)
+        self._queries = {}
+
+        with self.connection() as conn:
+            for query in SQLITE_SCHEMA:
+                conn.execute(query)
+
+    def _open(self):
+        """ Opens a new connection to the database. """
+        conn = sqlite3.connect(self.database, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def connect(self):
+        """ Checks a connection out of the pool, opening a new one if none is idle. """
+        self._available.acquire()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return self._open()
+        except:
+            self._available.release()
+            raise
+
+    def release(self, conn):
+        """ Returns a connection to the pool. """
+        self._pool.put(conn)
+        self._available.release()
+
+    def cursor(self, conn):
+        """ Returns a cursor that accepts %s parameters. """
+        return self._wrap(SQLiteCursor(conn.cursor(), self._translate))
+
+    def statement(self, conn, query):
+        """ Returns a cursor that accepts %s parameters. SQLite keeps its own
+        cache of prepared statements per connection. """
+        return self._wrap(SQLiteCursor(conn.cursor(), self._translate))
+
+    def _begin(self, conn):
+        """ Opens a transaction on the connection if there is none. A savepoint opened
+        outside a transaction would commit it when released.
+
+        The transaction is started with BEGIN IMMEDIATE, as the savepoint may
+        lock rows with select_for_update, which takes an open transaction to
+        hold the write lock already. """
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+
+    def select_for_update(self, conn, query, params=()):
+        """ Runs the query after taking the database's write lock.
+
+        SQLite has no row locks, so the transaction is started with BEGIN
+        IMMEDIATE, which keeps other writers out until it ends. An open
+        transaction already holds the lock: sqlite3 only opens one before a
+        write, and _begin opens it with BEGIN IMMEDIATE. """
+        if not conn.in_transaction:
+            conn.execute('BEGIN IMMEDIATE')
+        cursor = self.statement(conn, query)
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+    def explain(self, conn, query, params=()):
+        """ Returns the names of the indexes named in the query's EXPLAIN QUERY PLAN output. """
+        cursor = self.cursor(conn)
+        cursor.execute('EXPLAIN QUERY PLAN ' + query, params)
+        records = cursor.fetchall()
+        cursor.close()
+
+        indexes = []
+        for record in records:
+            detail = record[-1]
+            match = re.search(r'USING (?:COVERING )?INDEX (\w+)', detail)
+            if match is not None:
+                indexes.append(match.group(1))
+            elif 'USING INTEGER PRIMARY KEY' in detail:
+                indexes.append('PRIMARY')
+        return indexes
+
+    def insert_many(self, conn, table, columns, rows):
+        """ Inserts the rows with executemany and returns their new IDs.
+
+        SQLite has a single writer and allocates IDs in order, so the new rows
+        have the IDs up to the last inserted one. """
+        cursor = self.cursor(conn)
+        cursor.executemany(f'INSERT INTO {table} ({", ".join(columns)}) '
+                           f'VALUES ({", ".join(["%s"] * len(columns))})', rows)
+        cursor.execute('SELECT last_insert_rowid()')
+        last = cursor.fetchone()[0]
+        cursor.close()
+        return list(range(last - len(rows) + 1, last + 1))
+
+    def add_counts(self, conn, table, columns, rows):
+        """ Adds the counts with an INSERT ... ON CONFLICT upsert. """
+        cursor = self.cursor(conn)
+        cursor.executemany(f'INSERT INTO {table} ({", ".join(columns)}, Count) '
+                           f'VALUES ({", ".join(["%s"] * (len(columns) + 1))}) '
+                           f'ON CONFLICT({", ".join(columns)}) DO UPDATE SET Count = Count + excluded.Count', rows)
+        cursor.close()
+
+    def _translate(self, query):
+        """ Converts a query from the %s parameter style to the ? style. """
+        translated = self._queries.get(query)
+        if translated is None:
+            translated = query.replace('%s', '?')
+            self._queries[query] = translated
+        return translated
+
+
+class SQLiteCursor(object):
+    """ Wraps a SQLite cursor so it runs queries written in the %s parameter style. """
+
+    def __init__(self, cursor, translate):
+        self._cursor = cursor
+        self._translate = translate
+
+    def execute(self, query, params=()):
+        """ Runs a query. """
+        self._cursor.execute(self._translate(query), params)
+
+    def executemany(self, query, seq_params):
+        """ Runs a query once for every set of parameters. """
+        self._cursor.executemany(self._translate(query), seq_params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def iter_rows(cursor, batch_size=DEFAULT_BATCH_SIZE):
+    """ Yields the rows of an executed query, fetching batch_size rows at a time.
+
+    Rows are yielded as soon as their batch arrives, so memory use does not grow
+    with the size of the result. The cursor is always drained and closed, even
+    if the caller stops iterating early, so the connection can be reused. """
+    finished = False
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                finished = True
+                break
+            for row in rows:
+                yield row
+    finally:
+        if not finished:
+            while cursor.fetchmany(batch_size):
+                pass
+        cursor.close()
+
+
+def iter_chunks(items, chunk_size=DEFAULT_CHUNK_SIZE):
+    """ Yields lists of up to chunk_size items from an iterable, reading it lazily. """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk != []:
+        yield chunk
@@ -1,9 +1,25 @@
-from operators import Operator
+from collections import OrderedDict
+
+from cache import DEFAULT_CACHE_SIZE, cache_key
+from database import DEFAULT_BATCH_SIZE, DEFAULT_CHUNK_SIZE, DEFAULT_PAGE_SIZE, iter_chunks, iter_rows
+from operators import Operator, OperatorStore
+from search import DEFAULT_SEARCH_LIMIT, TableSearch
+from summary import drone_key, operator_key
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Operator ID stored in a DroneTable for drones without an operator
+NO_OPERATOR = 0
 
 
 class Drone(object):
     """ Stores details on a drone. """
 
+    __slots__ = ('id', 'name', 'class_type', 'rescue', 'operator')
+
     def __init__(self, id, name, class_type, rescue, operator):
         self.id = id
         self.name = name
@@ -12,6 +28,109 @@ class Drone(object):
         self.operator = operator
 
 
+def operator_name(first_name, last_name):
+    """ Builds the display name of an operator, or None if there is no operator. """
+    if first_name is None:
+        return None
+    if last_name is None:
+        return first_name
+    return f'{first_name} {last_name}'
+
+
+class DroneTable(object):
+    """ Columnar copy of drones, held in NumPy arrays.
+
+    The columns are ids, names, class_types, rescue (booleans) and operators,
+    where drones without an operator have NO_OPERATOR. Filtering, counting
+    and sorting work on whole columns; Drone objects are only created when
+    the table is iterated. Filters and sorts return new tables. """
+
+    def __init__(self, ids, names, class_types, rescue, operators):
+        self.ids = ids
+        self.names = names
+        self.class_types = class_types
+        self.rescue = rescue
+        self.operators = operators
+
+    @classmethod
+    def from_rows(cls, rows):
+        """ Builds a table from (ID, Name, ClassType, Rescue, OperatorID) rows. """
+        if numpy is None:
+            raise Exception('DroneTable requires NumPy')
+        ids, names, class_types, rescue, operators = [], [], [], [], []
+        for row in rows:
+            ids.append(row[0])
+            names.append(row[1])
+            class_types.append(row[2])
+            rescue.append(bool(row[3]))
+            operators.append(NO_OPERATOR if row[4] is None else row[4])
+        return cls(numpy.array(ids, dtype=numpy.int64), numpy.array(names, dtype=str),
+                   numpy.array(class_types, dtype=numpy.int8), numpy.array(rescue, dtype=bool),
+                   numpy.array(operators, dtype=numpy.int64))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self.drone(i)
+
+    def drone(self, i):
+        """ Creates the Drone in row i. """
+        operator = int(self.operators[i])
+        return Drone(int(self.ids[i]), str(self.names[i]), int(self.class_types[i]), int(self.rescue[i]),
+                     None if operator == NO_OPERATOR else operator)
+
+    def mask(self, class_type='all', rescue='all', allocated='all'):
+        """ Returns the boolean mask of the rows matching the filters. Any combination of
+        class type, rescue (1 or 0) and allocated (True or False) can be given. """
+        mask = numpy.ones(len(self.ids), dtype=bool)
+        if class_type != 'all':
+            mask &= self.class_types == class_type
+        if rescue != 'all':
+            mask &= self.rescue == bool(rescue)
+        if allocated != 'all':
+            mask &= (self.operators != NO_OPERATOR) == bool(allocated)
+        return mask
+
+    def where(self, mask=None, **filters):
+        """ Returns the rows selected by a boolean mask and/or the filters of mask(). """
+        if mask is None:
+            mask = self.mask(**filters)
+        elif filters:
+            mask = mask & self.mask(**filters)
+        return DroneTable(self.ids[mask], self.names[mask], self.class_types[mask],
+                          self.rescue[mask], self.operators[mask])
+
+    def count(self, mask=None, **filters):
+        """ Counts the rows selected by a boolean mask and/or the filters of mask(). """
+        if mask is None and not filters:
+            return len(self.ids)
+        if mask is None:
+            mask = self.mask(**filters)
+        elif filters:
+            mask = mask & self.mask(**filters)
+        return int(numpy.count_nonzero(mask))
+
+    def sort(self, by='name', descending=False):
+        """ Returns the rows sorted by a column (id, name, class_type, rescue or operator),
+        with ties in ID order (reversed if descending). """
+        columns = {
+            'id': self.ids,
+            'name': self.names,
+            'class_type': self.class_types,
+            'rescue': self.rescue,
+            'operator': self.operators,
+        }
+        if by not in columns:
+            raise Exception(f'Unknown column {by}')
+        order = numpy.lexsort((self.ids, columns[by]))
+        if descending:
+            order = order[::-1]
+        return DroneTable(self.ids[order], self.names[order], self.class_types[order],
+                          self.rescue[order], self.operators[order])
+
+
 class DroneAction(object):
     """ A pending action on the DroneStore. """
 
@@ -40,190 +159,453 @@ class DroneAction(object):
 
 
 class DroneStore(object):
-    """ DroneStore stores all the drones for DALSys. """
-
-    def __init__(self, conn=None):
-        self._conn = conn
+    """ DroneStore stores all the drones for DALSys.
+
+    Connections are taken from a connection factory (see database.py) for each
+    operation. Drones retrieved by get are kept in an LRU cache of cache_size
+    entries for up to cache_ttl seconds (forever if None), which the writes
+    keep up to date. The writes of other clients reach the cache through the
+    change log (see ConnectionFactory.sync_caches). """
+
+    def __init__(self, factory=None, batch_size=DEFAULT_BATCH_SIZE, cache_size=DEFAULT_CACHE_SIZE, cache_ttl=None):
+        self._factory = factory
+        self._batch_size = batch_size
+        self._cache = factory.cache('DroneStore', cache_size, cache_ttl)
+        self._operator_cache = factory.cache('OperatorStore', cache_size, cache_ttl)
+        self._operators = OperatorStore(factory, batch_size, cache_size, cache_ttl)
+        # asks the user a question and returns the answer; the batch mode of
+        # main.py replaces it so nothing waits for input
+        self.ask = input
 
     def add(self, drone):
         """ Adds a new drone to the store. """
         self.save(drone)
 
+    def add_many(self, drones, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+        """ Adds many drones to the store and returns how many were added.
+
+        The drones are read lazily from any iterable and inserted chunk_size at
+        a time, with one multi-row INSERT and one commit per chunk. Each drone's
+        id is set to its new ID. If given, progress is called with the running
+        total after every chunk. """
+        columns = ('Name', 'ClassType', 'Rescue', 'OperatorID')
+        total = 0
+        for chunk in iter_chunks(drones, chunk_size):
+            rows = [(drone.name, drone.class_type, drone.rescue, drone.operator) for drone in chunk]
+            with self._factory.connection() as conn:
+                ids = self._factory.insert_many(conn, 'DroneStore', columns, rows)
+                after = dict((('DroneStore', id), drone_key(drone.class_type, drone.rescue, drone.operator))
+                             for drone, id in zip(chunk, ids))
+                self._factory.log_changes(conn, [('DroneStore', id, 'insert') for id in ids], None, after)
+            for drone, id in zip(chunk, ids):
+                drone.id = id
+            total += len(chunk)
+            if progress is not None:
+                progress(total)
+        return total
+
     def remove(self, id):
         """ Removes a drone from the store. """
-        cursor = self._conn.cursor()
 
         # check if drone exists
         drone = self.get(id)
 
-        # remove the reference to this drone from the operator
-        query = 'SELECT ID FROM OperatorStore WHERE DroneID = %s'
-        cursor.execute(query, (id,))
-        record = cursor.fetchone()
-        if record is not None:
-            query = 'UPDATE OperatorStore SET DroneID = %s WHERE ID = %s'
-            cursor.execute(query, (None, record[0]))
-
-        query = 'DELETE FROM DroneStore WHERE ID = %s'
-        cursor.execute(query, (id,))
-
-        cursor.close()
+        with self._factory.transaction(), self._factory.connection() as conn:
+            changes = [('DroneStore', drone.id, 'delete')]
+            # remove the reference to this drone from the operator
+            query = 'SELECT ID FROM OperatorStore WHERE DroneID = %s'
+            cursor = self._factory.statement(conn, query)
+            cursor.execute(query, (id,))
+            records = cursor.fetchall()
+            if records != []:
+                changes.append(('OperatorStore', records[0][0], 'update'))
+            # the operator's summary key does not change, only the drone's is taken out
+            before = self._factory.lock_keys(conn, changes[:1])
+            if records != []:
+                query = 'UPDATE OperatorStore SET DroneID = %s WHERE ID = %s'
+                cursor = self._factory.statement(conn, query)
+                cursor.execute(query, (None, records[0][0]))
+                self._operator_cache.invalidate(records[0][0])
+
+            query = 'DELETE FROM DroneStore WHERE ID = %s'
+            cursor = self._factory.statement(conn, query)
+            cursor.execute(query, (id,))
+            self._factory.log_changes(conn, changes, before, {})
+            self._cache.invalidate(drone.id)
 
     def get(self, id):
         """ Retrieves a drone from the store by its ID. """
-        cursor = self._conn.cursor()
-        query = 'SELECT * FROM DroneStore WHERE ID = %s'
-        cursor.execute(query, (id,))
-        record = cursor.fetchone()
-
-        if cursor.rowcount == 0 or record is None:
-            raise Exception('Unknown drone')
-        else:
-            record = list(record)
+        key = cache_key(id)
+        replica = self._factory.read_replica()
+        if replica is not None:
+            record = replica.drone(key)
+            if record is None:
+                raise Exception('Unknown drone')
             return Drone(*record)
-        cursor.close()
-
-    def list_all(self, class_type='all', rescue='all'):
-        """ Lists all the drones in the system. """
-
-        # fetch all the records from the database
-        cursor = self._conn.cursor()
-        if class_type == 'all' and rescue == 'all':
-            query = 'SELECT * FROM DroneStore ORDER BY Name'
-        elif class_type == 1 and rescue == 'all':
-            query = 'SELECT * FROM DroneStore WHERE ClassType = 1 ORDER BY Name'
-        elif class_type == 2 and rescue == 'all':
-            query = 'SELECT * FROM DroneStore WHERE ClassType = 2 ORDER BY Name'
-        elif class_type == 1 and rescue == 1:
-            query = 'SELECT * FROM DroneStore WHERE ClassType = 1 AND Rescue = 1 ORDER BY Name'
-        elif class_type == 2 and rescue == 1:
-            query = 'SELECT * FROM DroneStore WHERE ClassType = 2 AND Rescue = 1 ORDER BY Name'
-        elif class_type == 'all' and rescue == 1:
-            query = 'SELECT * FROM DroneStore WHERE Rescue = 1 ORDER BY Name'
-
-        cursor.execute(query)
-        records = cursor.fetchall()
-        cursor.close()
+
+        self._factory.sync_caches()
+        record = self._cache.get(key)
+        if record is None:
+            with self._factory.connection() as conn:
+                query = 'SELECT ID, Name, ClassType, Rescue, OperatorID FROM DroneStore WHERE ID = %s'
+                cursor = self._factory.statement(conn, query)
+                cursor.execute(query, (id,))
+                records = cursor.fetchall()
+
+            if records == []:
+                raise Exception('Unknown drone')
+            record = tuple(records[0])
+            self._cache.put(key, record)
+
+        # the cache holds the record rather than the drone, so callers can
+        # change the drone they get without changing the cached copy
+        return Drone(*record)
+
+    def cache_stats(self):
+        """ Returns the hit, miss and eviction counters of the drone cache. """
+        return self._cache.stats()
+
+    def _filter(self, class_type='all', rescue='all', after=None):
+        """ Builds the WHERE clause and parameters for the list filters.
+
+        If after is a (name, id) key, only the drones that sort after it in
+        (Name, ID) order are matched. """
+        conditions = []
+        params = []
+        if class_type != 'all':
+            conditions.append('DroneStore.ClassType = %s')
+            params.append(class_type)
+        if rescue != 'all':
+            conditions.append('DroneStore.Rescue = %s')
+            params.append(rescue)
+        if after is not None:
+            conditions.append(
+                '(DroneStore.Name > %s OR (DroneStore.Name = %s AND DroneStore.ID > %s))')
+            params.extend([after[0], after[0], after[1]])
+
+        if conditions == []:
+            return '', params
+        return ' WHERE ' + ' AND '.join(conditions), params
+
+    def list_all(self, class_type='all', rescue='all', batch_size=None):
+        """ Lists all the drones in the system.
+
+        The drones are streamed from the database in batches of
+        batch_size rows (defaults to the store's batch size), or read from
+        the factory's replica if it has one. """
+        replica = self._factory.read_replica()
+        if replica is not None:
+            records = replica.drones(class_type, rescue)
+            if records == []:
+                raise Exception('There are no drones for this criteria')
+            for record in records:
+                yield Drone(*record)
+            return
+
+        # stream the records from the database
+        where, params = self._filter(class_type, rescue)
+        query = 'SELECT ID, Name, ClassType, Rescue, OperatorID FROM DroneStore' + \
+            where + ' ORDER BY Name'
+        empty = True
+        with self._factory.connection() as conn:
+            cursor = self._factory.cursor(conn)
+            cursor.execute(query, params)
+            for record in iter_rows(cursor, batch_size or self._batch_size):
+                empty = False
+                yield Drone(*record)
 
         # check if the records are empty
-        if records == []:
+        if empty:
             raise Exception('There are no drones for this criteria')
 
-        # store all the records in drones
-        drones = {}
-        for record in records:
-            record = list(record)
-            drone = Drone(*record)
-            drones[drone.id] = drone
+    def table(self, class_type='all', rescue='all', batch_size=None):
+        """ Loads the drones into a columnar DroneTable with one query. Requires NumPy. """
+        if numpy is None:
+            raise Exception('DroneTable requires NumPy')
+        replica = self._factory.read_replica()
+        if replica is not None:
+            return DroneTable.from_rows(replica.drones(class_type, rescue))
+        where, params = self._filter(class_type, rescue)
+        query = 'SELECT ID, Name, ClassType, Rescue, OperatorID FROM DroneStore' + where + ' ORDER BY Name, ID'
+        with self._factory.connection() as conn:
+            cursor = self._factory.cursor(conn)
+            cursor.execute(query, params)
+            return DroneTable.from_rows(iter_rows(cursor, batch_size or self._batch_size))
+
+    def list_with_operators(self, class_type='all', rescue='all', batch_size=None, limit=None):
+        """ Lists the drones together with the display name of their operator.
+
+        The operator names are resolved with a single LEFT JOIN, so listing the
+        fleet costs one query regardless of its size. Yields (drone, name) pairs
+        where name is None for unallocated drones, up to limit pairs if given. """
+        empty = True
+        for drone, name in self._select_with_operators(class_type, rescue, limit=limit, batch_size=batch_size):
+            empty = False
+            yield drone, name
 
-        for drone in drones:
-            yield drones[drone]
-
-    def allocate(self, drone, operator):
-        """ Starts the allocation of a drone to an operator. """
+        # check if the records are empty
+        if empty:
+            raise Exception('There are no drones for this criteria')
 
-        # check if the drone exists
-        drone = self.get(drone)  # raises exception if does not exits
+    def page(self, after=None, limit=DEFAULT_PAGE_SIZE, class_type='all', rescue='all'):
+        """ Retrieves one page of (drone, operator name) pairs in (Name, ID) order.
+
+        Pages use keyset pagination: pass the (name, id) of the last drone of
+        the previous page as after to get the next one. An empty list means
+        there are no more drones. """
+        return list(self._select_with_operators(class_type, rescue, after, limit))
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        """ Finds up to limit drones by name, returning (drone, operator name) pairs.
+
+        Names are matched by the prefixes of their words, then by similarity
+        for misspelt queries (see search.py), in an in-memory index shared by
+        the stores of the factory. Only the matches are read from the
+        database. """
+        index = self._factory.shared('search:DroneStore',
+                                     lambda: TableSearch(self._factory, 'DroneStore', ('Name',)))
+        ids = index.search(query, limit)
+        if ids == []:
+            return []
+        where = ' WHERE DroneStore.ID IN (' + ', '.join(['%s'] * len(ids)) + ')'
+        pairs = dict((drone.id, (drone, name)) for drone, name in self._select_with_operators(where=(where, ids)))
+        return [pairs[id] for id in ids if id in pairs]
+
+    def changes_since(self, version):
+        """ Returns (latest version, changed, removed) for the drones changed after
+        version (see ConnectionFactory.changes_since), where changed are
+        (drone, operator name) pairs and removed are the ids of deleted drones.
+
+        Drones whose operator changed are included, as their operator name may
+        have. With version None, only the latest version is returned. The cost
+        depends on the number of changes, not on the size of the fleet. """
+        latest, changes = self._factory.changes_since(version)
+        ids = set(id for v, table, id, operation in changes if table == 'DroneStore')
+        operator_ids = set(id for v, table, id, operation in changes if table == 'OperatorStore')
+        changed = OrderedDict()
+        for column, keys in (('DroneStore.ID', ids), ('DroneStore.OperatorID', operator_ids)):
+            for chunk in iter_chunks(sorted(keys), self._batch_size):
+                where = ' WHERE ' + column + ' IN (' + ', '.join(['%s'] * len(chunk)) + ')'
+                for drone, name in self._select_with_operators(where=(where, chunk)):
+                    changed[drone.id] = (drone, name)
+        removed = sorted(ids - set(changed))
+        return latest, list(changed.values()), removed
+
+    def _select_with_operators(self, class_type='all', rescue='all', after=None, limit=None, batch_size=None, where=None):
+        """ Streams (drone, operator name) pairs from the joined tables, or from the
+        factory's replica if it has one. A (clause, params) where replaces the
+        filters and is always run on the database. """
+        replica = self._factory.read_replica() if where is None else None
+        if replica is not None:
+            for record, first_name, last_name in replica.drones_with_operators(class_type, rescue, after, limit):
+                yield Drone(*record), operator_name(first_name, last_name)
+            return
+
+        if where is None:
+            where, params = self._filter(class_type, rescue, after)
+        else:
+            where, params = where[0], list(where[1])
+        query = 'SELECT DroneStore.ID, DroneStore.Name, DroneStore.ClassType, DroneStore.Rescue, DroneStore.OperatorID, ' \
+            'OperatorStore.FirstName, OperatorStore.LastName FROM DroneStore ' \
+            'LEFT JOIN OperatorStore ON DroneStore.OperatorID = OperatorStore.ID' + \
+            where + ' ORDER BY DroneStore.Name, DroneStore.ID'
+        if limit is not None:
+            query += ' LIMIT %s'
+            params.append(limit)
+
+        with self._factory.connection() as conn:
+            cursor = self._factory.cursor(conn)
+            cursor.execute(query, params)
+            for record in iter_rows(cursor, batch_size or self._batch_size):
+                drone = Drone(*record[:5])
+                yield drone, operator_name(record[5], record[6])
 
-        cursor = self._conn.cursor()
+    def allocate(self, drone, operator):
+        """ Starts the allocation of a drone to an operator.
+
+        The drone and the name of its current operator are read with one joined
+        query, and the operator is found through the name index. Validation
+        errors are confirmed before anything is locked, then _allocate locks
+        the rows and writes the allocation in one transaction. Apart from the
+        one-off loading of the name index and the periodic check of the caches
+        (see ConnectionFactory.sync_caches), an allocation to an existing
+        operator costs at most two queries (each with its commit) before the
+        prompts, and at most ten statements (five of them keeping the change
+        log and the fleet summaries) and a commit after them. An unknown
+        operator also costs the lookup of the name in the database and the
+        refresh of the search index that suggests similar names. """
         first_name = operator[0]
         family_name = operator[1]
-        query = 'SELECT * FROM OperatorStore WHERE FirstName = %s AND LastName = %s'
-        cursor.execute(query, (first_name, family_name))
-        record = cursor.fetchone()
+        drone, holder = self._read_allocation(drone)
+        operator = self._operators.find_by_name(first_name, family_name)
 
         # check if the operator exists
-        if cursor.rowcount == 0 or record is None:
+        if operator is None:
+            similar = self._operators.search(f'{first_name} {family_name}', 3)
+            if similar != []:
+                names = ', '.join(f'{match.first_name} {match.family_name}' for match, drone in similar)
+                print(f'Similar operators: {names}')
             print('Validation errors: ')
-            choice = input(
+            choice = self.ask(
                 'Operator does not exist, do you want to add operator [Y/ n]? ').strip().lower()
             if choice == 'y' or choice == '':
-                # make an operator with current values
+                # make an operator with current values, which is added to the
+                # database together with the allocation
                 operator = Operator(None, first_name, family_name)
-
-                # update the OperatorStore table in the database
-                query = 'INSERT INTO OperatorStore (FirstName, LastName, DateOfBirth, DroneLicense, RescueEndorsement, RescueOperations, DroneID) VALUES (%s, %s, %s, %s, %s, %s, %s)'
-                cursor.execute(query, (operator.first_name, operator.family_name, operator.date_of_birth,
-                                       operator.drone_license, operator.rescue_endorsement, operator.operations, operator.drone))
-
-                # fetch the last id added and set it to the id of the operator
-                query = 'SELECT ID FROM OperatorStore ORDER BY ID DESC LIMIT 1'
-                cursor.execute(query)
-                id = cursor.fetchone()[0]
-                operator.id = id
-                print(f'Operator {first_name} {family_name} added')
             else:
                 raise Exception('Allocation cancelled')
-        else:
-            record = list(record)
-            operator = Operator(*record)
 
+        action = self._check_allocation(drone, holder, operator)
+        if action.messages != []:
+            print('Validation errors:')
+            while action.messages != []:
+                print(f'- {action.messages[0]}')
+                choice = self.ask(
+                    'Do you want to continue [Y/n]? ').strip().lower()
+                if choice == 'y' or choice == '':
+                    action.messages.pop(0)
+                else:
+                    raise Exception('Allocation cancelled')
+
+        added = operator.id is None
+        action.commit()
+        if added:
+            print(f'Operator {first_name} {family_name} added')
+
+    def start_allocation(self, drone, first_name, family_name, add_operator=False):
+        """ Starts the allocation of a drone to the operator with the given name, without
+        prompting. The validation errors are the messages of the returned action,
+        which allocates the drone when committed. An unknown operator is an error,
+        unless add_operator is set, in which case the operator is added by the
+        allocation. """
+        drone, holder = self._read_allocation(drone)
+        operator = self._operators.find_by_name(first_name, family_name)
+        if operator is None:
+            if not add_operator:
+                raise Exception('Unknown operator')
+            operator = Operator(None, first_name, family_name)
+        return self._check_allocation(drone, holder, operator)
+
+    def _read_allocation(self, id):
+        """ Reads a drone and the name of its operator with one joined query. """
+        with self._factory.connection() as conn:
+            query = 'SELECT DroneStore.ID, DroneStore.Name, DroneStore.ClassType, DroneStore.Rescue, DroneStore.OperatorID, ' \
+                'OperatorStore.FirstName, OperatorStore.LastName FROM DroneStore ' \
+                'LEFT JOIN OperatorStore ON DroneStore.OperatorID = OperatorStore.ID WHERE DroneStore.ID = %s'
+            cursor = self._factory.statement(conn, query)
+            cursor.execute(query, (id,))
+            records = cursor.fetchall()
+        if records == []:
+            raise Exception('Unknown drone')
+        return Drone(*records[0][:5]), operator_name(records[0][5], records[0][6])
+
+    def _check_allocation(self, drone, holder, operator):
+        """ Returns the allocation action, with a message for every validation error. """
         action = DroneAction(drone, operator, self._allocate)
 
         if operator.drone is not None:
             action.add_message("Operator can only control one drone")
         if drone.operator is not None:
-            query = 'SELECT FirstName, LastName FROM OperatorStore WHERE DroneID = %s'
-            cursor.execute(query, (drone.id,))
-            first_name, last_name = cursor.fetchone()
             action.add_message(
-                f"Drone already allocated to {first_name} {last_name}")
+                f"Drone already allocated to {holder}")
         if operator.drone_license != drone.class_type:
             action.add_message(
                 "Operator does not have correct drone license")
         if drone.rescue and not operator.rescue_endorsement:
             action.add_message("Operator does not have rescue endorsement")
-
-        if action.messages == []:
-            self._allocate(drone, operator)
-        else:
-            print('Validation errors:')
-            while action.messages != []:
-                print(f'- {action.messages[0]}')
-                choice = input(
-                    'Do you want to continue [Y/n]? ').strip().lower()
-                if choice == 'y' or choice == '':
-                    action.messages.pop(0)
-                else:
-                    raise Exception('Allocation cancelled')
-
-        self._allocate(drone, operator)
-
-        cursor.close()
+        return action
 
     def _allocate(self, drone, operator):
-        """ Performs the actual allocation of the operator to the drone. """
-        if drone.operator is not None:
-            # If the operator had a drone previously, we need to clean it so it does not
-            # hold an incorrect reference
-            cursor = self._conn.cursor()
-            query = 'UPDATE OperatorStore SET DroneID = %s WHERE ID = %s'
-            cursor.execute(query, (None, drone.operator))
-            cursor.close()
-        if operator.drone is not None:
-            # If the drone had a operator previously, we need to clean it so it does not
-            # hold an incorrect reference
-            cursor = self._conn.cursor()
-            query = 'UPDATE DroneStore SET OperatorID = %s WHERE ID = %s'
-            cursor.execute(query, (None, operator.drone))
-            cursor.close()
+        """ Performs the actual allocation of the operator to the drone.
+
+        The drone and operator rows are locked and re-read first. If another
+        client allocated either of them since they were read, nothing is
+        written. An operator without an id is added to the store. All the
+        references are changed in the same transaction. """
+        new_operator = operator.id is None
+        with self._factory.transaction(), self._factory.connection() as conn:
+            # the locked rows also give the summary keys of the drones, the
+            # only rows whose keys the allocation changes
+            if new_operator:
+                query = 'SELECT OperatorID, NULL, ClassType, Rescue, NULL, NULL, NULL FROM DroneStore WHERE DroneStore.ID = %s'
+                records = self._factory.select_for_update(conn, query, (drone.id,))
+            else:
+                query = 'SELECT DroneStore.OperatorID, OperatorStore.DroneID, DroneStore.ClassType, DroneStore.Rescue, ' \
+                    'Previous.ClassType, Previous.Rescue, Previous.OperatorID FROM DroneStore CROSS JOIN OperatorStore ' \
+                    'LEFT JOIN DroneStore AS Previous ON Previous.ID = OperatorStore.DroneID ' \
+                    'WHERE DroneStore.ID = %s AND OperatorStore.ID = %s'
+                records = self._factory.select_for_update(conn, query, (drone.id, operator.id))
+            if records == [] or tuple(records[0][:2]) != (drone.operator, operator.drone):
+                self._cache.invalidate(drone.id)
+                self._operator_cache.invalidate(operator.id)
+                raise Exception('Drone or operator changed during the allocation, please try again')
+            class_type, rescue, previous_class, previous_rescue, previous_operator = records[0][2:]
+
+            changes = [('DroneStore', drone.id, 'update'), ('DroneStore', operator.drone, 'update'),
+                       ('OperatorStore', operator.id, 'update'), ('OperatorStore', drone.operator, 'update')]
+            before = {('DroneStore', drone.id): drone_key(class_type, rescue, drone.operator)}
+            after = {}
+            if previous_class is not None and operator.drone != drone.id:
+                before[('DroneStore', operator.drone)] = drone_key(previous_class, previous_rescue, previous_operator)
+                after[('DroneStore', operator.drone)] = drone_key(previous_class, previous_rescue, None)
+            if new_operator:
+                query = 'INSERT INTO OperatorStore (FirstName, LastName, DateOfBirth, DroneLicense, RescueEndorsement, RescueOperations, DroneID) VALUES (%s, %s, %s, %s, %s, %s, %s)'
+                cursor = self._factory.statement(conn, query)
+                cursor.execute(query, (operator.first_name, operator.family_name, operator.date_of_birth,
+                                       operator.drone_license, operator.rescue_endorsement, operator.operations, drone.id))
+                operator.id = cursor.lastrowid
+
+            if not new_operator or drone.operator is not None:
+                # point the operator at the drone, and clear the reference of the
+                # drone's previous operator, in one statement
+                query = 'UPDATE OperatorStore SET DroneID = CASE WHEN ID = %s THEN %s ELSE NULL END WHERE ID IN (%s, %s)'
+                cursor = self._factory.statement(conn, query)
+                previous = drone.operator if drone.operator is not None else operator.id
+                cursor.execute(query, (operator.id, drone.id, operator.id, previous))
+
+            if operator.drone is not None and operator.drone != drone.id:
+                # the operator's previous drone must let go of the operator first,
+                # as OperatorID is unique
+                query = 'UPDATE DroneStore SET OperatorID = %s WHERE ID = %s'
+                cursor = self._factory.statement(conn, query)
+                cursor.execute(query, (None, operator.drone))
 
+            query = 'UPDATE DroneStore SET OperatorID = %s WHERE ID = %s'
+            cursor = self._factory.statement(conn, query)
+            cursor.execute(query, (operator.id, drone.id))
+
+            after[('DroneStore', drone.id)] = drone_key(class_type, rescue, operator.id)
+            if new_operator:
+                changes[2] = ('OperatorStore', operator.id, 'insert')
+                after[('OperatorStore', operator.id)] = operator_key(operator.drone_license, operator.rescue_endorsement)
+            self._factory.log_changes(conn, changes, before, after)
+
+        for id in (drone.id, operator.drone):
+            self._cache.invalidate(id)
+        for id in (operator.id, drone.operator):
+            self._operator_cache.invalidate(id)
+        if new_operator:
+            self._operators.index_name(operator.id, operator.first_name, operator.family_name)
         operator.drone = drone.id
         drone.operator = operator.id
-        self.update(drone, operator=operator)
 
     def save(self, drone):
         """ Saves the drone to the database. """
-
-        cursor = self._conn.cursor()
-        query = 'INSERT INTO DroneStore (Name, ClassType, Rescue, OperatorID) VALUES (%s, %s, %s, %s)'
-        cursor.execute(query, (drone.name, drone.class_type,
-                               drone.rescue, drone.operator))
-        cursor.close()
+        with self._factory.connection() as conn:
+            query = 'INSERT INTO DroneStore (Name, ClassType, Rescue, OperatorID) VALUES (%s, %s, %s, %s)'
+            cursor = self._factory.statement(conn, query)
+            cursor.execute(query, (drone.name, drone.class_type,
+                                   drone.rescue, drone.operator))
+            drone.id = cursor.lastrowid
+            self._factory.log_changes(conn, [('DroneStore', drone.id, 'insert')], None,
+                                      {('DroneStore', drone.id): drone_key(drone.class_type, drone.rescue, drone.operator)})
+        self._cache.put(drone.id, (drone.id, drone.name, drone.class_type, drone.rescue, drone.operator))
         
     def update(self, drone):
-        cursor = self._conn.cursor()
+        """ Saves the new details of a drone. In a coalescing transaction, several
+        updates of the drone are written as one statement. """
         query = 'UPDATE DroneStore SET Name=%s, ClassType=%s, Rescue=%s, OperatorID=%s WHERE ID=%s'
-        cursor.execute(query, (drone.name, drone.class_type, drone.rescue, drone.operator, drone.id))
-        cursor.close()
-        self._conn.commit()
\ No newline at end of file
+        self._factory.write(('DroneStore', cache_key(drone.id)), query,
+                            (drone.name, drone.class_type, drone.rescue, drone.operator, drone.id),
+                            drone_key(drone.class_type, drone.rescue, drone.operator))
+        self._cache.put(cache_key(drone.id), (cache_key(drone.id), drone.name, drone.class_type, drone.rescue, drone.operator))
\ No newline at end of file
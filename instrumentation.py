@@ -0,0 +1,238 @@
+""" Query instrumentation for the stores.
+
+A QueryStats collects the statements run through the cursors of a connection
+factory once it is instrumented (see ConnectionFactory.instrument), grouped
+by query text and by the command that ran them. """
+
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+import json
+import threading
+import time
+
+# Statements slower than this many milliseconds are kept in the slow query log
+DEFAULT_SLOW_QUERY_MS = 100
+
+# Number of entries kept in the slow query log
+DEFAULT_SLOW_LOG_SIZE = 100
+
+# Upper bounds of the latency histogram buckets in milliseconds, in a 1-2-5 series
+HISTOGRAM_BOUNDS = [scale * step for scale in (0.01, 0.1, 1, 10, 100, 1000, 10000) for step in (1, 2, 5)]
+
+
+class Histogram(object):
+    """ Latency histogram with fixed buckets. Percentiles are estimated by the upper
+    bound of the bucket they fall in, or the largest latency for the last bucket. """
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        """ Records a latency in milliseconds. """
+        self.counts[bisect_left(HISTOGRAM_BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """ Returns the estimated latency below which p percent of the latencies fall. """
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(HISTOGRAM_BOUNDS[i], self.max) if i < len(HISTOGRAM_BOUNDS) else self.max
+        return self.max
+
+    def summary(self):
+        """ Returns the count, mean, p50, p95, p99 and max latencies as a dict. """
+        return {
+            'count': self.count,
+            'mean_ms': self.total / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'max_ms': self.max,
+        }
+
+
+class StatementStats(object):
+    """ The executions of one statement or command. """
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.rows = 0
+        self.fetch_ms = 0.0
+        self.statements = 0
+
+    def summary(self):
+        """ Returns the counters as a dict. """
+        summary = self.latency.summary()
+        summary['total_ms'] = self.latency.total
+        summary['rows'] = self.rows
+        summary['fetch_ms'] = self.fetch_ms
+        return summary
+
+
+class QueryStats(object):
+    """ Counts, latencies and rows of the statements run by the stores.
+
+    The latency of a statement is the time its execute takes, which includes
+    the round trip to the database. Fetching the rows is counted separately,
+    as fetch_ms. Statements are also counted against the command running on
+    the thread (see command), and those slower than slow_query_ms are kept in
+    a bounded slow query log. """
+
+    def __init__(self, slow_query_ms=DEFAULT_SLOW_QUERY_MS, slow_log_size=DEFAULT_SLOW_LOG_SIZE):
+        self.slow_query_ms = slow_query_ms
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._statements = {}
+        self._commands = {}
+        self._slow = deque(maxlen=slow_log_size)
+
+    @contextmanager
+    def command(self, name):
+        """ Context manager that times a command and counts the statements it runs on this thread. """
+        outer = getattr(self._local, 'command', None)
+        self._local.command = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            self._local.command = outer
+            with self._lock:
+                self._entry(self._commands, name).latency.add(ms)
+
+    def record(self, query, ms):
+        """ Records an execution of the query that took ms milliseconds. """
+        command = getattr(self._local, 'command', None)
+        with self._lock:
+            self._entry(self._statements, query).latency.add(ms)
+            if command is not None:
+                self._entry(self._commands, command).statements += 1
+            if ms >= self.slow_query_ms:
+                self._slow.append({'query': query, 'ms': ms, 'command': command, 'time': time.time()})
+
+    def record_rows(self, query, rows, ms):
+        """ Records rows of the query fetched in ms milliseconds. """
+        command = getattr(self._local, 'command', None)
+        with self._lock:
+            entry = self._entry(self._statements, query)
+            entry.rows += rows
+            entry.fetch_ms += ms
+            if command is not None:
+                self._entry(self._commands, command).rows += rows
+
+    def statements(self):
+        """ Returns the summary of every statement, the slowest in total first. """
+        with self._lock:
+            summaries = [dict(query=query, **entry.summary()) for query, entry in self._statements.items()]
+        return sorted(summaries, key=lambda summary: summary['total_ms'], reverse=True)
+
+    def commands(self):
+        """ Returns the summary of every command, with the number of statements it ran. """
+        with self._lock:
+            summaries = []
+            for name, entry in self._commands.items():
+                summary = dict(command=name, **entry.summary())
+                summary['statements'] = entry.statements
+                summaries.append(summary)
+        return sorted(summaries, key=lambda summary: summary['command'])
+
+    def slow_queries(self):
+        """ Returns the slow query log, oldest first. """
+        with self._lock:
+            return list(self._slow)
+
+    def reset(self):
+        """ Clears all the counters and the slow query log. """
+        with self._lock:
+            self._statements.clear()
+            self._commands.clear()
+            self._slow.clear()
+
+    def to_dict(self):
+        """ Returns all the statistics as a dict that can be dumped as JSON. """
+        return {
+            'time': time.time(),
+            'slow_query_ms': self.slow_query_ms,
+            'commands': self.commands(),
+            'statements': self.statements(),
+            'slow_queries': self.slow_queries(),
+        }
+
+    def dump(self, path):
+        """ Writes all the statistics to a JSON file. """
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def _entry(self, entries, key):
+        """ Returns the stats for key, creating them on first use. The lock must be held. """
+        entry = entries.get(key)
+        if entry is None:
+            entry = entries[key] = StatementStats()
+        return entry
+
+
+class InstrumentedCursor(object):
+    """ Wraps a cursor so the statements it runs and the rows it fetches are recorded. """
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._query = None
+
+    def execute(self, query, params=()):
+        """ Runs a query. """
+        self._query = query
+        start = time.perf_counter()
+        try:
+            return self._cursor.execute(query, params)
+        finally:
+            self._stats.record(query, (time.perf_counter() - start) * 1000)
+
+    def executemany(self, query, seq_params):
+        """ Runs a query once for every set of parameters. """
+        self._query = query
+        start = time.perf_counter()
+        try:
+            return self._cursor.executemany(query, seq_params)
+        finally:
+            self._stats.record(query, (time.perf_counter() - start) * 1000)
+
+    def fetchone(self):
+        """ Fetches the next row. """
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        self._fetched(0 if row is None else 1, start)
+        return row
+
+    def fetchmany(self, size=None):
+        """ Fetches the next size rows. """
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        self._fetched(len(rows), start)
+        return rows
+
+    def fetchall(self):
+        """ Fetches the remaining rows. """
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        self._fetched(len(rows), start)
+        return rows
+
+    def _fetched(self, rows, start):
+        """ Records fetched rows. """
+        if self._query is not None:
+            self._stats.record_rows(self._query, rows, (time.perf_counter() - start) * 1000)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
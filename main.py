@@ -1,34 +1,222 @@
-import mysql.connector
+from allocation import AllocationEngine
+from compliance import RULES, VIOLATION_FIELDS, scan
+import csv
+from database import DEFAULT_CHUNK_SIZE, MySQLConnectionFactory, SQLiteConnectionFactory
+from datetime import date
 from drones import Drone, DroneStore
+import json
+from migrations import check_indexes, migrate
+from operators import Operator, OperatorStore
 import shlex
+from summary import check as check_summary, read_summary, rebuild as rebuild_summary, summary_lines
+import sys
+import time
+
+# Number of batch mode commands whose writes are committed together
+DEFAULT_COMMIT_EVERY = 100
+
+# Number of lines collected before list output is written out
+DEFAULT_OUTPUT_BUFFER = 1000
+
+# The formats and fields of the list command, with the headings and widths of the table format
+LIST_FORMATS = ('table', 'csv', 'jsonl')
+LIST_FIELDS = ('id', 'name', 'class', 'rescue', 'operator')
+TABLE_HEADINGS = {'id': 'ID', 'name': 'Name', 'class': 'Class', 'rescue': 'Rescue', 'operator': 'Operator'}
+TABLE_WIDTHS = {'id': 10, 'name': 20, 'class': 10, 'rescue': 10, 'operator': 10}
+
+
+def read_records(path):
+    """ Reads the records of a CSV file (with a header row) or a JSON Lines file as dicts. """
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                if line.strip() != '':
+                    yield json.loads(line)
+
+
+def parse_flag(value):
+    """ Converts a yes/no field of an imported record to 1 or 0. """
+    if isinstance(value, str):
+        return 1 if value.strip().lower() in ('1', 'y', 'yes', 'true') else 0
+    return 1 if value else 0
+
+
+def drone_from_record(record):
+    """ Creates a drone from an imported record with name, class and rescue fields. """
+    return Drone(None, record['name'], int(record['class']), parse_flag(record.get('rescue')), None)
+
+
+def operator_from_record(record):
+    """ Creates an operator from an imported record. """
+    date_of_birth = record.get('date_of_birth') or None
+    if date_of_birth is not None:
+        date_of_birth = date.fromisoformat(date_of_birth)
+    drone_license = record.get('drone_license') or None
+    if drone_license is not None:
+        drone_license = int(drone_license)
+    return Operator(None, record['first_name'], record.get('last_name'), date_of_birth, drone_license,
+                    parse_flag(record.get('rescue_endorsement')), int(record.get('operations') or 0))
+
+
+def split_command(line):
+    """ Splits a command line into its words. Only the command name is lowercased,
+    so names and paths in the arguments keep their case. """
+    parts = shlex.split(line)
+    if parts != []:
+        parts[0] = parts[0].lower()
+    return parts
+
+
+def parse_options(args, names):
+    """ Parses -name=value options (or --name=value) into a dict. Options without a
+    value are set to True. Raises an exception for options not in names. The
+    names are matched in any case, and the values keep theirs. """
+    options = {}
+    for arg in args:
+        name, equals, value = arg.lstrip('-').partition('=')
+        name = name.lower()
+        if not arg.startswith('-') or name not in names:
+            raise Exception(f'Unknown option {arg}')
+        options[name] = value if equals else True
+    return options
+
+
+def option_keyword(options, name, default):
+    """ Returns the value of a keyword option (such as a format) lowercased, or
+    default if the option is not given. """
+    value = options.get(name, default)
+    return value.lower() if isinstance(value, str) else value
+
+
+class OutputBuffer(object):
+    """ Collects written text and passes it on to a stream in large chunks, so a
+    line-buffered terminal is not flushed for every line. """
+
+    def __init__(self, stream, size=DEFAULT_OUTPUT_BUFFER):
+        self._stream = stream
+        self._size = size
+        self._parts = []
+
+    def write(self, text):
+        """ Writes text, passing the collected text on once size pieces have been written. """
+        self._parts.append(text)
+        if len(self._parts) >= self._size:
+            self.flush()
+
+    def flush(self):
+        """ Passes the collected text on to the stream. """
+        if self._parts != []:
+            self._stream.write(''.join(self._parts))
+            self._parts = []
+        self._stream.flush()
+
+
+def drone_values(drone, operator):
+    """ Returns the list fields of a drone and its operator's name, without changing the drone. """
+    return {
+        'id': drone.id,
+        'name': drone.name,
+        'class': drone.class_type,
+        'rescue': bool(drone.rescue),
+        'operator': operator,
+    }
+
+
+def write_drones(drones, stream, output_format='table', fields=LIST_FIELDS):
+    """ Writes (drone, operator name) pairs to a stream and returns how many were written. """
+    out = OutputBuffer(stream)
+    writer = csv.writer(out) if output_format == 'csv' else None
+    count = 0
+    for drone, operator in drones:
+        values = drone_values(drone, operator)
+        if output_format == 'table':
+            if count == 0:
+                out.write(' '.join(f'{TABLE_HEADINGS[field]: <{TABLE_WIDTHS[field]}}' for field in fields) + '\n')
+            values['class'] = 'One' if drone.class_type == 1 else 'Two'
+            values['rescue'] = 'No' if drone.rescue == 0 else 'Yes'
+            if operator is None:
+                values['operator'] = '<none>'
+            out.write(' '.join(f'{values[field]: <{TABLE_WIDTHS[field]}}' for field in fields) + '\n')
+        elif output_format == 'csv':
+            if count == 0:
+                writer.writerow(fields)
+            writer.writerow([values[field] for field in fields])
+        else:
+            out.write(json.dumps(dict((field, values[field]) for field in fields)) + '\n')
+        count += 1
+    out.flush()
+    return count
+
+
+def write_violations(violations, stream, output_format='table'):
+    """ Writes compliance violations to a stream and returns their counts by rule. """
+    out = OutputBuffer(stream)
+    writer = csv.writer(out) if output_format == 'csv' else None
+    counts = dict((rule, 0) for rule in RULES)
+    for violation in violations:
+        values = violation.values()
+        if output_format == 'table':
+            if sum(counts.values()) == 0:
+                out.write(f'{"Rule": <14} {"Drone": <30} {"Operator": <30} Message\n')
+            drone = '<none>' if values['drone_id'] is None else f'{values["drone_id"]}: {values["drone"] or ""}'
+            operator = '<none>' if values['operator_id'] is None else f'{values["operator_id"]}: {values["operator"] or ""}'
+            out.write(f'{values["rule"]: <14} {drone: <30} {operator: <30} {values["message"]}\n')
+        elif output_format == 'csv':
+            if sum(counts.values()) == 0:
+                writer.writerow(VIOLATION_FIELDS)
+            writer.writerow(values.values())
+        else:
+            out.write(json.dumps(values) + '\n')
+        counts[violation.rule] += 1
+    out.flush()
+    return counts
+
+
+def no_answer(prompt):
+    """ Answers the questions asked in batch mode when there is no answer policy. """
+    raise Exception(f'Cannot answer "{prompt.strip()}" in batch mode, use -yes or -no')
 
 
 class Application(object):
     """ Main application wrapper for processing input. """
 
-    def __init__(self, conn):
-        self._drones = DroneStore(conn)
+    def __init__(self, factory):
+        self._drones = DroneStore(factory)
+        self._operators = OperatorStore(factory)
         self._commands = {
             'list': self.list,
             'add': self.add,
             'update': self.update,
             'remove': self.remove,
             'allocate': self.allocate,
+            'autoallocate': self.autoallocate,
+            'import': self.import_records,
+            'check': self.check,
+            'stats': self.stats,
+            'changes': self.changes,
+            'search': self.search,
+            'report': self.report,
+            'compliance': self.compliance,
             'help': self.help,
         }
-        self._connection = conn
+        self._factory = factory
+        # the change log version the changes command last showed
+        self._version = None
 
     def main_loop(self):
         print('Welcome to DALSys')
         cont = True
         while cont:
-            val = input('> ').strip().lower()
+            val = input('> ').strip()
             cmd = None
             args = {}
             if len(val) == 0:
                 continue
             try:
-                parts = shlex.split(val)
+                parts = split_command(val)
                 if parts[0] == 'quit':
                     cont = False
                     print('Exiting DALSys')
@@ -40,10 +228,88 @@ class Application(object):
             if cmd is not None:
                 args = parts[1:]
                 try:
-                    cmd(args)
+                    self.run(parts[0], cmd, args)
                 except Exception as ex:
                     print('!! %s !!' % (str(ex)))
 
+    def run(self, name, cmd, args):
+        """ Runs a command, timing it if the query statistics are enabled. """
+        if self._factory.stats is not None and cmd != self.stats:
+            with self._factory.stats.command(name):
+                cmd(args)
+        else:
+            cmd(args)
+
+    def run_batch(self, lines, answer=None, fail_fast=False, commit_every=DEFAULT_COMMIT_EVERY):
+        """ Runs the commands read from lines without prompting, and returns how many failed.
+
+        Questions are answered with answer ('yes' or 'no'), or fail the command
+        if there is none. The writes of every commit_every commands are
+        committed together, and a command that fails only rolls back its own
+        writes. With fail_fast, the batch stops at the first failed command.
+        Blank lines and lines starting with # are skipped. """
+        if answer == 'yes':
+            self._drones.ask = lambda prompt: 'y'
+        elif answer == 'no':
+            self._drones.ask = lambda prompt: 'n'
+        else:
+            self._drones.ask = no_answer
+
+        timings = {}
+        failed = 0
+        commits = 0
+        number = 0
+        lines = iter(lines)
+        finished = False
+        start = time.perf_counter()
+        while not finished:
+            with self._factory.transaction():
+                count = 0
+                while count < commit_every:
+                    line = next(lines, None)
+                    if line is None:
+                        finished = True
+                        break
+                    number += 1
+                    val = line.strip()
+                    if val == '' or val.startswith('#'):
+                        continue
+                    name = val.split()[0].lower()
+                    if name == 'quit':
+                        finished = True
+                        break
+                    count += 1
+
+                    command_start = time.perf_counter()
+                    try:
+                        parts = split_command(val)
+                        cmd = self._commands.get(parts[0])
+                        if cmd is None:
+                            raise Exception(f'Unknown command "{val}"')
+                        with self._factory.savepoint():
+                            self.run(parts[0], cmd, parts[1:])
+                    except Exception as ex:
+                        failed += 1
+                        print(f'!! line {number}: {ex} !!')
+                        if fail_fast:
+                            print('Stopping the batch at the first failed command')
+                            finished = True
+                            break
+                    finally:
+                        timings.setdefault(name, []).append(time.perf_counter() - command_start)
+            if count > 0:
+                commits += 1
+        elapsed = time.perf_counter() - start
+
+        total = sum(len(durations) for durations in timings.values())
+        print(f'\n{"Command": <14} {"Runs": >6} {"Total ms": >10} {"Mean ms": >10} {"Max ms": >10}')
+        for name, durations in sorted(timings.items()):
+            print(f'{name: <14} {len(durations): >6} {sum(durations) * 1000: >10.2f} '
+                  f'{sum(durations) / len(durations) * 1000: >10.2f} {max(durations) * 1000: >10.2f}')
+        rate = total / elapsed if elapsed > 0 else 0
+        print(f'\n{total} commands ({failed} failed) in {elapsed:.2f}s, {rate:.0f} per second, {commits} commits')
+        return failed
+
     def add(self, args):
         """ Adds a new drone. """
 
@@ -66,12 +332,8 @@ class Application(object):
         drone = Drone(None, name, class_type, rescue, None)
         self._drones.add(drone)
 
-        # get the id of the newly added drone
-        cursor = self._connection.cursor()
-        query = 'SELECT ID FROM DroneStore ORDER BY ID DESC LIMIT 1'
-        cursor.execute(query)
-        id = cursor.fetchone()[0]
-        cursor.close()
+        # the store sets the id of the newly added drone
+        id = drone.id
 
         if rescue:
             print(f'\nAdded rescue drone with ID {id:04}')
@@ -92,80 +354,283 @@ class Application(object):
 
         first_name, last_name = args[1].strip().split(' ', 1)
 
+        # allocate raises an exception if the drone was not allocated
         self._drones.allocate(args[0], [first_name, last_name])
+        print(f'\nDrone allocated to {args[1]}')
 
-        # check for the allocation
-        cursor = self._connection.cursor()
-        query = 'SELECT ID FROM OperatorStore WHERE DroneID = %s'
-        cursor.execute(query, (args[0],))
-        id = cursor.fetchone()
-        if id is not None:
-            print(f'\nDrone allocated to {args[1]}')
+    def import_records(self, args):
+        """ Imports drones or operators from a CSV or JSON Lines file. """
+        if len(args) < 2 or args[0].lower() not in ('drones', 'operators'):
+            raise Exception('Type and path are required')
+        kind = args[0].lower()
+        path = args[1]
+        chunk_size = DEFAULT_CHUNK_SIZE
+        for arg in args[2:]:
+            if '-chunk=' in arg:
+                chunk_size = int(arg.split('-chunk=')[1])
+
+        if kind == 'drones':
+            store = self._drones
+            items = (drone_from_record(record) for record in read_records(path))
+        else:
+            store = self._operators
+            items = (operator_from_record(record) for record in read_records(path))
+
+        start = time.perf_counter()
+
+        def progress(total):
+            elapsed = time.perf_counter() - start
+            print(f'{total} {kind} imported ({total / elapsed:.0f} per second)')
+
+        total = store.add_many(items, chunk_size, progress)
+        elapsed = time.perf_counter() - start
+        rate = total / elapsed if elapsed > 0 else 0
+        print(f'\nImported {total} {kind} in {elapsed:.2f}s ({rate:.0f} per second)')
+
+    def check(self, args):
+        """ Checks that the store queries use their indexes. """
+        for description, indexes, ok in check_indexes(self._factory):
+            status = 'OK' if ok else 'NOT INDEXED'
+            used = ', '.join(indexes) or '<none>'
+            print(f'{description: <30} {status: <12} {used}')
+
+    def stats(self, args):
+        """ Shows the query statistics of the commands run so far. """
+        stats = self._factory.stats
+        if stats is None:
+            raise Exception('Query statistics are not enabled, start DALSys with -stats')
+
+        # the option is a keyword, but the path after dump keeps its case
+        option = args[0].lower() if len(args) > 0 else None
+        if option is None:
+            print(f'{"Command": <14} {"Runs": >6} {"Queries": >8} {"Rows": >8} '
+                  f'{"p50 ms": >9} {"p95 ms": >9} {"p99 ms": >9} {"Max ms": >9}')
+            for command in stats.commands():
+                print(f'{command["command"]: <14} {command["count"]: >6} {command["statements"]: >8} {command["rows"]: >8} '
+                      f'{command["p50_ms"]: >9.2f} {command["p95_ms"]: >9.2f} {command["p99_ms"]: >9.2f} {command["max_ms"]: >9.2f}')
+            print(f'\n{"Statement": <60} {"Count": >6} {"Rows": >8} {"p50 ms": >9} {"p95 ms": >9} {"p99 ms": >9} {"Total ms": >9}')
+            for statement in stats.statements()[:10]:
+                print(f'{statement["query"][:60]: <60} {statement["count"]: >6} {statement["rows"]: >8} '
+                      f'{statement["p50_ms"]: >9.2f} {statement["p95_ms"]: >9.2f} {statement["p99_ms"]: >9.2f} {statement["total_ms"]: >9.2f}')
+        elif option == 'slow':
+            slow = stats.slow_queries()
+            for entry in slow:
+                print(f'{entry["ms"]: >9.2f} ms  {entry["command"] or "-": <14} {entry["query"]}')
+            print(f'\n{len(slow)} statements slower than {stats.slow_query_ms} ms')
+        elif option == 'reset':
+            stats.reset()
+            print('Query statistics cleared')
+        elif option == 'threshold' and len(args) > 1:
+            stats.slow_query_ms = float(args[1])
+            print(f'Slow query threshold set to {stats.slow_query_ms} ms')
+        elif option == 'dump' and len(args) > 1:
+            stats.dump(args[1])
+            print(f'Query statistics written to {args[1]}')
+        else:
+            raise Exception('Unknown stats option')
+
+    def changes(self, args):
+        """ Lists the drones changed since the last changes command (or since -since).
+
+        The first changes command only notes the current version. With -watch
+        it polls the change log every that many seconds until interrupted, so
+        each poll costs one query plus one per changed chunk of drones. """
+        options = parse_options(args, ('since', 'format', 'watch'))
+        output_format = option_keyword(options, 'format', 'table')
+        if output_format not in LIST_FORMATS:
+            raise Exception(f'Unknown format {output_format}')
+        try:
+            if 'since' in options:
+                self._version = int(options['since'])
+            interval = float(options['watch']) if 'watch' in options else None
+        except ValueError:
+            raise Exception('Version and interval must be numbers')
+
+        while True:
+            first = self._version is None
+            version, changed, removed = self._drones.changes_since(self._version)
+            if first:
+                print(f'Watching changes after version {version}')
+            elif changed != [] or removed != []:
+                write_drones(changed, sys.stdout, output_format)
+                for id in removed:
+                    print(f'Drone {id} removed', file=sys.stderr if output_format != 'table' else sys.stdout)
+                print(f'\nVersion {version}: {len(changed)} changed, {len(removed)} removed',
+                      file=sys.stderr if output_format != 'table' else sys.stdout)
+            elif interval is None:
+                print(f'No changes after version {version}')
+            self._version = version
+            if interval is None:
+                return
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                return
+
+    def search(self, args):
+        """ Finds drones or operators by name, tolerating typos. """
+        if len(args) < 2 or args[0].lower() not in ('drones', 'operators'):
+            raise Exception('Search needs drones or operators and a name')
+        kind = args[0].lower()
+        options = parse_options(args[2:], ('limit', 'format'))
+        try:
+            limit = int(options.get('limit', 10))
+        except ValueError:
+            raise Exception('Limit must be a number')
+
+        if kind == 'drones':
+            output_format = option_keyword(options, 'format', 'table')
+            if output_format not in LIST_FORMATS:
+                raise Exception(f'Unknown format {output_format}')
+            count = write_drones(self._drones.search(args[1], limit), sys.stdout, output_format)
+        else:
+            matches = self._operators.search(args[1], limit)
+            if matches != []:
+                print(f'{"ID": <10} {"Name": <30} {"Drone": <20}')
+            for operator, drone in matches:
+                name = f'{operator.first_name} {operator.family_name or ""}'.strip()
+                drone_name = '<none>' if drone is None else f'{drone[0]}: {drone[1]}'
+                print(f'{operator.id: <10} {name: <30} {drone_name: <20}')
+            count = len(matches)
+        if count == 0:
+            print(f'No {kind} found for "{args[1]}"')
+
+    def report(self, args):
+        """ Shows the fleet counts from the summary tables, which the store writes keep
+        up to date, so the report costs the same however big the fleet is.
+        -check compares them with counts of the tables and -rebuild recounts them. """
+        options = parse_options(args, ('format', 'check', 'rebuild'))
+        output_format = option_keyword(options, 'format', 'table')
+        if output_format not in ('table', 'json'):
+            raise Exception(f'Unknown format {output_format}')
+        if 'rebuild' in options:
+            rebuild_summary(self._factory)
+            print('Fleet summary recounted')
+        if 'check' in options:
+            differences = check_summary(self._factory)
+            for summary, key, counted, actual in differences:
+                print(f'{summary} {key}: {counted} counted, {actual} in the table')
+            if differences == []:
+                print('Fleet summary matches the tables')
+            return
+
+        report = read_summary(self._factory)
+        if output_format == 'json':
+            print(json.dumps(report))
+        else:
+            print('\n'.join(summary_lines(report)))
+
+    def compliance(self, args):
+        """ Checks every drone and operator against the allocation and operator rules.
+
+        Each rule is one query over the whole fleet (see compliance.py). The
+        violations are written in the table, csv or jsonl format, to stdout or
+        to the -output file, followed by their counts by rule. -rules picks
+        the rules to check. """
+        options = parse_options(args, ('rules', 'format', 'output'))
+        output_format = option_keyword(options, 'format', 'table')
+        if output_format not in LIST_FORMATS:
+            raise Exception(f'Unknown format {output_format}')
+        rules = list(RULES)
+        if 'rules' in options:
+            rules = [rule.strip() for rule in option_keyword(options, 'rules', '').split(',')]
+            for rule in rules:
+                if rule not in RULES:
+                    raise Exception(f'Unknown rule {rule}')
+
+        if 'output' in options:
+            with open(options['output'], 'w', newline='') as f:
+                counts = write_violations(scan(self._factory, rules), f, output_format)
+            summary = sys.stdout
+        else:
+            counts = write_violations(scan(self._factory, rules), sys.stdout, output_format)
+            summary = sys.stdout if output_format == 'table' else sys.stderr
+
+        print('', file=summary)
+        for rule in rules:
+            print(f'{rule: <14} {counts[rule]: >9} violation{"" if counts[rule] == 1 else "s"}', file=summary)
+        total = sum(counts.values())
+        print('Fleet is compliant' if total == 0 else f'{total} violations found', file=summary)
+
+    def autoallocate(self, args):
+        """ Allocates all the idle drones to free operators in one batch. """
+        engine = AllocationEngine(self._factory)
+        plan = engine.plan()
+        if '-dry-run' not in args:
+            engine.commit(plan)
+
+        for drone, operator in plan.assignments:
+            print(f'{drone.id: <10} {drone.name: <20} -> {operator.first_name} {operator.family_name}')
+        for drone, reason in plan.unmatched:
+            print(f'{drone.id: <10} {drone.name: <20} not allocated: {reason}')
+
+        if '-dry-run' in args:
+            print(f'\n{len(plan.assignments)} drones would be allocated, {len(plan.unmatched)} could not be allocated')
+        else:
+            print(f'\n{len(plan.assignments)} drones allocated, {len(plan.unmatched)} could not be allocated')
 
     def help(self, args):
         """ Displays help information. """
         print("Valid commands are:")
-        print("* list [- class =(1|2)] [- rescue ]")
+        print("* list [- class =(1|2)] [- rescue ] [-format=(table|csv|jsonl)] [-limit=n] [-fields=id,name,...] [-output=path]")
         print("* add 'name ' -class =(1|2) [- rescue ]")
         print("* update id [- name ='name '] [- class =(1|2)] [- rescue ]")
         print("* remove id")
         print("* allocate id 'operator'")
+        print("* autoallocate [-dry-run]")
+        print("* import (drones|operators) path [-chunk=n]")
+        print("* check")
+        print("* stats [slow | reset | threshold ms | dump path]")
+        print("* changes [-since=version] [-format=(table|csv|jsonl)] [-watch=seconds]")
+        print("* search (drones|operators) 'name' [-limit=n] [-format=(table|csv|jsonl)]")
+        print("* report [-format=(table|json)] [-check] [-rebuild]")
+        print("* compliance [-rules=license,endorsement,...] [-format=(table|csv|jsonl)] [-output=path]")
 
     def list(self, args):
-        """ Lists all the drones in the system. """
+        """ Lists all the drones in the system.
 
-        # check the args
-        if len(args) == 0:
-            drones = self._drones.list_all()
+        The drones are written as they are streamed from the database, in the
+        table, csv or jsonl format, to stdout or to the -output file. -limit
+        stops after that many drones and -fields picks the columns. """
+        options = parse_options(args, ('class', 'rescue', 'format', 'limit', 'fields', 'output'))
 
-        elif len(args) == 1:
-            if '-class=1' in str(args):
-                drones = self._drones.list_all(class_type=1)
-            elif '-class=2' in str(args):
-                drones = self._drones.list_all(class_type=2)
-            elif '-rescue' in str(args):
-                drones = self._drones.list_all(rescue=1)
-            else:
-                n = args[0].strip().split('-class=')[1]
-                raise Exception(f'Unknown drone class {n}')
-        else:
-            if '-class=1' in str(args) and '-rescue' in str(args):
-                drones = self._drones.list_all(class_type=1, rescue=1)
-            elif '-class=2' in str(args) and '-rescue' in str(args):
-                drones = self._drones.list_all(class_type=2, rescue=1)
-
-        ############    print the drones    ###############
-        num_of_drones = 0
-        for drone in drones:
-            if drone.operator is None:
-                drone.operator = '<none>'
-            else:
-                cursor = self._connection.cursor()
-                query = 'SELECT FirstName, LastName FROM OperatorStore WHERE DroneID = %s'
-                cursor.execute(query, (drone.id,))
-                first_name, last_name = cursor.fetchone()
-                drone.operator = f'{first_name} {last_name}'
-                cursor.close()
-            if drone.rescue == 0:
-                drone.rescue = 'No'
-            else:
-                drone.rescue = 'Yes'
-            if drone.class_type == 1:
-                drone.class_type = 'One'
-            else:
-                drone.class_type = 'Two'
+        class_type = option_keyword(options, 'class', 'all')
+        if class_type not in ('all', '1', '2'):
+            raise Exception(f'Unknown drone class {class_type}')
+        if class_type != 'all':
+            class_type = int(class_type)
+        rescue = 1 if 'rescue' in options else 'all'
 
-            num_of_drones += 1
-            if num_of_drones == 1:
-                print(
-                    f'{"ID": <10} {"Name": <20} {"Class": <10} {"Rescue": <10} {"Operator": <10}')
-            print(
-                f'{drone.id: <10} {drone.name: <20} {drone.class_type: <10} {drone.rescue: <10} {drone.operator: <10}')
+        output_format = option_keyword(options, 'format', 'table')
+        if output_format not in LIST_FORMATS:
+            raise Exception(f'Unknown format {output_format}')
+        fields = LIST_FIELDS
+        if 'fields' in options:
+            fields = tuple(field.strip() for field in option_keyword(options, 'fields', '').split(','))
+            for field in fields:
+                if field not in LIST_FIELDS:
+                    raise Exception(f'Unknown field {field}')
+        limit = None
+        if 'limit' in options:
+            try:
+                limit = int(options['limit'])
+            except ValueError:
+                raise Exception('Limit must be a number')
 
-        if num_of_drones == 1:
-            print('\n1 drone listed')
+        drones = self._drones.list_with_operators(class_type=class_type, rescue=rescue, limit=limit)
+        if 'output' in options:
+            with open(options['output'], 'w', newline='') as f:
+                count = write_drones(drones, f, output_format, fields)
+            summary = sys.stdout
         else:
-            print(f'\n{num_of_drones} drones listed')
+            count = write_drones(drones, sys.stdout, output_format, fields)
+            # keep the summary out of machine-readable output
+            summary = sys.stdout if output_format == 'table' else sys.stderr
+
+        if count == 1:
+            print('\n1 drone listed', file=summary)
+        else:
+            print(f'\n{count} drones listed', file=summary)
 
     def remove(self, args):
         """ Removes a drone. """
@@ -220,15 +685,42 @@ class Application(object):
 
 
 if __name__ == '__main__':
-    conn = mysql.connector.connect(
-        user='mcho139',
-        password='b6f002ef',        
-        host='studdb-mysql.fos.auckland.ac.nz',   
-        database='stu_mcho139_COMPSCI_280_C_S2_2019',       
-        charset='utf8',
-        use_pure = True 
-    )
+    # python main.py [database] [-batch[=path]] [-yes | -no] [-fail-fast] [-commit-every=n] [-replica] [-stats]
+    options = [arg for arg in sys.argv[1:] if arg.startswith('-')]
+    paths = [arg for arg in sys.argv[1:] if not arg.startswith('-')]
+    if len(paths) > 0:
+        # use the embedded SQLite database at the given path
+        factory = SQLiteConnectionFactory(paths[0])
+    else:
+        factory = MySQLConnectionFactory(
+            user='mcho139',
+            password='b6f002ef',        
+            host='studdb-mysql.fos.auckland.ac.nz',   
+            database='stu_mcho139_COMPSCI_280_C_S2_2019',       
+            charset='utf8'
+        )
+    if '-stats' in options:
+        # time every statement, for the stats command
+        factory.instrument()
+    migrate(factory)
+    if '-replica' in options:
+        # answer the reads from an in-memory copy of the fleet
+        factory.replicate()
+    app = Application(factory)
+    batch = [option for option in options if option == '-batch' or option.startswith('-batch=')]
+    if batch != []:
+        # run the commands of a file, or of stdin with -batch or -batch=-
+        path = batch[0][len('-batch='):]
+        answer = 'yes' if '-yes' in options else 'no' if '-no' in options else None
+        commit_every = DEFAULT_COMMIT_EVERY
+        for option in options:
+            if option.startswith('-commit-every='):
+                commit_every = int(option.split('=', 1)[1])
+        if path in ('', '-'):
+            failed = app.run_batch(sys.stdin, answer, '-fail-fast' in options, commit_every)
+        else:
+            with open(path) as f:
+                failed = app.run_batch(f, answer, '-fail-fast' in options, commit_every)
+        sys.exit(1 if failed else 0)
     print('connected')
-    app = Application(conn)
     app.main_loop()
-    conn.close()
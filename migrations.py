@@ -0,0 +1,87 @@
+""" Schema migrations for the DALSys database.
+
+Each migration is applied once and recorded in the SchemaMigrations table,
+so migrate() can be run every time the application starts. The statements
+work on both MySQL and SQLite. """
+
+from summary import populate_statement
+
+# (version, description, statement) for every migration, in the order they are applied
+MIGRATIONS = [
+    (1, 'Index operators by name for allocation',
+     'CREATE INDEX OperatorStoreName ON OperatorStore(LastName, FirstName)'),
+    (2, 'Index drones by the list filters',
+     'CREATE INDEX DroneStoreFilter ON DroneStore(ClassType, Rescue, Name)'),
+    (3, 'Index operators by their drone',
+     'CREATE INDEX OperatorStoreDroneID ON OperatorStore(DroneID)'),
+    (4, 'Add the change version counter',
+     'CREATE TABLE ChangeVersion(ID int not null, Version int not null, primary key(ID))'),
+    (5, 'Start the change version counter',
+     'INSERT INTO ChangeVersion (ID, Version) VALUES (1, 0)'),
+    (6, 'Add the change log',
+     'CREATE TABLE ChangeLog(Version int not null, TableName varchar(20) not null, RowID int not null, '
+     'Operation varchar(10) not null, primary key(Version, TableName, RowID))'),
+    (7, 'Add the drone summary',
+     'CREATE TABLE DroneSummary(ClassType int not null, Rescue int not null, Allocated int not null, '
+     'Count int not null, primary key(ClassType, Rescue, Allocated))'),
+    (8, 'Count the drones in the summary', populate_statement('DroneStore')),
+    (9, 'Add the operator summary',
+     'CREATE TABLE OperatorSummary(DroneLicense int not null, RescueEndorsement int not null, '
+     'Count int not null, primary key(DroneLicense, RescueEndorsement))'),
+    (10, 'Count the operators in the summary', populate_statement('OperatorStore')),
+    (11, 'Index operators by their names in lower case',
+     'CREATE INDEX OperatorStoreLowerName ON OperatorStore((LOWER(LastName)), (LOWER(FirstName)))'),
+]
+
+# (description, query, parameters, index) for the store queries that must use an
+# index. DroneStore.OperatorID is already indexed by its unique key, whose name
+# depends on the database, so any index is accepted for it.
+INDEX_CHECKS = [
+    ('Operator by name', 'SELECT * FROM OperatorStore WHERE LOWER(FirstName) = %s AND LOWER(LastName) = %s',
+     ('john', 'doe'), 'OperatorStoreLowerName'),
+    ('Drones by class and rescue', 'SELECT ID, Name, ClassType, Rescue, OperatorID FROM DroneStore '
+     'WHERE ClassType = %s AND Rescue = %s ORDER BY Name', (1, 1), 'DroneStoreFilter'),
+    ('Operator by drone', 'SELECT ID FROM OperatorStore WHERE DroneID = %s',
+     (1,), 'OperatorStoreDroneID'),
+    ('Drone by operator', 'SELECT ID FROM DroneStore WHERE OperatorID = %s',
+     (1,), None),
+]
+
+
+def migrate(factory):
+    """ Applies the migrations that have not been applied yet and returns their versions. """
+    applied = []
+    with factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        cursor.execute('CREATE TABLE IF NOT EXISTS SchemaMigrations('
+                       'Version int not null, Description varchar(100) not null, primary key(Version))')
+        cursor.execute('SELECT Version FROM SchemaMigrations')
+        done = set(record[0] for record in cursor.fetchall())
+
+        for version, description, statement in MIGRATIONS:
+            if version in done:
+                continue
+            cursor.execute(statement)
+            cursor.execute('INSERT INTO SchemaMigrations (Version, Description) VALUES (%s, %s)',
+                           (version, description))
+            applied.append(version)
+        cursor.close()
+    return applied
+
+
+def check_indexes(factory):
+    """ Runs EXPLAIN on the store queries that should be indexed.
+
+    Returns a (description, indexes, ok) tuple for every query, where indexes
+    are the indexes the database chose. On a nearly empty MySQL table the
+    optimiser may prefer a table scan, so run the check on representative data. """
+    results = []
+    with factory.connection() as conn:
+        for description, query, params, index in INDEX_CHECKS:
+            indexes = factory.explain(conn, query, params)
+            if index is None:
+                ok = indexes != []
+            else:
+                ok = index in indexes
+            results.append((description, indexes, ok))
+    return results
@@ -1,9 +1,18 @@
+from collections import OrderedDict
 from datetime import date
 
+from cache import DEFAULT_CACHE_SIZE, cache_key
+from database import DEFAULT_BATCH_SIZE, DEFAULT_CHUNK_SIZE, DEFAULT_PAGE_SIZE, iter_chunks, iter_rows
+from search import DEFAULT_SEARCH_LIMIT, TableSearch
+from summary import operator_key
+
 
 class Operator(object):
     """ Stores details on an operator. """
 
+    __slots__ = ('id', 'first_name', 'family_name', 'date_of_birth', 'drone_license',
+                 'rescue_endorsement', 'operations', 'drone')
+
     def __init__(self, id, first_name, family_name, date_of_birth=None, drone_license=None, rescue_endorsement=False, operations=0, drone=None):
         self.id = id
         self.first_name = first_name
@@ -14,6 +23,21 @@ class Operator(object):
         self.operations = operations
         self.drone = drone
 
+    @property
+    def last_name(self):
+        """ The family name of the operator. """
+        return self.family_name
+
+    @last_name.setter
+    def last_name(self, value):
+        self.family_name = value
+
+
+def normalize_name(first_name, family_name):
+    """ Normalizes an operator's name for lookups, ignoring case and extra spaces. """
+    return (' '.join((first_name or '').split()).casefold(),
+            ' '.join((family_name or '').split()).casefold())
+
 
 class OperatorAction(object):
     """ A pending action on the OperatorStore. """
@@ -42,12 +66,20 @@ class OperatorAction(object):
 
 
 class OperatorStore(object):
-    """ Stores the operators. """
+    """ Stores the operators.
+
+    Connections are taken from a connection factory (see database.py) for each
+    operation. Operators retrieved by get are kept in an LRU cache of
+    cache_size entries for up to cache_ttl seconds (forever if None), which
+    the writes keep up to date. The writes of other clients reach the cache
+    through the change log (see ConnectionFactory.sync_caches). """
 
-    def __init__(self, conn=None):
+    def __init__(self, factory=None, batch_size=DEFAULT_BATCH_SIZE, cache_size=DEFAULT_CACHE_SIZE, cache_ttl=None):
         self._operators = {}
         self._last_id = 0
-        self._conn = conn
+        self._factory = factory
+        self._batch_size = batch_size
+        self._cache = factory.cache('OperatorStore', cache_size, cache_ttl)
 
     def add(self, operator):
         """ Starts adding a new operator to the store. """
@@ -75,11 +107,40 @@ class OperatorStore(object):
 
     def _add(self, operator):
         """ Adds a new operator to the store. """
-        cursor = self._conn.cursor()
-        query = 'INSERT INTO OperatorStore (FirstName, LastName, DroneLicense, RescueEndorsement, RescueOperations) VALUES (%s, %s, %s, %s, %s)'
-        cursor.execute(query, (operator.first_name, operator.last_name, 
-                               operator.drone_license, operator.rescue_endorsement, operator.operations))
-        cursor.close()
+        with self._factory.connection() as conn:
+            query = 'INSERT INTO OperatorStore (FirstName, LastName, DroneLicense, RescueEndorsement, RescueOperations) VALUES (%s, %s, %s, %s, %s)'
+            cursor = self._factory.statement(conn, query)
+            cursor.execute(query, (operator.first_name, operator.last_name, 
+                                   operator.drone_license, operator.rescue_endorsement, operator.operations))
+            operator.id = cursor.lastrowid
+            self._factory.log_changes(conn, [('OperatorStore', operator.id, 'insert')], None,
+                                      {('OperatorStore', operator.id): operator_key(operator.drone_license, operator.rescue_endorsement)})
+        self.index_name(operator.id, operator.first_name, operator.last_name)
+
+    def add_many(self, operators, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+        """ Adds many operators to the store and returns how many were added.
+
+        The operators are read lazily from any iterable and inserted chunk_size
+        at a time, with one multi-row INSERT and one commit per chunk. They are
+        not validated like add() does. Each operator's id is set to its new ID.
+        If given, progress is called with the running total after every chunk. """
+        columns = ('FirstName', 'LastName', 'DateOfBirth', 'DroneLicense', 'RescueEndorsement', 'RescueOperations', 'DroneID')
+        total = 0
+        for chunk in iter_chunks(operators, chunk_size):
+            rows = [(operator.first_name, operator.family_name, operator.date_of_birth, operator.drone_license,
+                     operator.rescue_endorsement, operator.operations, operator.drone) for operator in chunk]
+            with self._factory.connection() as conn:
+                ids = self._factory.insert_many(conn, 'OperatorStore', columns, rows)
+                after = dict((('OperatorStore', id), operator_key(operator.drone_license, operator.rescue_endorsement))
+                             for operator, id in zip(chunk, ids))
+                self._factory.log_changes(conn, [('OperatorStore', id, 'insert') for id in ids], None, after)
+            for operator, id in zip(chunk, ids):
+                operator.id = id
+                self.index_name(id, operator.first_name, operator.family_name)
+            total += len(chunk)
+            if progress is not None:
+                progress(total)
+        return total
 
     def remove(self, operator):
         """ Removes a operator from the store. """
@@ -90,43 +151,214 @@ class OperatorStore(object):
 
     def get(self, id):
         """ Retrieves a operator from the store by its ID or name. """
-        cursor = self._conn.cursor()
-        query = 'SELECT * FROM OperatorStore WHERE ID = %s'
-        cursor.execute(query, (id,))
-        record = cursor.fetchone()
-
-        if cursor.rowcount == 0 or record is None:
-            raise Exception('Unknown drone')
-        else:
-            record = list(record)
+        key = cache_key(id)
+        replica = self._factory.read_replica()
+        if replica is not None:
+            record = replica.operator(key)
+            if record is None:
+                raise Exception('Unknown drone')
             return Operator(*record)
-        cursor.close()
-        
 
-    def list_all(self):
-        """ Lists all the _operators in the system. """
-        cursor = self._conn.cursor()
+        self._factory.sync_caches()
+        record = self._cache.get(key)
+        if record is None:
+            with self._factory.connection() as conn:
+                query = 'SELECT * FROM OperatorStore WHERE ID = %s'
+                cursor = self._factory.statement(conn, query)
+                cursor.execute(query, (id,))
+                records = cursor.fetchall()
+
+            if records == []:
+                raise Exception('Unknown drone')
+            record = tuple(records[0])
+            self._cache.put(key, record)
+
+        # the cache holds the record rather than the operator, so callers can
+        # change the operator they get without changing the cached copy
+        return Operator(*record)
+
+    def cache_stats(self):
+        """ Returns the hit, miss and eviction counters of the operator cache. """
+        return self._cache.stats()
+
+    def find_by_name(self, first_name, family_name):
+        """ Retrieves an operator by name, or returns None if there is no such operator.
+
+        Names are looked up in an in-process hash index of the normalized names,
+        which is loaded on first use and shared by the stores of the factory, so
+        repeated lookups do not query the database. Operators missing from the
+        index, e.g. added by another client, are looked up in the database by
+        their names in lower case, which ignores case like the index does (for
+        ASCII letters on SQLite), but not extra spaces in the stored names. """
+        names = self._name_index()
+        key = normalize_name(first_name, family_name)
+        id = names.get(key)
+        if id is not None:
+            try:
+                operator = self.get(id)
+            except Exception:
+                operator = None
+
+            # the operator may have been renamed or removed since it was indexed
+            if operator is not None and normalize_name(operator.first_name, operator.family_name) == key:
+                return operator
+            names.pop(key, None)
+
+        with self._factory.connection() as conn:
+            query = 'SELECT * FROM OperatorStore WHERE LOWER(FirstName) = %s AND LOWER(LastName) = %s ORDER BY ID LIMIT 1'
+            cursor = self._factory.statement(conn, query)
+            cursor.execute(query, key)
+            records = cursor.fetchall()
+
+        if records == []:
+            return None
+        record = tuple(records[0])
+        self._cache.put(record[0], record)
+        names[key] = record[0]
+        return Operator(*record)
+
+    def index_name(self, id, first_name, family_name):
+        """ Adds an operator to the name index. """
+        self._name_index().setdefault(normalize_name(first_name, family_name), id)
+
+    def _name_index(self):
+        """ Returns the name index, loading it from the database on first use. """
+        return self._factory.shared('names:OperatorStore', self._load_names)
+
+    def _load_names(self):
+        """ Builds the name index from the names of all the operators. """
+        names = {}
+        with self._factory.connection() as conn:
+            query = 'SELECT ID, FirstName, LastName FROM OperatorStore ORDER BY ID'
+            cursor = self._factory.cursor(conn)
+            cursor.execute(query)
+            for id, first_name, family_name in iter_rows(cursor, self._batch_size):
+                # keep the first operator with the name, as the SQL lookup does
+                names.setdefault(normalize_name(first_name, family_name), id)
+        return names
+
+    def list_all(self, batch_size=None):
+        """ Lists all the _operators in the system.
+
+        The operators are streamed from the database in batches of
+        batch_size rows (defaults to the store's batch size), or read from
+        the factory's replica if it has one. """
+        replica = self._factory.read_replica()
+        if replica is not None:
+            for record in replica.operators():
+                yield Operator(*record)
+            return
+
         query = "SELECT * FROM OperatorStore ORDER BY LastName"
-        cursor.execute(query)
-        records = cursor.fetchall()
-        cursor.close()
-        
-        operators = {}
-        
-        for record in records:
-            record = list(record)
-            operator = Operator(*record)
-            operators[operator.id] = operator
-
-        for operator in operators:
-            yield operators[operator]
-            
+        with self._factory.connection() as conn:
+            cursor = self._factory.cursor(conn)
+            cursor.execute(query)
+            for record in iter_rows(cursor, batch_size or self._batch_size):
+                yield Operator(*record)
+
+    def list_with_drones(self, batch_size=None):
+        """ Lists the operators together with the drone assigned to them.
+
+        The drones are resolved with a single LEFT JOIN, so the listing costs one
+        query regardless of the number of operators and drones. Yields
+        (operator, drone) pairs where drone is a (id, name, class_type) tuple,
+        or None if the operator has no drone. """
+        return self._select_with_drones(batch_size=batch_size)
+
+    def page(self, after=None, limit=DEFAULT_PAGE_SIZE):
+        """ Retrieves one page of (operator, drone) pairs in (LastName, ID) order.
+
+        Pages use keyset pagination: pass the (last name, id) of the last
+        operator of the previous page as after to get the next one. An empty
+        list means there are no more operators. """
+        return list(self._select_with_drones(after, limit))
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        """ Finds up to limit operators by full name, returning (operator, drone) pairs
+        like page does. Names are matched like DroneStore.search does. """
+        index = self._factory.shared('search:OperatorStore',
+                                     lambda: TableSearch(self._factory, 'OperatorStore', ('FirstName', 'LastName')))
+        ids = index.search(query, limit)
+        if ids == []:
+            return []
+        where = ' WHERE OperatorStore.ID IN (' + ', '.join(['%s'] * len(ids)) + ')'
+        pairs = dict((operator.id, (operator, drone)) for operator, drone in self._select_with_drones(where=(where, ids)))
+        return [pairs[id] for id in ids if id in pairs]
+
+    def changes_since(self, version):
+        """ Returns (latest version, changed, removed) for the operators changed after
+        version (see ConnectionFactory.changes_since), where changed are
+        (operator, drone) pairs like page returns and removed are the ids of
+        deleted operators.
+
+        Operators whose drone changed are included, as its name or class may
+        have. With version None, only the latest version is returned. """
+        latest, changes = self._factory.changes_since(version)
+        ids = set(id for v, table, id, operation in changes if table == 'OperatorStore')
+        drone_ids = set(id for v, table, id, operation in changes if table == 'DroneStore')
+        changed = OrderedDict()
+        for column, keys in (('OperatorStore.ID', ids), ('DroneStore.ID', drone_ids)):
+            for chunk in iter_chunks(sorted(keys), self._batch_size):
+                where = ' WHERE ' + column + ' IN (' + ', '.join(['%s'] * len(chunk)) + ')'
+                for operator, drone in self._select_with_drones(where=(where, chunk)):
+                    changed[operator.id] = (operator, drone)
+        removed = sorted(ids - set(changed))
+        return latest, list(changed.values()), removed
+
+    def _select_with_drones(self, after=None, limit=None, batch_size=None, where=None):
+        """ Streams (operator, drone) pairs from the joined tables, or from the factory's
+        replica if it has one. A (clause, params) where replaces the keyset
+        condition and is always run on the database. """
+        replica = self._factory.read_replica() if where is None else None
+        if replica is not None:
+            for record, drone in replica.operators_with_drones(after, limit):
+                yield Operator(*record), drone
+            return
+
+        query = 'SELECT OperatorStore.ID, OperatorStore.FirstName, OperatorStore.LastName, OperatorStore.DateOfBirth, ' \
+            'OperatorStore.DroneLicense, OperatorStore.RescueEndorsement, OperatorStore.RescueOperations, OperatorStore.DroneID, ' \
+            'DroneStore.ID, DroneStore.Name, DroneStore.ClassType FROM OperatorStore ' \
+            'LEFT JOIN DroneStore ON DroneStore.OperatorID = OperatorStore.ID'
+        params = []
+        if where is not None:
+            query += where[0]
+            params.extend(where[1])
+        elif after is not None:
+            # NULL last names sort first, so they are only followed by larger
+            # IDs with no last name or by any operator with a last name
+            if after[0] is None:
+                query += ' WHERE (OperatorStore.LastName IS NULL AND OperatorStore.ID > %s)' \
+                    ' OR OperatorStore.LastName IS NOT NULL'
+                params.append(after[1])
+            else:
+                query += ' WHERE (OperatorStore.LastName > %s' \
+                    ' OR (OperatorStore.LastName = %s AND OperatorStore.ID > %s))'
+                params.extend([after[0], after[0], after[1]])
+        query += ' ORDER BY OperatorStore.LastName, OperatorStore.ID'
+        if limit is not None:
+            query += ' LIMIT %s'
+            params.append(limit)
+
+        with self._factory.connection() as conn:
+            cursor = self._factory.cursor(conn)
+            cursor.execute(query, params)
+            for record in iter_rows(cursor, batch_size or self._batch_size):
+                operator = Operator(*record[:8])
+                if record[8] is None:
+                    yield operator, None
+                else:
+                    yield operator, tuple(record[8:])
+
     def update(self, operator):
-        cursor = self._conn.cursor()
+        """ Saves the new details of an operator. In a coalescing transaction, several
+        updates of the operator are written as one statement. """
         query = 'UPDATE OperatorStore SET FirstName=%s, LastName=%s, DateOfBirth=%s, DroneLicense=%s, RescueEndorsement=%s, RescueOperations=%s WHERE ID=%s'
-        cursor.execute(query, (operator.first_name, operator.family_name, operator.date_of_birth, operator.drone_license, operator.rescue_endorsement, operator.operations, operator.id))
-        cursor.close()
-        self._conn.commit()
+        self._factory.write(('OperatorStore', cache_key(operator.id)), query,
+                            (operator.first_name, operator.family_name, operator.date_of_birth, operator.drone_license, operator.rescue_endorsement, operator.operations, operator.id),
+                            operator_key(operator.drone_license, operator.rescue_endorsement))
+        # the update does not change DroneID, so the row is reloaded on the next get
+        self._cache.invalidate(cache_key(operator.id))
+        self.index_name(cache_key(operator.id), operator.first_name, operator.family_name)
 
     def save(self):
         """ Saves the store to the database. """
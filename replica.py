@@ -0,0 +1,251 @@
+""" In-process read replica of the fleet.
+
+A FleetReplica keeps a copy of DroneStore and OperatorStore in memory and
+answers the list and lookup queries of the stores from it (see
+ConnectionFactory.replicate). It is kept current through the change log:
+before a read it compares its version with the ChangeVersion counter and
+re-reads only the rows changed since, or reloads both tables when that is
+cheaper or the database was changed underneath it. """
+
+from bisect import bisect_right, insort
+import threading
+import time
+
+# Changed rows above which the replica reloads the tables instead of re-reading the rows
+DEFAULT_MAX_CHANGES = 1000
+
+# Number of ids looked up together when re-reading changed rows
+ID_CHUNK_SIZE = 500
+
+DRONE_COLUMNS = 'ID, Name, ClassType, Rescue, OperatorID'
+OPERATOR_COLUMNS = 'ID, FirstName, LastName, DateOfBirth, DroneLicense, RescueEndorsement, RescueOperations, DroneID'
+
+
+def sort_key(value, id):
+    """ Returns the key that sorts rows by (value, id) like the stores' ORDER BY, NULLs first. """
+    return (value is not None, value if value is not None else '', id)
+
+
+def rescue_key(rescue):
+    """ Normalizes a Rescue value, which may be NULL, a number or a boolean. """
+    return None if rescue is None else int(rescue)
+
+
+class FleetReplica(object):
+    """ In-memory copy of the drone and operator tables.
+
+    Drones are indexed by id, by operator and by (class, rescue), and both
+    tables are kept in the (name, id) order the stores list them in, so a
+    page is found by bisection and a selective filter only sorts the drones
+    it matches. Records are the
+    tuples the stores build their Drone and Operator objects from.
+
+    The version is checked at most every interval seconds (on every read if
+    0). More than max_changes changed rows, a version that went backwards or
+    clear() make the next read reload both tables. Names are ordered by
+    Python string comparison, as SQLite does; a MySQL collation may order
+    differently cased names another way. """
+
+    def __init__(self, factory, interval=0.0, max_changes=DEFAULT_MAX_CHANGES):
+        self.interval = interval
+        self.max_changes = max_changes
+        self.version = None
+        self.reloads = 0
+        self.refreshes = 0
+        self._factory = factory
+        self._lock = threading.RLock()
+        self._checked = None
+        self._drones = {}
+        self._operators = {}
+        self._by_operator = {}
+        self._by_filter = {}
+        self._drone_order = []
+        self._operator_order = []
+
+    def clear(self):
+        """ Drops the copy, so the next read reloads it. """
+        with self._lock:
+            self.version = None
+
+    def refresh(self):
+        """ Brings the copy up to date with the database. """
+        with self._lock:
+            now = time.monotonic()
+            if self.version is not None and self._checked is not None and now - self._checked < self.interval:
+                return
+            if self.version is None:
+                self._reload()
+            else:
+                version = self._factory.current_version()
+                if version < self.version:
+                    self._reload()
+                elif version > self.version:
+                    self._apply(*self._factory.changes_since(self.version))
+            self._checked = now
+
+    def stats(self):
+        """ Returns the size, version and refresh counters of the replica. """
+        with self._lock:
+            return {'drones': len(self._drones), 'operators': len(self._operators), 'version': self.version,
+                    'reloads': self.reloads, 'refreshes': self.refreshes}
+
+    def drone(self, id):
+        """ Returns the record of a drone, or None if there is no such drone. """
+        with self._lock:
+            return self._drones.get(id)
+
+    def operator(self, id):
+        """ Returns the record of an operator, or None if there is no such operator. """
+        with self._lock:
+            return self._operators.get(id)
+
+    def drones(self, class_type='all', rescue='all', after=None, limit=None):
+        """ Returns the drone records matching the filters in (Name, ID) order,
+        starting after the (name, id) key after and up to limit records. """
+        with self._lock:
+            ids = self._filtered(class_type, rescue)
+            if ids is None or (limit is not None and len(ids) * 2 > len(self._drones)):
+                # walk the fleet's order, skipping the drones filtered out
+                order = self._drone_order
+            else:
+                order = sorted(sort_key(self._drones[id][1], id) for id in ids)
+                ids = None
+            start = 0 if after is None else bisect_right(order, sort_key(after[0], after[1]))
+            end = len(order)
+            if ids is None and limit is not None:
+                end = min(end, start + limit)
+            records = []
+            for i in range(start, end):
+                if limit is not None and len(records) >= limit:
+                    break
+                id = order[i][2]
+                if ids is None or id in ids:
+                    records.append(self._drones[id])
+            return records
+
+    def drones_with_operators(self, class_type='all', rescue='all', after=None, limit=None):
+        """ Returns (drone record, first name, last name) for drones() like the LEFT JOIN
+        of DroneStore, with None names for unallocated drones. """
+        with self._lock:
+            rows = []
+            for record in self.drones(class_type, rescue, after, limit):
+                operator = self._operators.get(record[4])
+                if operator is None:
+                    rows.append((record, None, None))
+                else:
+                    rows.append((record, operator[1], operator[2]))
+            return rows
+
+    def operators(self, after=None, limit=None):
+        """ Returns the operator records in (LastName, ID) order, starting after the
+        (last name, id) key after and up to limit records. """
+        with self._lock:
+            order = self._operator_order
+            start = 0 if after is None else bisect_right(order, sort_key(after[0], after[1]))
+            end = len(order) if limit is None else min(len(order), start + limit)
+            return [self._operators[order[i][2]] for i in range(start, end)]
+
+    def operators_with_drones(self, after=None, limit=None):
+        """ Returns (operator record, drone) for operators() like the LEFT JOIN of
+        OperatorStore, where drone is an (id, name, class_type) tuple or None. """
+        with self._lock:
+            rows = []
+            for record in self.operators(after, limit):
+                drone = self._drones.get(self._by_operator.get(record[0]))
+                rows.append((record, None if drone is None else (drone[0], drone[1], drone[2])))
+            return rows
+
+    def _filtered(self, class_type, rescue):
+        """ Returns the set of drone ids matching the filters, or None for all the drones. """
+        if class_type == 'all' and rescue == 'all':
+            return None
+        ids = set()
+        for (key_class, key_rescue), members in self._by_filter.items():
+            if (class_type == 'all' or key_class == class_type) and (rescue == 'all' or key_rescue == rescue_key(rescue)):
+                ids.update(members)
+        return ids
+
+    def _reload(self):
+        """ Loads both tables. The version is read first, so changes made during the
+        load are applied again by the next refresh. """
+        version = self._factory.current_version()
+        self._drones = {}
+        self._operators = {}
+        self._by_operator = {}
+        self._by_filter = {}
+        with self._factory.connection() as conn:
+            cursor = self._factory.cursor(conn)
+            cursor.execute('SELECT ' + DRONE_COLUMNS + ' FROM DroneStore')
+            for record in cursor.fetchall():
+                self._put_drone(tuple(record))
+            cursor.execute('SELECT ' + OPERATOR_COLUMNS + ' FROM OperatorStore')
+            for record in cursor.fetchall():
+                self._operators[record[0]] = tuple(record)
+            cursor.close()
+        self._drone_order = sorted(sort_key(record[1], id) for id, record in self._drones.items())
+        self._operator_order = sorted(sort_key(record[2], id) for id, record in self._operators.items())
+        self.version = version
+        self.reloads += 1
+
+    def _apply(self, version, changes):
+        """ Re-reads the rows changed up to version. """
+        ids = {'DroneStore': set(), 'OperatorStore': set()}
+        for change_version, table, id, operation in changes:
+            if table in ids:
+                ids[table].add(id)
+        if len(ids['DroneStore']) + len(ids['OperatorStore']) > self.max_changes:
+            self._reload()
+            return
+
+        drones = self._read('DroneStore', DRONE_COLUMNS, ids['DroneStore'])
+        operators = self._read('OperatorStore', OPERATOR_COLUMNS, ids['OperatorStore'])
+        for id in ids['DroneStore']:
+            old = self._remove_drone(id)
+            if old is not None:
+                self._drone_order.pop(bisect_right(self._drone_order, sort_key(old[1], id)) - 1)
+            record = drones.get(id)
+            if record is not None:
+                self._put_drone(record)
+                insort(self._drone_order, sort_key(record[1], id))
+        for id in ids['OperatorStore']:
+            old = self._operators.pop(id, None)
+            if old is not None:
+                self._operator_order.pop(bisect_right(self._operator_order, sort_key(old[2], id)) - 1)
+            record = operators.get(id)
+            if record is not None:
+                self._operators[id] = record
+                insort(self._operator_order, sort_key(record[2], id))
+        self.version = version
+        self.refreshes += 1
+
+    def _read(self, table, columns, ids):
+        """ Reads the rows of a table with the given ids, as a dict of records by id. """
+        records = {}
+        ids = sorted(ids)
+        with self._factory.connection() as conn:
+            for start in range(0, len(ids), ID_CHUNK_SIZE):
+                chunk = ids[start:start + ID_CHUNK_SIZE]
+                query = 'SELECT ' + columns + ' FROM ' + table + ' WHERE ID IN (' + ', '.join(['%s'] * len(chunk)) + ')'
+                cursor = self._factory.cursor(conn)
+                cursor.execute(query, chunk)
+                for record in cursor.fetchall():
+                    records[record[0]] = tuple(record)
+                cursor.close()
+        return records
+
+    def _put_drone(self, record):
+        """ Adds a drone record and indexes it. """
+        id = record[0]
+        self._drones[id] = record
+        if record[4] is not None:
+            self._by_operator[record[4]] = id
+        self._by_filter.setdefault((record[2], rescue_key(record[3])), set()).add(id)
+
+    def _remove_drone(self, id):
+        """ Removes a drone record from the indexes and returns it, or None if there is none. """
+        record = self._drones.pop(id, None)
+        if record is not None:
+            if self._by_operator.get(record[4]) == id:
+                del self._by_operator[record[4]]
+            self._by_filter[(record[2], rescue_key(record[3]))].discard(id)
+        return record
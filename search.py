@@ -0,0 +1,286 @@
+""" In-memory name search for the stores.
+
+A SearchIndex finds names by the prefixes of their words, then by trigram
+similarity so misspelt queries still find something. A TableSearch keeps
+the index of one table's names current through the change log, like the
+replica does (see replica.py). """
+
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict
+import re
+import threading
+
+from replica import DEFAULT_MAX_CHANGES
+
+# Number of matches returned by a search
+DEFAULT_SEARCH_LIMIT = 10
+
+# Least similarity (see name_similarity) of a fuzzy match
+DEFAULT_SIMILARITY = 0.4
+
+# Posting entries a fuzzy search counts, from the query's rarest trigram on
+FUZZY_POSTINGS_BUDGET = 20000
+
+# Candidates scored by a fuzzy search for every match asked for
+CANDIDATES_PER_MATCH = 20
+
+# Number of ids looked up together when re-reading changed rows
+ID_CHUNK_SIZE = 500
+
+split_words = re.compile(r'[\W_]+').split
+
+
+def normalize(text):
+    """ Normalizes a name for searching, ignoring case and extra spaces. """
+    return ' '.join((text or '').split()).casefold()
+
+
+def words(name):
+    """ Returns the distinct words of a normalized name. """
+    return set(word for word in split_words(name) if word)
+
+
+def word_trigrams(word):
+    """ Returns the trigrams of a word, padded so short words and word starts count. """
+    padded = '  ' + word + ' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def trigrams(name):
+    """ Returns the trigrams of all the words of a normalized name. """
+    grams = set()
+    for word in words(name):
+        grams |= word_trigrams(word)
+    return grams
+
+
+def name_similarity(query, name):
+    """ Returns how alike a normalized query is to a normalized name, from 0 to 1.
+
+    Every word of the query is scored against the most alike word of the name,
+    by the Dice coefficient of their trigrams, and the query scores as its
+    worst word. So 'jon' finds 'John Doe' as well as 'John', like a prefix
+    search needs every term to start a word of the name. """
+    name_grams = [word_trigrams(word) for word in words(name)]
+    score = 1.0
+    for word in words(query):
+        grams = word_trigrams(word)
+        score = min(score, max([2 * len(grams & other) / (len(grams) + len(other)) for other in name_grams] or [0.0]))
+    return score
+
+
+class SearchIndex(object):
+    """ Prefix and trigram index over names, by id.
+
+    The (word, id) pairs of all the names are kept sorted in two parallel
+    lists, so the names with a word starting with a prefix are a slice found
+    by bisection, and a pair is found the same way to remove it. Every term
+    of a query must prefix a word of the name. Trigram postings are lists
+    that removals leave stale entries in; matches are always scored against
+    the current name, and the postings are rebuilt once half are stale. """
+
+    def __init__(self):
+        self._names = {}
+        self._words = []
+        self._ids = []
+        self._postings = defaultdict(list)
+        self._size = 0
+        self._stale = 0
+
+    def __len__(self):
+        return len(self._names)
+
+    def build(self, names):
+        """ Replaces the contents of the index with (id, name) pairs. """
+        self._names = dict((id, normalize(name)) for id, name in names)
+        pairs = sorted((word, id) for id, name in self._names.items() for word in words(name))
+        self._words = [word for word, id in pairs]
+        self._ids = [id for word, id in pairs]
+        self._build_postings()
+
+    def add(self, id, name):
+        """ Adds or replaces the name of id. """
+        self.remove(id)
+        name = normalize(name)
+        self._names[id] = name
+        for word in words(name):
+            i = self._position(word, id)
+            self._words.insert(i, word)
+            self._ids.insert(i, id)
+        for trigram in trigrams(name):
+            self._postings[trigram].append(id)
+            self._size += 1
+
+    def remove(self, id):
+        """ Removes the name of id, if there is one. """
+        name = self._names.pop(id, None)
+        if name is None:
+            return
+        for word in words(name):
+            i = self._position(word, id)
+            del self._words[i]
+            del self._ids[i]
+        self._stale += len(trigrams(name))
+        if self._stale * 2 > self._size:
+            self._build_postings()
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT, similarity=DEFAULT_SIMILARITY):
+        """ Returns the ids of up to limit names matching the query: the prefix matches,
+        then the fuzzy matches from the most similar. """
+        query = normalize(query)
+        if query == '':
+            return []
+        matches = self.prefix(query, limit)
+        if len(matches) < limit:
+            found = set(matches)
+            for id, score in self.fuzzy(query, limit, similarity):
+                if id not in found:
+                    matches.append(id)
+                    if len(matches) == limit:
+                        break
+        return matches
+
+    def prefix(self, query, limit=DEFAULT_SEARCH_LIMIT):
+        """ Returns the ids of up to limit names with a word starting with every term
+        of the normalized query, in the order of their words. """
+        terms = words(query)
+        if not terms:
+            return []
+        # walk the narrowest slice, and check the other terms on its names
+        ranges = [(bisect_left(self._words, term), bisect_left(self._words, term + '\U0010ffff')) for term in terms]
+        start, end = min(ranges, key=lambda bounds: bounds[1] - bounds[0])
+        matches = []
+        seen = set()
+        for i in range(start, end):
+            id = self._ids[i]
+            if id in seen:
+                continue
+            seen.add(id)
+            if len(terms) > 1:
+                name_words = words(self._names[id])
+                if not all(any(word.startswith(term) for word in name_words) for term in terms):
+                    continue
+            matches.append(id)
+            if len(matches) == limit:
+                break
+        return matches
+
+    def fuzzy(self, query, limit=DEFAULT_SEARCH_LIMIT, similarity=DEFAULT_SIMILARITY):
+        """ Returns (id, similarity) for up to limit names at least similarity alike the
+        normalized query, from the most similar.
+
+        Candidates are counted from the postings of the query's rarest trigrams,
+        up to FUZZY_POSTINGS_BUDGET entries, so common trigrams do not make the
+        search scan most names. """
+        grams = trigrams(query)
+        postings = sorted((self._postings.get(gram, []) for gram in grams), key=len)
+        counts = Counter()
+        counted = 0
+        for posting in postings:
+            if counted > 0 and counted + len(posting) > FUZZY_POSTINGS_BUDGET:
+                break
+            # even the rarest trigram may be too common to count in full
+            posting = posting[:FUZZY_POSTINGS_BUDGET]
+            counts.update(posting)
+            counted += len(posting)
+
+        scored = []
+        for id, count in counts.most_common(limit * CANDIDATES_PER_MATCH):
+            name = self._names.get(id)
+            if name is None:
+                continue
+            score = name_similarity(query, name)
+            if score >= similarity:
+                scored.append((-score, name, id))
+        scored.sort()
+        return [(id, -score) for score, name, id in scored[:limit]]
+
+    def _position(self, word, id):
+        """ Returns the position of the (word, id) pair in the sorted lists, or where it goes. """
+        start = bisect_left(self._words, word)
+        end = bisect_right(self._words, word, start)
+        return bisect_left(self._ids, id, start, end)
+
+    def _build_postings(self):
+        """ Builds the trigram postings from the names. """
+        self._postings = defaultdict(list)
+        for id, name in self._names.items():
+            for trigram in trigrams(name):
+                self._postings[trigram].append(id)
+        self._size = sum(len(posting) for posting in self._postings.values())
+        self._stale = 0
+
+
+class TableSearch(object):
+    """ SearchIndex over the names of one table, kept current through the change log.
+
+    The name of a row is its name columns joined with spaces. The index is
+    loaded by the first search, and before every search the ChangeVersion
+    counter is checked and the rows changed since are re-read. Inside a
+    transaction the index is only loaded, not refreshed, so it does not pick
+    up writes that may still be rolled back. More than max_changes changed
+    rows make the index reload, as inserting the names one by one into the
+    sorted lists would then cost more. """
+
+    def __init__(self, factory, table, columns, max_changes=DEFAULT_MAX_CHANGES):
+        self.version = None
+        self.max_changes = max_changes
+        self._factory = factory
+        self._table = table
+        self._columns = columns
+        self._index = SearchIndex()
+        self._lock = threading.Lock()
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT, similarity=DEFAULT_SIMILARITY):
+        """ Returns the ids of up to limit rows whose name matches the query (see SearchIndex.search). """
+        with self._lock:
+            if self.version is None or self._factory.current_work() is None:
+                self._refresh()
+            return self._index.search(query, limit, similarity)
+
+    def _refresh(self):
+        """ Brings the index up to date with the table. """
+        if self.version is not None:
+            version = self._factory.current_version()
+            if version == self.version:
+                return
+            if version > self.version:
+                latest, changes = self._factory.changes_since(self.version)
+                ids = set(id for v, table, id, operation in changes if table == self._table)
+                if len(ids) > self.max_changes:
+                    self._reload()
+                    return
+                names = self._read(sorted(ids))
+                for id in ids:
+                    if id in names:
+                        self._index.add(id, names[id])
+                    else:
+                        self._index.remove(id)
+                self.version = latest
+                return
+
+        # first search, or the database went back to an earlier version
+        self._reload()
+
+    def _reload(self):
+        """ Loads the index from the whole table. """
+        version = self._factory.current_version()
+        self._index.build(self._read(None).items())
+        self.version = version
+
+    def _read(self, ids):
+        """ Reads the names of the rows with the given ids (all the rows if None) as a dict by id. """
+        query = 'SELECT ID, ' + ', '.join(self._columns) + ' FROM ' + self._table
+        chunks = [None] if ids is None else [ids[i:i + ID_CHUNK_SIZE] for i in range(0, len(ids), ID_CHUNK_SIZE)]
+        names = {}
+        with self._factory.connection() as conn:
+            for chunk in chunks:
+                cursor = self._factory.cursor(conn)
+                if chunk is None:
+                    cursor.execute(query)
+                else:
+                    cursor.execute(query + ' WHERE ID IN (' + ', '.join(['%s'] * len(chunk)) + ')', chunk)
+                for record in cursor.fetchall():
+                    names[record[0]] = ' '.join(part for part in record[1:] if part is not None)
+                cursor.close()
+        return names
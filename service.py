@@ -0,0 +1,467 @@
+""" HTTP/JSON service over the stores, and a load-test client for it.
+
+Usage:
+    python service.py [database] [-host=127.0.0.1] [-port=8080] [-workers=8] [-replica[=seconds]]
+    python service.py [database] -loadtest [-requests=2000] [-concurrency=8] [-url=http://host:port]
+
+Without a database path the service uses the MySQL server given by
+-mysql-host, -mysql-user and -mysql-database, or by the DALSYS_MYSQL_HOST,
+DALSYS_MYSQL_USER, DALSYS_MYSQL_PASSWORD and DALSYS_MYSQL_DATABASE
+environment variables. The password is only read from the environment.
+
+The service answers on these routes, with JSON bodies:
+    GET    /drones?class=&rescue=&limit=&after_name=&after_id=
+    GET    /drones/<id>
+    POST   /drones                    {"name", "class", "rescue"}
+    PUT    /drones/<id>               {"name", "class", "rescue"}, all optional
+    DELETE /drones/<id>
+    POST   /drones/<id>/allocate      {"first_name", "family_name", "force", "add_operator"}
+    GET    /operators?limit=&after_last_name=&after_id=
+    GET    /operators/<id>
+
+Lists are paged with keyset pagination: the response holds the parameters
+of the next page in "next", which is null after the last page. Requests are
+handled by a pool of worker threads, which share the connection pool of
+one connection factory. With -replica, reads are answered from an in-memory
+copy of the fleet that checks for changes at most every that many seconds.
+With -loadtest and no -url, the service is started on a free local port for
+the test.
+
+Errors reported by the stores are answered with 404 (unknown rows) or 409.
+Any other exception is a fault of the service: it is logged to stderr
+and answered with 500. """
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import http.client
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import traceback
+from urllib.parse import parse_qs, urlsplit
+
+from database import DEFAULT_PAGE_SIZE, MySQLConnectionFactory, SQLiteConnectionFactory
+from drones import Drone, DroneStore
+from migrations import migrate
+from operators import OperatorStore
+
+# Number of threads handling requests, and of pooled connections
+DEFAULT_WORKERS = 8
+
+# Largest page a list request can ask for
+MAX_PAGE_SIZE = 1000
+
+
+class ServiceError(Exception):
+    """ An error answered with an HTTP status. """
+
+    def __init__(self, status, message):
+        super(ServiceError, self).__init__(message)
+        self.status = status
+
+
+def drone_json(drone, operator=None):
+    """ Converts a drone, and optionally its operator's name, to JSON values. """
+    return {
+        'id': drone.id,
+        'name': drone.name,
+        'class': drone.class_type,
+        'rescue': bool(drone.rescue),
+        'operator_id': drone.operator,
+        'operator': operator,
+    }
+
+
+def operator_json(operator, drone=None):
+    """ Converts an operator, and optionally its (id, name, class) drone, to JSON values. """
+    return {
+        'id': operator.id,
+        'first_name': operator.first_name,
+        'family_name': operator.family_name,
+        'date_of_birth': operator.date_of_birth.isoformat() if isinstance(operator.date_of_birth, date) else operator.date_of_birth,
+        'drone_license': operator.drone_license,
+        'rescue_endorsement': bool(operator.rescue_endorsement),
+        'operations': operator.operations,
+        'drone_id': operator.drone,
+        'drone': None if drone is None else {'id': drone[0], 'name': drone[1], 'class': drone[2]},
+    }
+
+
+class FleetService(object):
+    """ The operations of the JSON API, on stores shared by all the requests. """
+
+    ROUTES = [
+        ('GET', re.compile(r'^/drones$'), 'list_drones'),
+        ('POST', re.compile(r'^/drones$'), 'add_drone'),
+        ('GET', re.compile(r'^/drones/(\d+)$'), 'get_drone'),
+        ('PUT', re.compile(r'^/drones/(\d+)$'), 'update_drone'),
+        ('DELETE', re.compile(r'^/drones/(\d+)$'), 'remove_drone'),
+        ('POST', re.compile(r'^/drones/(\d+)/allocate$'), 'allocate'),
+        ('GET', re.compile(r'^/operators$'), 'list_operators'),
+        ('GET', re.compile(r'^/operators/(\d+)$'), 'get_operator'),
+    ]
+
+    def __init__(self, factory):
+        self._drones = DroneStore(factory)
+        self._operators = OperatorStore(factory)
+
+    def handle(self, method, path, query, body):
+        """ Runs the operation for a request and returns (status, JSON value). """
+        for route_method, pattern, name in self.ROUTES:
+            match = pattern.match(path)
+            if match is not None and route_method == method:
+                try:
+                    return getattr(self, name)(query, body, *[int(group) for group in match.groups()])
+                except ServiceError:
+                    raise
+                except Exception as ex:
+                    if type(ex) is not Exception:
+                        # not an error reported by the stores, which raise plain
+                        # exceptions, so it is answered with 500
+                        raise
+                    # the stores report missing rows as unknown, and anything
+                    # else (such as a concurrent change) as a conflict
+                    message = str(ex)
+                    raise ServiceError(404 if message.startswith('Unknown') else 409, message)
+        if any(pattern.match(path) for route_method, pattern, name in self.ROUTES):
+            raise ServiceError(405, f'{method} is not allowed on {path}')
+        raise ServiceError(404, f'No route for {path}')
+
+    def list_drones(self, query, body):
+        """ Lists a page of drones. """
+        class_type = query.get('class', 'all')
+        if class_type != 'all':
+            class_type = self._integer(query, 'class')
+        rescue = query.get('rescue', 'all')
+        if rescue != 'all':
+            rescue = self._integer(query, 'rescue')
+        limit = self._limit(query)
+        after = None
+        if 'after_id' in query:
+            after = (query.get('after_name', ''), self._integer(query, 'after_id'))
+
+        page = self._drones.page(after, limit, class_type, rescue)
+        next_page = None
+        if len(page) == limit:
+            last = page[-1][0]
+            next_page = {'after_name': last.name, 'after_id': last.id}
+        return 200, {'drones': [drone_json(drone, operator) for drone, operator in page], 'next': next_page}
+
+    def get_drone(self, query, body, id):
+        """ Retrieves a drone. """
+        return 200, drone_json(self._drones.get(id))
+
+    def add_drone(self, query, body):
+        """ Adds a drone. """
+        body = self._body(body)
+        if not body.get('name'):
+            raise ServiceError(400, 'Name is required')
+        if body.get('class') not in (1, 2):
+            raise ServiceError(400, 'Class must be 1 or 2')
+        drone = Drone(None, body['name'], body['class'], 1 if body.get('rescue') else 0, None)
+        self._drones.add(drone)
+        return 201, drone_json(drone)
+
+    def update_drone(self, query, body, id):
+        """ Changes the name, class or rescue flag of a drone. """
+        body = self._body(body)
+        drone = self._drones.get(id)
+        if 'name' in body:
+            if not body['name']:
+                raise ServiceError(400, 'Name is required')
+            drone.name = body['name']
+        if 'class' in body:
+            if body['class'] not in (1, 2):
+                raise ServiceError(400, 'Class must be 1 or 2')
+            drone.class_type = body['class']
+        if 'rescue' in body:
+            drone.rescue = 1 if body['rescue'] else 0
+        self._drones.update(drone)
+        return 200, drone_json(drone)
+
+    def remove_drone(self, query, body, id):
+        """ Removes a drone. """
+        self._drones.remove(id)
+        return 204, None
+
+    def allocate(self, query, body, id):
+        """ Allocates a drone to an operator. Validation errors are answered with 409
+        and the list of errors, unless force is set. """
+        body = self._body(body)
+        if not body.get('first_name'):
+            raise ServiceError(400, 'First name is required')
+        action = self._drones.start_allocation(id, body['first_name'], body.get('family_name'),
+                                               bool(body.get('add_operator')))
+        if action.messages != [] and not body.get('force'):
+            return 409, {'error': 'Validation errors', 'messages': action.messages}
+        action.commit()
+        return 200, {'drone': drone_json(action.drone), 'operator': operator_json(action.operator)}
+
+    def list_operators(self, query, body):
+        """ Lists a page of operators. """
+        limit = self._limit(query)
+        after = None
+        if 'after_id' in query:
+            after = (query.get('after_last_name'), self._integer(query, 'after_id'))
+
+        page = self._operators.page(after, limit)
+        next_page = None
+        if len(page) == limit:
+            last = page[-1][0]
+            next_page = {'after_id': last.id}
+            if last.family_name is not None:
+                next_page['after_last_name'] = last.family_name
+        return 200, {'operators': [operator_json(operator, drone) for operator, drone in page], 'next': next_page}
+
+    def get_operator(self, query, body, id):
+        """ Retrieves an operator. """
+        return 200, operator_json(self._operators.get(id))
+
+    def _body(self, body):
+        """ Checks that a request body is a JSON object. """
+        if not isinstance(body, dict):
+            raise ServiceError(400, 'The body must be a JSON object')
+        return body
+
+    def _integer(self, query, name):
+        """ Reads an integer query parameter. """
+        try:
+            return int(query[name])
+        except ValueError:
+            raise ServiceError(400, f'{name} must be a number')
+
+    def _limit(self, query):
+        """ Reads the page size, which defaults to the store's. """
+        if 'limit' not in query:
+            return DEFAULT_PAGE_SIZE
+        limit = self._integer(query, 'limit')
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ServiceError(400, f'limit must be between 1 and {MAX_PAGE_SIZE}')
+        return limit
+
+
+class FleetRequestHandler(BaseHTTPRequestHandler):
+    """ Decodes the HTTP requests for the FleetService of the server. """
+
+    protocol_version = 'HTTP/1.1'
+
+    # a kept-alive connection holds a worker thread, so idle ones are closed
+    timeout = 10
+
+    # the headers and the body are sent separately, which Nagle's algorithm
+    # would hold back waiting for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_PUT(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def _handle(self):
+        """ Runs the request and writes the JSON response. """
+        url = urlsplit(self.path)
+        query = dict((name, values[-1]) for name, values in parse_qs(url.query).items())
+        try:
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+            except ValueError:
+                raise ServiceError(400, 'The Content-Length is not a number')
+            body = None
+            if length > 0:
+                try:
+                    body = json.loads(self.rfile.read(length))
+                except ValueError:
+                    raise ServiceError(400, 'The body is not valid JSON')
+            status, value = self.server.service.handle(self.command, url.path, query, body)
+        except ServiceError as ex:
+            status, value = ex.status, {'error': str(ex)}
+        except Exception:
+            sys.stderr.write(f'Error handling {self.command} {self.path}:\n{traceback.format_exc()}')
+            status, value = 500, {'error': 'Internal server error'}
+
+        data = b'' if value is None else json.dumps(value).encode('utf-8')
+        self.send_response(status)
+        if value is not None:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        # the load test would otherwise log every request
+        pass
+
+
+class PooledHTTPServer(HTTPServer):
+    """ HTTP server that handles its connections on a fixed pool of worker threads. """
+
+    def __init__(self, address, service, workers=DEFAULT_WORKERS):
+        super(PooledHTTPServer, self).__init__(address, FleetRequestHandler)
+        self.service = service
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='dalsys-http')
+
+    def process_request(self, request, client_address):
+        """ Hands the connection to a worker thread. """
+        self._executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        """ Serves all the requests of a connection. """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        """ Closes the socket and waits for the workers to finish. """
+        super(PooledHTTPServer, self).server_close()
+        self._executor.shutdown(wait=True)
+
+
+def load_test(host, port, requests=2000, concurrency=DEFAULT_WORKERS, max_id=None):
+    """ Sends read requests from concurrency threads, each keeping one connection
+    open, and returns the throughput and latency percentiles as a dict.
+
+    The requests are a mix of drone pages, drones by id (up to max_id) and
+    operator pages. """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker(seed):
+        rng = random.Random(seed)
+        conn = http.client.HTTPConnection(host, port)
+        mine = []
+        failed = 0
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    break
+            choice = rng.random()
+            if choice < 0.4 and max_id:
+                path = f'/drones/{rng.randint(1, max_id)}'
+            elif choice < 0.8:
+                path = f'/drones?limit=50&class={rng.randint(1, 2)}'
+            else:
+                path = '/operators?limit=50'
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                if response.status >= 500:
+                    failed += 1
+            except (OSError, http.client.HTTPException):
+                failed += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port)
+            mine.append((time.perf_counter() - start) * 1000)
+        conn.close()
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] if latencies else 0.0
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': latencies[-1] if latencies else 0.0,
+    }
+
+
+def main(argv):
+    options = {}
+    paths = []
+    for arg in argv:
+        if arg.startswith('-'):
+            name, equals, value = arg.lstrip('-').partition('=')
+            options[name] = value if equals else True
+        else:
+            paths.append(arg)
+    workers = int(options.get('workers', DEFAULT_WORKERS))
+
+    if 'loadtest' in options and 'url' in options:
+        url = urlsplit(options['url'])
+        report = load_test(url.hostname, url.port or 80, int(options.get('requests', 2000)),
+                           int(options.get('concurrency', DEFAULT_WORKERS)))
+        print(json.dumps(report, indent=2))
+        return 1 if report['errors'] else 0
+
+    if len(paths) > 0:
+        # use the embedded SQLite database at the given path
+        factory = SQLiteConnectionFactory(paths[0], pool_size=workers)
+    else:
+        factory = MySQLConnectionFactory(
+            pool_size=workers,
+            user=options.get('mysql-user') or os.environ.get('DALSYS_MYSQL_USER', ''),
+            password=os.environ.get('DALSYS_MYSQL_PASSWORD', ''),
+            host=options.get('mysql-host') or os.environ.get('DALSYS_MYSQL_HOST', ''),
+            database=options.get('mysql-database') or os.environ.get('DALSYS_MYSQL_DATABASE', ''),
+            charset='utf8')
+    migrate(factory)
+    if 'replica' in options:
+        # answer the reads from an in-memory copy of the fleet
+        factory.replicate(0.0 if options['replica'] is True else float(options['replica']))
+
+    if 'loadtest' in options:
+        server = PooledHTTPServer(('127.0.0.1', 0), FleetService(factory), workers)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        with factory.connection() as conn:
+            cursor = factory.cursor(conn)
+            cursor.execute('SELECT MAX(ID) FROM DroneStore')
+            max_id = cursor.fetchall()[0][0]
+            cursor.close()
+        try:
+            report = load_test('127.0.0.1', server.server_address[1], int(options.get('requests', 2000)),
+                               int(options.get('concurrency', DEFAULT_WORKERS)), max_id)
+        finally:
+            server.shutdown()
+            server.server_close()
+        print(json.dumps(report, indent=2))
+        return 1 if report['errors'] else 0
+
+    address = (options.get('host', '127.0.0.1'), int(options.get('port', 8080)))
+    server = PooledHTTPServer(address, FleetService(factory), workers)
+    print(f'Serving on http://{address[0]}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
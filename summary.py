@@ -0,0 +1,193 @@
+""" Fleet summaries kept up to date by the store writes.
+
+DroneSummary counts the drones by (class, rescue, allocated) and
+OperatorSummary counts the operators by (license, endorsement), so a report
+reads a handful of rows however big the fleet is. The writes keep them
+current in their own transaction: the rows about to change are locked and
+their keys read before the write (lock_keys), the writer passes their keys
+after it, and only the net changes of the counts are written (recount). """
+
+from collections import Counter, OrderedDict
+
+# table -> (summary table, summary columns, key expressions of a row of the table)
+SUMMARIES = OrderedDict([
+    ('DroneStore', ('DroneSummary', ('ClassType', 'Rescue', 'Allocated'), (
+        '{0}.ClassType',
+        'CASE WHEN {0}.Rescue = 1 THEN 1 ELSE 0 END',
+        'CASE WHEN {0}.OperatorID IS NULL THEN 0 ELSE 1 END'))),
+    ('OperatorStore', ('OperatorSummary', ('DroneLicense', 'RescueEndorsement'), (
+        'COALESCE({0}.DroneLicense, 0)',
+        'CASE WHEN {0}.RescueEndorsement = 1 THEN 1 ELSE 0 END'))),
+])
+
+# Number of ids read together by one statement
+ID_CHUNK_SIZE = 500
+
+
+def count_query(table):
+    """ Returns the GROUP BY query that counts the rows of a table by their summary key. """
+    summary, columns, keys = SUMMARIES[table]
+    keys = ', '.join(key.format(table) for key in keys)
+    return f'SELECT {keys}, COUNT(*) FROM {table} GROUP BY {keys}'
+
+
+def populate_statement(table):
+    """ Returns the statement that fills the empty summary of a table. """
+    summary, columns, keys = SUMMARIES[table]
+    return f'INSERT INTO {summary} ({", ".join(columns)}, Count) ' + count_query(table)
+
+
+def _ids_by_table(changes):
+    """ Groups the ids of (table, id, operation) changes by summarized table. """
+    ids = OrderedDict((table, set()) for table in SUMMARIES)
+    for table, id, operation in changes:
+        if table in ids and id is not None:
+            ids[table].add(int(id))
+    return [(table, sorted(table_ids)) for table, table_ids in ids.items() if table_ids]
+
+
+def _chunks(ids):
+    """ Splits ids into lists of up to ID_CHUNK_SIZE. """
+    return [ids[i:i + ID_CHUNK_SIZE] for i in range(0, len(ids), ID_CHUNK_SIZE)]
+
+
+def drone_key(class_type, rescue, operator):
+    """ Returns the summary key of a drone with the given values, as the key
+    expressions of DroneStore compute it. """
+    return ('DroneSummary', int(class_type), 1 if rescue == 1 else 0, 0 if operator is None else 1)
+
+
+def operator_key(drone_license, rescue_endorsement):
+    """ Returns the summary key of an operator with the given values, as the key
+    expressions of OperatorStore compute it. """
+    return ('OperatorSummary', 0 if drone_license is None else int(drone_license), 1 if rescue_endorsement == 1 else 0)
+
+
+# table -> (columns of a row, function making its summary key from them)
+ROW_KEYS = {
+    'DroneStore': (('ClassType', 'Rescue', 'OperatorID'), drone_key),
+    'OperatorStore': (('DroneLicense', 'RescueEndorsement'), operator_key),
+}
+
+
+def _read_keys(factory, conn, changes, lock):
+    """ Reads the summary keys of the rows of (table, id, operation) changes as a
+    dict by (table, id), locking the rows if lock is set. """
+    keys = {}
+    for table, ids in _ids_by_table(changes):
+        columns, make_key = ROW_KEYS[table]
+        cursor = None if lock else factory.cursor(conn)
+        for chunk in _chunks(ids):
+            query = f'SELECT ID, {", ".join(columns)} FROM {table} WHERE ID IN ({", ".join(["%s"] * len(chunk))})'
+            if lock:
+                records = factory.select_for_update(conn, query, chunk)
+            else:
+                cursor.execute(query, chunk)
+                records = cursor.fetchall()
+            for record in records:
+                keys[(table, record[0])] = make_key(*record[1:])
+        if cursor is not None:
+            cursor.close()
+    return keys
+
+
+def lock_keys(factory, conn, changes):
+    """ Locks the rows of (table, id, operation) changes until the end of the
+    transaction and returns their summary keys before the write, as a dict by
+    (table, id). Must run on the connection of the write, before the rows are
+    changed, so no other writer can move them in the meantime. """
+    return _read_keys(factory, conn, changes, True)
+
+
+def recount(factory, conn, changes, before=None, after=None):
+    """ Moves the rows of (table, id, operation) changes from their summary keys
+    before the write to their keys after it. before and after are dicts of keys
+    by (table, id), like lock_keys returns; a row in neither keeps its count. If
+    after is None, the keys of the rows that were not deleted are read. Must run
+    on the connection of the write, after the rows are changed. """
+    if after is None:
+        after = _read_keys(factory, conn, [change for change in changes if change[2] != 'delete'], False)
+    counts = Counter(after.values())
+    counts.subtract((before or {}).values())
+    for summary, columns, keys in SUMMARIES.values():
+        # in key order, so concurrent writers lock the summary rows in the same order
+        rows = sorted(key[1:] + (count,) for key, count in counts.items() if key[0] == summary and count != 0)
+        if rows != []:
+            factory.add_counts(conn, summary, columns, rows)
+
+
+def read_summary(factory):
+    """ Returns the fleet counts from the summary tables as a dict.
+
+    The counts of the drones are by class, rescue flag and allocation, and
+    those of the operators by license (0 for none) and rescue endorsement. """
+    report = {
+        'drones': 0, 'drones_by_class': {}, 'drones_by_rescue': {0: 0, 1: 0}, 'drones_by_allocated': {0: 0, 1: 0},
+        'operators': 0, 'operators_by_license': {}, 'operators_by_endorsement': {0: 0, 1: 0},
+    }
+    with factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        cursor.execute('SELECT ClassType, Rescue, Allocated, Count FROM DroneSummary WHERE Count <> 0')
+        for class_type, rescue, allocated, count in cursor.fetchall():
+            report['drones'] += count
+            report['drones_by_class'][class_type] = report['drones_by_class'].get(class_type, 0) + count
+            report['drones_by_rescue'][rescue] += count
+            report['drones_by_allocated'][allocated] += count
+        cursor.execute('SELECT DroneLicense, RescueEndorsement, Count FROM OperatorSummary WHERE Count <> 0')
+        for license, endorsement, count in cursor.fetchall():
+            report['operators'] += count
+            report['operators_by_license'][license] = report['operators_by_license'].get(license, 0) + count
+            report['operators_by_endorsement'][endorsement] += count
+        cursor.close()
+    report['drones_by_class'] = dict(sorted(report['drones_by_class'].items()))
+    report['operators_by_license'] = dict(sorted(report['operators_by_license'].items()))
+    return report
+
+
+def summary_lines(report):
+    """ Returns the lines of a text report of read_summary's counts. """
+    def share(count, total):
+        return f'{count: >9} {count * 100 / total if total else 0: >5.1f}%'
+
+    drones = report['drones']
+    operators = report['operators']
+    lines = [f'{"Drones": <24}{drones: >9}']
+    for class_type, count in report['drones_by_class'].items():
+        lines.append(f'  {"Class " + str(class_type): <22}{share(count, drones)}')
+    lines.append(f'  {"Rescue": <22}{share(report["drones_by_rescue"][1], drones)}')
+    lines.append(f'  {"Allocated": <22}{share(report["drones_by_allocated"][1], drones)}')
+    lines.append(f'  {"Unallocated": <22}{share(report["drones_by_allocated"][0], drones)}')
+    lines.append(f'{"Operators": <24}{operators: >9}')
+    for license, count in report['operators_by_license'].items():
+        label = 'No license' if license == 0 else f'Class {license} license'
+        lines.append(f'  {label: <22}{share(count, operators)}')
+    lines.append(f'  {"Rescue endorsed": <22}{share(report["operators_by_endorsement"][1], operators)}')
+    return lines
+
+
+def rebuild(factory):
+    """ Counts the summaries again from the tables, e.g. after writes made without the stores. """
+    with factory.transaction(), factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        for table, (summary, columns, keys) in SUMMARIES.items():
+            cursor.execute(f'DELETE FROM {summary}')
+            cursor.execute(populate_statement(table))
+        cursor.close()
+
+
+def check(factory):
+    """ Compares the summaries with GROUP BY counts of the tables, and returns
+    (summary table, key, summary count, actual count) for every difference. """
+    differences = []
+    with factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        for table, (summary, columns, keys) in SUMMARIES.items():
+            cursor.execute(f'SELECT {", ".join(columns)}, Count FROM {summary}')
+            counted = dict((tuple(record[:-1]), record[-1]) for record in cursor.fetchall())
+            cursor.execute(count_query(table))
+            actual = dict((tuple(record[:-1]), record[-1]) for record in cursor.fetchall())
+            for key in sorted(set(counted) | set(actual)):
+                if counted.get(key, 0) != actual.get(key, 0):
+                    differences.append((summary, key, counted.get(key, 0), actual.get(key, 0)))
+        cursor.close()
+    return differences
@@ -0,0 +1,36 @@
+""" Fixtures shared by the tests, which run the stores on a temporary SQLite database. """
+
+import os
+import sys
+
+import pytest
+
+# the modules are at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import SQLiteConnectionFactory
+from drones import Drone, DroneStore
+from migrations import migrate
+from operators import Operator, OperatorStore
+
+
+@pytest.fixture
+def factory(tmp_path):
+    """ A migrated SQLite database in a temporary directory. """
+    factory = SQLiteConnectionFactory(str(tmp_path / 'fleet.db'))
+    migrate(factory)
+    return factory
+
+
+@pytest.fixture
+def fleet(factory):
+    """ The drone store of a small fleet: drones 1-4 and operators 1-3, with operator 2
+    controlling drone 3. Drone 2 and operator 3 are rescue ones. """
+    drones = DroneStore(factory)
+    drones.add_many([Drone(None, 'Alpha', 1, 0, None), Drone(None, 'Bravo', 2, 1, None),
+                     Drone(None, 'Charlie', 1, 0, None), Drone(None, 'Delta', 2, 0, None)])
+    OperatorStore(factory).add_many([Operator(None, 'John', 'Doe', drone_license=1),
+                                     Operator(None, 'Jane', 'Roe', drone_license=1),
+                                     Operator(None, 'Jake', 'Poe', drone_license=2, rescue_endorsement=1, operations=5)])
+    drones.allocate(3, ['Jane', 'Roe'])
+    return drones
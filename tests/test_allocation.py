@@ -0,0 +1,52 @@
+import pytest
+
+from allocation import AllocationEngine
+from drones import Drone
+from operators import Operator, OperatorStore
+
+
+def matching(plan):
+    return sorted((drone.id, operator.id) for drone, operator in plan.assignments)
+
+
+def reasons(plan):
+    return sorted((drone.id, reason) for drone, reason in plan.unmatched)
+
+
+def test_plan_is_a_maximum_matching(factory, fleet):
+    plan = AllocationEngine(factory).plan()
+    # Jake is the only class 2 operator and the only one who can fly the rescue drone
+    assert matching(plan) == [(1, 1), (2, 3)]
+    assert reasons(plan) == [(4, 'All the eligible operators have been allocated a drone')]
+
+
+def test_standard_drones_take_unendorsed_operators_first(factory, fleet):
+    fleet.remove(2)
+    OperatorStore(factory).add_many([Operator(None, 'Joe', 'Bloggs', drone_license=2)])
+    assert matching(AllocationEngine(factory).plan()) == [(1, 1), (4, 4)]
+
+
+def test_unmatched_reasons(factory, fleet):
+    fleet.add_many([Drone(None, 'Echo', 3, 0, None), Drone(None, 'Foxtrot', 1, 1, None)])
+    plan = AllocationEngine(factory).plan()
+    assert (5, 'No free operator has a class 3 license') in reasons(plan)
+    assert (6, 'No free operator with a class 1 license has a rescue endorsement') in reasons(plan)
+
+
+def test_commit_allocates_the_plan(factory, fleet):
+    plan = AllocationEngine(factory).run()
+    assert matching(plan) == [(1, 1), (2, 3)]
+    assert fleet.get(1).operator == 1
+    assert fleet.get(2).operator == 3
+    assert fleet._operators.get(3).drone == 2
+    assert AllocationEngine(factory).plan().assignments == []
+
+
+def test_commit_writes_nothing_if_the_fleet_changed(factory, fleet):
+    engine = AllocationEngine(factory)
+    plan = engine.plan()
+    fleet.allocate(1, ['John', 'Doe'])
+    with pytest.raises(Exception, match='The fleet changed during the allocation'):
+        engine.commit(plan)
+    assert fleet.get(2).operator is None
+    assert fleet._operators.get(3).drone is None
@@ -0,0 +1,25 @@
+from app import stable_rows
+
+
+def is_increasing(positions, indexes):
+    kept = [positions[index] for index in sorted(indexes)]
+    return kept == sorted(kept)
+
+
+def test_stable_rows_keep_a_longest_increasing_run():
+    positions = [3, 1, 2, 0, 4]
+    stable = stable_rows(positions)
+    assert stable == {1, 2, 4}
+    assert is_increasing(positions, stable)
+
+
+def test_stable_rows_of_sorted_and_reversed_rows():
+    assert stable_rows([]) == set()
+    assert stable_rows([0, 1, 2, 3]) == {0, 1, 2, 3}
+    assert len(stable_rows([3, 2, 1, 0])) == 1
+
+
+def test_one_moved_row_moves_alone():
+    # the last row moved to the top, every other row stays in place
+    positions = [1, 2, 3, 4, 0]
+    assert stable_rows(positions) == {0, 1, 2, 3}
@@ -0,0 +1,90 @@
+import cache
+from cache import LRUCache, cache_key
+from database import SQLiteConnectionFactory
+from drones import Drone, DroneStore
+
+
+class Clock(object):
+    """ A monotonic clock that only moves when told to. """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+def test_evicts_the_least_recently_used():
+    entries = LRUCache(2)
+    entries.put(1, 'a')
+    entries.put(2, 'b')
+    assert entries.get(1) == 'a'
+    entries.put(3, 'c')
+    assert entries.get(2) is None
+    assert entries.get(1) == 'a'
+    assert entries.get(3) == 'c'
+    assert entries.stats() == {'hits': 3, 'misses': 1, 'evictions': 1, 'size': 2, 'capacity': 2}
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, 'time', clock)
+    entries = LRUCache(10, ttl=5)
+    entries.put(1, 'a')
+    clock.now = 5
+    assert entries.get(1) == 'a'
+    clock.now = 5.5
+    assert entries.get(1) is None
+    assert entries.stats()['size'] == 0
+
+
+def test_invalidate_and_clear():
+    entries = LRUCache(10)
+    entries.put(1, 'a')
+    entries.put(2, 'b')
+    entries.invalidate(1)
+    entries.invalidate(3)
+    assert entries.get(1) is None
+    entries.clear()
+    assert entries.get(2) is None
+
+
+def test_zero_capacity_disables_the_cache():
+    entries = LRUCache(0)
+    entries.put(1, 'a')
+    assert entries.get(1) is None
+
+
+def test_cache_key():
+    assert cache_key('0004') == 4
+    assert cache_key('x') is None
+    assert cache_key(None) is None
+
+
+def test_store_writes_update_the_cache(factory, fleet):
+    drone = fleet.get(1)
+    drone.name = 'Zulu'
+    fleet.update(drone)
+    assert fleet.get(1).name == 'Zulu'
+    fleet.remove(1)
+    assert fleet.cache_stats()['size'] < 4
+
+
+def test_writes_of_other_clients_reach_the_cache(factory, fleet):
+    # a second client on the same database, as another process would be
+    other = DroneStore(SQLiteConnectionFactory(factory.database))
+    factory.cache_interval = 60
+    assert fleet.get(1).name == 'Alpha'
+    assert fleet.get(2).name == 'Bravo'
+
+    drone = other.get(1)
+    drone.name = 'Zulu'
+    other.update(drone)
+    other.add(Drone(None, 'Echo', 1, 0, None))
+    # within the interval the cached drone may be stale
+    assert fleet.get(1).name == 'Alpha'
+
+    factory.cache_interval = 0
+    assert fleet.get(1).name == 'Zulu'
+    assert fleet.get(2).name == 'Bravo'
+    assert fleet.cache_stats()['hits'] >= 2
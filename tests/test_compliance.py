@@ -0,0 +1,62 @@
+from datetime import date
+
+import pytest
+
+from compliance import RULES, age_limit, scan
+from operators import Operator, OperatorStore
+
+TODAY = date(2026, 10, 18)
+
+
+def violations(factory, rules=None):
+    """ Returns the (rule, drone id, operator id) of the violations, checking they come rule by rule. """
+    found = [(violation.rule, violation.drone_id, violation.operator_id) for violation in scan(factory, rules, TODAY)]
+    order = list(rules or RULES)
+    assert [order.index(rule) for rule, drone_id, operator_id in found] == sorted(order.index(rule) for rule, drone_id, operator_id in found)
+    return sorted(found)
+
+
+def break_rules(factory):
+    """ Makes the fleet break every rule once, as overridden checks or other clients could. """
+    with factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        # Jake, with a class 2 license, flies class 1 drone 1
+        cursor.execute('UPDATE DroneStore SET OperatorID = 3 WHERE ID = 1')
+        cursor.execute('UPDATE OperatorStore SET DroneID = 1 WHERE ID = 3')
+        # Jane, without an endorsement, flies drone 3 which becomes a rescue drone
+        cursor.execute('UPDATE DroneStore SET Rescue = 1 WHERE ID = 3')
+        # drone 4 and John point at different pairings, and John has a class 1 license
+        cursor.execute('UPDATE DroneStore SET OperatorID = 1 WHERE ID = 4')
+        cursor.execute('UPDATE OperatorStore SET DroneID = 2 WHERE ID = 1')
+        cursor.close()
+    OperatorStore(factory).add_many([
+        Operator(None, 'Kim', 'Young', date(2006, 10, 19), drone_license=2, rescue_endorsement=1, operations=4),
+        Operator(None, 'Kat', 'Young', date(2006, 10, 18), drone_license=2)])
+
+
+def test_a_compliant_fleet_has_no_violations(factory, fleet):
+    assert violations(factory) == []
+
+
+def test_every_rule(factory, fleet):
+    break_rules(factory)
+    assert violations(factory) == [('age', None, 4), ('drone-link', 4, 1), ('endorsement', 3, 2), ('license', 1, 3),
+                                   ('license', 4, 1), ('operations', None, 4), ('operator-link', 2, 1)]
+    violation = next(scan(factory, ['endorsement'], TODAY))
+    assert list(violation.values().items()) == [
+        ('rule', 'endorsement'), ('drone_id', 3), ('drone', 'Charlie'), ('operator_id', 2), ('operator', 'Jane Roe'),
+        ('message', RULES['endorsement'][0])]
+
+
+def test_selected_rules(factory, fleet):
+    break_rules(factory)
+    assert violations(factory, ['age', 'license']) == [('age', None, 4), ('license', 1, 3), ('license', 4, 1)]
+    with pytest.raises(Exception, match='Unknown rule speed'):
+        violations(factory, ['license', 'speed'])
+
+
+def test_age_limit():
+    assert age_limit(TODAY) == date(2006, 10, 18)
+    assert age_limit(date(2024, 2, 29)) == date(2004, 2, 29)
+    # 2100 is not a leap year
+    assert age_limit(date(2120, 2, 29)) == date(2100, 2, 28)
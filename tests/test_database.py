@@ -0,0 +1,51 @@
+from drones import Drone
+
+
+def test_changes_since_none_only_returns_the_version(factory, fleet):
+    version = factory.current_version()
+    assert factory.changes_since(None) == (version, [])
+    assert factory.changes_since(version) == (version, [])
+
+
+def test_changes_are_logged_in_version_order(factory, fleet):
+    version = factory.current_version()
+    drone = fleet.get(1)
+    drone.name = 'Zulu'
+    fleet.update(drone)
+    fleet.remove(2)
+    latest, changes = factory.changes_since(version)
+    assert latest == version + 2
+    assert [(v - version, table, id, operation) for v, table, id, operation in changes] == [
+        (1, 'DroneStore', 1, 'update'), (2, 'DroneStore', 2, 'delete')]
+    assert factory.changes_since(latest) == (latest, [])
+
+
+def test_log_changes_without_changes(factory):
+    version = factory.current_version()
+    with factory.connection() as conn:
+        assert factory.log_changes(conn, []) is None
+        assert factory.log_changes(conn, [('DroneStore', None, 'update')]) is None
+    assert factory.current_version() == version
+
+
+def test_drone_changes_include_the_operator_renames(factory, fleet):
+    version = factory.current_version()
+    fleet.add(Drone(None, 'Echo', 1, 0, None))
+    fleet.remove(1)
+    operator = fleet._operators.get(2)
+    operator.first_name = 'Janet'
+    fleet._operators.update(operator)
+    latest, changed, removed = fleet.changes_since(version)
+    assert latest == factory.current_version()
+    assert sorted((drone.id, name) for drone, name in changed) == [(3, 'Janet Roe'), (5, None)]
+    assert removed == [1]
+
+
+def test_operator_changes_include_their_drones(factory, fleet):
+    version = factory.current_version()
+    drone = fleet.get(3)
+    drone.name = 'Charles'
+    fleet.update(drone)
+    latest, changed, removed = fleet._operators.changes_since(version)
+    assert [(operator.id, drone) for operator, drone in changed] == [(2, (3, 'Charles', 1))]
+    assert removed == []
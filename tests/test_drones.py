@@ -0,0 +1,129 @@
+import sqlite3
+
+import pytest
+
+from drones import Drone
+from operators import Operator
+
+
+@pytest.fixture(autouse=True)
+def no_cache_checks(factory):
+    # the periodic check of the change log for the caches is not part of the bounds
+    factory.cache_interval = float('inf')
+
+
+def round_trips(stats, command):
+    """ Returns the number of queries and of commits the command ran. """
+    queries = commits = 0
+    for statement in stats.statements():
+        if statement['query'] == 'COMMIT':
+            commits += statement['count']
+        else:
+            queries += statement['count']
+    assert [entry['statements'] for entry in stats.commands() if entry['command'] == command] == [queries + commits]
+    return queries, commits
+
+
+def test_allocate_round_trips(factory, fleet):
+    fleet._operators.find_by_name('John', 'Doe')
+    stats = factory.instrument()
+    with stats.command('allocate'):
+        fleet.allocate(1, ['John', 'Doe'])
+
+    queries, commits = round_trips(stats, 'allocate')
+    # two queries before the prompts and at most ten statements after them
+    assert queries <= 2 + 10
+    assert commits <= 2 + 1
+    assert fleet.get(1).operator == 1
+
+
+def test_reallocate_round_trips(factory, fleet):
+    fleet.ask = lambda prompt: 'y'
+    fleet.allocate(1, ['John', 'Doe'])
+    fleet._operators.find_by_name('Jane', 'Roe')
+    stats = factory.instrument()
+    with stats.command('allocate'):
+        # John loses drone 1 and Jane lets go of drone 3
+        fleet.allocate(1, ['Jane', 'Roe'])
+
+    queries, commits = round_trips(stats, 'allocate')
+    assert queries <= 2 + 10
+    assert commits <= 2 + 1
+    assert fleet.get(1).operator == 2
+    assert fleet.get(3).operator is None
+    assert fleet._operators.get(1).drone is None
+    assert fleet._operators.get(2).drone == 1
+
+
+def test_allocate_new_operator_round_trips(factory, fleet):
+    fleet.ask = lambda prompt: 'y'
+    fleet._operators.find_by_name('John', 'Doe')
+    fleet._operators.search('John Doe')
+    stats = factory.instrument()
+    with stats.command('allocate'):
+        fleet.allocate(4, ['Jill', 'Moe'])
+
+    queries, commits = round_trips(stats, 'allocate')
+    # the name lookup and the refresh of the search index come on top
+    assert queries <= 2 + 10 + 1 + 2
+    assert commits <= 2 + 1 + 2
+    operator = fleet._operators.find_by_name('Jill', 'Moe')
+    assert operator.drone == 4
+    assert fleet.get(4).operator == operator.id
+
+
+def test_list_with_operators_round_trips(factory, fleet):
+    stats = factory.instrument()
+    with stats.command('list'):
+        drones = list(fleet.list_with_operators())
+
+    assert round_trips(stats, 'list') == (1, 1)
+    assert [(drone.id, operator) for drone, operator in drones if operator is not None] == [(3, 'Jane Roe')]
+
+
+def test_savepoint_holds_the_write_lock(factory, fleet):
+    other = sqlite3.connect(factory.database, timeout=0)
+    with factory.transaction(), factory.savepoint():
+        # a batch command that only reads still keeps other writers out, so
+        # its select_for_update reads cannot go stale
+        fleet.get(1)
+        with pytest.raises(sqlite3.OperationalError):
+            other.execute('BEGIN IMMEDIATE')
+    other.execute('BEGIN IMMEDIATE')
+    other.rollback()
+    other.close()
+
+
+def all_pages(store, limit, **filters):
+    """ Returns the pages of store.page, following the keyset of each last row. """
+    pages = []
+    after = None
+    while True:
+        page = store.page(after, limit, **filters)
+        if page == []:
+            return pages
+        pages.append([(drone.id, drone.name) for drone, operator in page])
+        after = (page[-1][0].name, page[-1][0].id)
+
+
+def test_keyset_pages(factory, fleet):
+    fleet.add_many([Drone(None, 'Alpha', 2, 0, None), Drone(None, 'Alpha', 1, 1, None), Drone(None, 'Echo', 1, 0, None)])
+    # drones with the same name are ordered by id, so no page repeats or skips one
+    assert all_pages(fleet, 2) == [[(1, 'Alpha'), (5, 'Alpha')], [(6, 'Alpha'), (2, 'Bravo')],
+                                   [(3, 'Charlie'), (4, 'Delta')], [(7, 'Echo')]]
+    assert all_pages(fleet, 2, class_type=1) == [[(1, 'Alpha'), (6, 'Alpha')], [(3, 'Charlie'), (7, 'Echo')]]
+    assert all_pages(fleet, 10, rescue=1) == [[(6, 'Alpha'), (2, 'Bravo')]]
+
+
+def test_operator_keyset_pages(factory, fleet):
+    operators = fleet._operators
+    operators.add_many([Operator(None, 'Jim', 'Doe'), Operator(None, 'Ann', 'Adams')])
+    pages = []
+    after = None
+    while True:
+        page = operators.page(after, 2)
+        if page == []:
+            break
+        pages.append([operator.id for operator, drone in page])
+        after = (page[-1][0].family_name, page[-1][0].id)
+    assert pages == [[5, 1], [4, 3], [2]]
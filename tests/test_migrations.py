@@ -0,0 +1,17 @@
+from database import SQLiteConnectionFactory
+from migrations import MIGRATIONS, check_indexes, migrate
+
+
+def test_migrate_applies_every_version_once(tmp_path):
+    factory = SQLiteConnectionFactory(str(tmp_path / 'fleet.db'))
+    assert migrate(factory) == [version for version, description, statement in MIGRATIONS]
+    assert migrate(factory) == []
+    with factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        cursor.execute('SELECT Version FROM SchemaMigrations ORDER BY Version')
+        assert [record[0] for record in cursor.fetchall()] == sorted(version for version, description, statement in MIGRATIONS)
+
+
+def test_store_queries_use_their_indexes(factory):
+    failed = [(description, indexes) for description, indexes, ok in check_indexes(factory) if not ok]
+    assert failed == []
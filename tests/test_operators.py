@@ -0,0 +1,30 @@
+from migrations import check_indexes
+from operators import Operator, OperatorStore
+
+
+def add_elsewhere(factory, first_name, family_name):
+    """ Adds an operator without the store, as another client would, and returns its id. """
+    with factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        cursor.execute('INSERT INTO OperatorStore (FirstName, LastName) VALUES (%s, %s)', (first_name, family_name))
+        return cursor.lastrowid
+
+
+def test_find_by_name_ignores_case(factory):
+    operators = OperatorStore(factory)
+    operators.add_many([Operator(None, 'John', 'Doe', drone_license=1)])
+    assert operators.find_by_name('JOHN', ' doe').id == 1
+
+
+def test_database_lookup_ignores_case_like_the_index(factory):
+    operators = OperatorStore(factory)
+    assert operators.find_by_name('John', 'Doe') is None
+    # the name index is loaded, so the new operator is only in the database
+    id = add_elsewhere(factory, 'Jane', 'McRoe')
+    assert operators.find_by_name('jane', 'MCROE').id == id
+    assert operators.find_by_name('Jane', 'McRoe').id == id
+
+
+def test_database_lookup_uses_an_index(factory):
+    results = dict((description, ok) for description, indexes, ok in check_indexes(factory))
+    assert results['Operator by name']
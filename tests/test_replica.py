@@ -0,0 +1,75 @@
+from database import SQLiteConnectionFactory
+from drones import Drone, DroneStore
+from operators import Operator
+
+
+def listing(fleet):
+    return [(drone.id, drone.name, drone.operator, name) for drone, name in fleet.list_with_operators()]
+
+
+def operator_listing(fleet):
+    return [(operator.id, drone) for operator, drone in fleet._operators.list_with_drones()]
+
+
+def pages(fleet):
+    pages = [fleet.page(None, 2, class_type=1), fleet.page(('Alpha', 5), 3, rescue=0)]
+    return [[(drone.id, name) for drone, name in page] for page in pages]
+
+
+def test_replica_reads_like_the_database(factory, fleet):
+    fleet.add_many([Drone(None, 'Alpha', 2, None, None), Drone(None, 'alpha', 1, 1, None)])
+    drones = listing(fleet)
+    operators = operator_listing(fleet)
+    drone_pages = pages(fleet)
+    factory.replicate()
+    assert listing(fleet) == drones
+    assert operator_listing(fleet) == operators
+    assert pages(fleet) == drone_pages
+    assert fleet.get(3).operator == 2
+    assert factory.replica.stats()['reloads'] == 1
+
+
+def test_replica_applies_the_changes(factory, fleet):
+    replica = factory.replicate()
+    listing(fleet)
+    drone = fleet.get(1)
+    drone.name = 'Zulu'
+    fleet.update(drone)
+    fleet.remove(2)
+    fleet.allocate(4, ['Jake', 'Poe'])
+    assert listing(fleet) == [(3, 'Charlie', 2, 'Jane Roe'), (4, 'Delta', 3, 'Jake Poe'), (1, 'Zulu', None, None)]
+    assert replica.stats()['reloads'] == 1
+    assert replica.stats()['refreshes'] >= 1
+    assert replica.stats()['version'] == factory.current_version()
+
+
+def test_replica_reloads_after_many_changes_or_clear(factory, fleet):
+    replica = factory.replicate(max_changes=2)
+    listing(fleet)
+    fleet.add_many([Drone(None, 'Echo', 1, 0, None), Drone(None, 'Foxtrot', 1, 0, None),
+                    Drone(None, 'Golf', 1, 0, None)])
+    assert len(listing(fleet)) == 7
+    assert replica.stats()['reloads'] == 2
+    replica.clear()
+    listing(fleet)
+    assert replica.stats()['reloads'] == 3
+
+
+def test_replica_sees_other_clients(factory, fleet):
+    factory.replicate()
+    listing(fleet)
+    other = DroneStore(SQLiteConnectionFactory(factory.database))
+    other.add(Drone(None, 'Echo', 1, 0, None))
+    other._operators.add_many([Operator(None, 'Jill', 'Moe', drone_license=1)])
+    assert listing(fleet)[-1] == (5, 'Echo', None, None)
+    assert operator_listing(fleet)[1] == (4, None)
+
+
+def test_replica_is_bypassed_in_a_transaction(factory, fleet):
+    factory.replicate()
+    listing(fleet)
+    with factory.transaction():
+        fleet.add(Drone(None, 'Echo', 1, 0, None))
+        # the uncommitted drone is only visible on the database
+        assert factory.read_replica() is None
+        assert listing(fleet)[-1][1] == 'Echo'
@@ -0,0 +1,90 @@
+from drones import Drone
+from search import SearchIndex, TableSearch, name_similarity, trigrams
+
+
+def make_index():
+    index = SearchIndex()
+    index.build([(1, 'John Doe'), (2, 'Jane  Roe'), (3, 'Jake Poe'), (4, 'Joan Smith')])
+    return index
+
+
+def test_trigrams_pad_every_word():
+    assert {'  d', ' do'} <= trigrams('john doe')
+
+
+def test_prefix():
+    index = make_index()
+    assert index.prefix('ja') == [3, 2]
+    assert index.prefix('j r') == [2]
+    assert index.prefix('jo doe') == [1]
+    assert index.prefix('x') == []
+
+
+def test_misspelt_words():
+    index = make_index()
+    assert name_similarity('jon', 'john doe') >= 0.4
+    assert 1 in index.search('jon')
+    assert index.search('jon doe') == [1]
+    assert index.search('smyth') == [4]
+    assert index.search('xyz') == []
+
+
+def test_every_word_must_be_alike():
+    assert name_similarity('john smith', 'john doe') == 0.0
+    assert make_index().search('johm smyth') == [4]
+
+
+def test_prefix_matches_come_first():
+    assert make_index().search('jo', 3) == [4, 1]
+
+
+def test_add_and_remove():
+    index = make_index()
+    index.add(1, 'Johnny Rotten')
+    index.remove(4)
+    assert len(index) == 3
+    assert index.search('doe') == []
+    assert index.search('rotten') == [1]
+    assert index.search('smith') == []
+    assert index._words == sorted(index._words)
+
+
+def test_postings_are_rebuilt_once_half_are_stale():
+    index = make_index()
+    for id in (1, 2, 3):
+        index.remove(id)
+    assert index._stale == 0
+    assert all(posting == [4] for posting in index._postings.values())
+    assert index.search('joam') == [4]
+
+
+def test_table_search_follows_the_change_log(factory, fleet):
+    search = TableSearch(factory, 'DroneStore', ('Name',))
+    assert search.search('alpah') == [1]
+
+    drone = fleet.get(1)
+    drone.name = 'Zulu'
+    fleet.update(drone)
+    fleet.remove(2)
+    fleet.add(Drone(None, 'Echo', 1, 0, None))
+    assert search.search('zulu') == [1]
+    assert search.search('alpha') == []
+    assert search.search('bravo') == []
+    assert search.search('echo') == [5]
+
+
+def test_table_search_reloads_after_many_changes(factory, fleet, monkeypatch):
+    search = TableSearch(factory, 'DroneStore', ('Name',), max_changes=2)
+    search.search('alpha')
+    reloads = []
+    reload = search._reload
+    monkeypatch.setattr(search, '_reload', lambda: reloads.append(1) or reload())
+
+    fleet.add(Drone(None, 'Echo', 1, 0, None))
+    assert search.search('echo') == [5]
+    assert reloads == []
+
+    fleet.add_many([Drone(None, 'Foxtrot', 1, 0, None), Drone(None, 'Golf', 1, 0, None),
+                    Drone(None, 'Hotel', 1, 0, None)])
+    assert search.search('hotel') == [8]
+    assert reloads == [1]
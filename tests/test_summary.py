@@ -0,0 +1,44 @@
+from allocation import AllocationEngine
+from drones import Drone
+from summary import check, read_summary, rebuild, summary_lines
+
+
+def test_read_summary(factory, fleet):
+    report = read_summary(factory)
+    assert report['drones'] == 4
+    assert report['drones_by_class'] == {1: 2, 2: 2}
+    assert report['drones_by_rescue'] == {0: 3, 1: 1}
+    assert report['drones_by_allocated'] == {0: 3, 1: 1}
+    assert report['operators'] == 3
+    assert report['operators_by_license'] == {1: 2, 2: 1}
+    assert report['operators_by_endorsement'] == {0: 2, 1: 1}
+    assert '  Class 2 license               1  33.3%' in summary_lines(report)
+
+
+def test_store_writes_keep_the_summaries_current(factory, fleet):
+    drone = fleet.get(1)
+    drone.class_type = 2
+    fleet.update(drone)
+    fleet.remove(2)
+    fleet.add(Drone(None, 'Echo', 1, 0, None))
+    fleet.allocate(4, ['Jake', 'Poe'])
+    operator = fleet._operators.get(3)
+    operator.rescue_endorsement = 0
+    fleet._operators.update(operator)
+    AllocationEngine(factory).run()
+    assert check(factory) == []
+    report = read_summary(factory)
+    assert report['drones_by_class'] == {1: 2, 2: 2}
+    assert report['drones_by_allocated'] == {0: 1, 1: 3}
+    assert report['operators_by_endorsement'] == {0: 3, 1: 0}
+
+
+def test_rebuild_after_writes_without_the_stores(factory, fleet):
+    with factory.connection() as conn:
+        cursor = factory.cursor(conn)
+        cursor.execute('DELETE FROM DroneStore WHERE ID = 4')
+        cursor.close()
+    assert check(factory) == [('DroneSummary', (2, 0, 0), 1, 0)]
+    rebuild(factory)
+    assert check(factory) == []
+    assert read_summary(factory)['drones'] == 3